@@ -44,3 +44,131 @@ S3_AMI_BUCKET = 'openanceamis'
 # as the base for the build volume in create_and_attach_volume
 #USE_SNAPSHOT=False
 
+# Number of seconds the images, snapshots and instances looked
+# up by name are kept in memory before being fetched again.
+#RESOURCE_CACHE_TTL=60
+
+# Maximum number of seconds to wait for a volume, snapshot,
+# instance or image to reach a given state.
+#WAIT_TIMEOUT=3600
+
+# If set to False, the configuration steps are run one SSH
+# command at a time instead of as a single remote script.
+#BATCH_COMMANDS=True
+
+# Local directory mirroring the image file system. Its files
+# are installed on the image along with the configuration files
+# (e.g. overlay/etc/motd is installed as /etc/motd).
+#OVERLAY_DIR='overlay'
+
+# Architectures built by the build_matrix task.
+#BUILD_ARCHS=('x86_64', 'i386')
+
+# Regions the EBS image is copied to after it has been checked.
+#REPLICA_REGIONS=('us-east-1', 'us-west-2')
+
+# Local file where the completed build stages are recorded,
+# for the resume task.
+#STATE_FILE='.archec2build.state'
+
+# If set to True (and SNAPSHOT_ID is not set), the build volume
+# is snapshotted after the packages are installed and after it is
+# configured. The next builds with the same packages (resp. the
+# same configuration) start from these snapshots, and upgrade
+# their packages with pacman -Syu. Each build with new inputs
+# leaves two more snapshots, which are only deleted by
+# fab clean_images:layers=True.
+#USE_LAYERS=False
+
+# If set to True, the downloaded packages are kept on an EBS
+# volume (PACKAGE_CACHE_SIZE GB) reused by the next builds of the
+# same architecture in the same availability zone. The cache is
+# trimmed down to PACKAGE_CACHE_MAX_BYTES after each build.
+# The cache volumes are not deleted by the cleanup tasks: they are
+# billed as any EBS volume as long as they exist.
+#USE_PACKAGE_CACHE=False
+#PACKAGE_CACHE_SIZE=5
+#PACKAGE_CACHE_MAX_BYTES=4 * 1024 ** 3
+
+# If set to True, the packages are downloaded concurrently from
+# the mirrors before pacstrap runs, with at most
+# PREFETCH_CONNECTIONS downloads per mirror.
+#PREFETCH_PACKAGES=True
+#PREFETCH_CONNECTIONS=2
+
+# If set to True, build_all first downloads the sync databases of
+# the repositories (into SYNC_DB_DIR) and resolves the packages. The
+# build is skipped when the package versions and the configuration
+# are the ones recorded on the base image.
+#CHECK_PACKAGE_VERSIONS=True
+#SYNC_DB_DIR='.archec2build.db'
+
+# Size in GB of the build volume. When it is not set, the size is
+# computed from the installed size of the resolved packages times
+# VOLUME_HEADROOM (see AUTO_VOLUME_SIZE).
+#VOLUME_SIZE=15
+#AUTO_VOLUME_SIZE=True
+#VOLUME_HEADROOM=1.5
+
+# Local file keeping the measured mirror scores, and number of
+# seconds after which the mirrors are measured again.
+#MIRROR_SCORES_FILE='.archec2build.mirrors'
+#MIRROR_SCORE_TTL=86400
+
+# Number of concurrent uploads of the S3 bundle parts, and URL of
+# an S3 compatible service to upload them to instead of S3.
+#S3_UPLOAD_CONNECTIONS=4
+#S3_ENDPOINT='http://localhost:9000'
+
+# If set to True, the files listed by MINIMIZE_POLICY (category,
+# glob patterns) are removed from the image before it is created,
+# except the locales of LANG. The free blocks are then trimmed
+# ('trim'), zeroed ('zero', which writes every free block) or left
+# alone (None).
+#MINIMIZE_IMAGE=False
+#MINIMIZE_POLICY=[
+#    ('package_cache', ['/var/cache/pacman/pkg/*']),
+#    ('man_pages', ['/usr/share/man/*']),
+#    ('documentation', ['/usr/share/doc/*', '/usr/share/info/*', '/usr/share/gtk-doc/*']),
+#    ('locales', ['/usr/share/locale/*']),
+#    ('logs', ['/var/log/journal/*', '/var/log/*.log']),
+#    ('headers', ['/usr/include/*']),
+#]
+#MINIMIZE_FREE_SPACE='trim'
+
+# The number of seconds to wait for a launched instance to be reachable
+# through SSH (port open, SSH banner, then a command run as root) before
+# giving up on it.
+#PROBE_DEADLINE=600
+
+# The maximum number of EC2 operations (deletions, reboots...) run
+# concurrently on the instances, images and snapshots.
+#WORKERS=8
+
+# Retention of clean_images: the number of most recent images (and
+# image snapshots) kept per architecture, and the age in days under
+# which they are kept anyway. The base images are always kept. The
+# S3 build manifests and bundles of the de-registered images are
+# only deleted with fab clean_images:s3=True (deregister_s3_image and
+# clean_all delete those of the current build).
+#GC_KEEP_LAST=0
+#GC_KEEP_DAYS=0
+# The maximum number of deletions per second while cleaning.
+#GC_RATE=5
+
+# Client side throttling of the EC2 API: the requests per second of
+# each API action, by default and for specific actions. The limits
+# apply to each fab process, so lower them when several builds share
+# the account.
+#EC2_REQUEST_RATE=10
+#EC2_REQUEST_RATES={'CreateTags' : 5, 'DescribeInstances' : 20}
+# Throttled requests (RequestLimitExceeded) are retried, waiting a
+# random time up to EC2_RETRY_DELAY * 2^attempt seconds, capped to
+# EC2_RETRY_MAX_DELAY. The 5xx and network failures are retried the
+# same way for the Describe and tagging requests (and RunInstances
+# and CopyImage, which are sent with a ClientToken) only, and the
+# network failures at most EC2_CONNECTION_RETRIES times.
+#EC2_MAX_RETRIES=8
+#EC2_RETRY_DELAY=0.5
+#EC2_RETRY_MAX_DELAY=30
+#EC2_CONNECTION_RETRIES=2
@@ -2,16 +2,55 @@
 import config
 import boto
 import boto.ec2
+import boto.utils
+from boto.exception import BotoServerError, EC2ResponseError
+from boto.ec2.connection import EC2Connection
+from boto.ec2.image import Image
+from boto.ec2.instance import Instance
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
 from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping ,\
     BlockDeviceType
 from fabric.colors import green, red, yellow, white, blue
 from fabric.api import *
 from fabric.utils import abort
+import fabric.network
+import fabric.state
 from fabric.context_managers import cd
 import time
+import base64
+import collections
 import datetime
+import errno
+import fcntl
+import random
+import fnmatch
+import hashlib
+import httplib
+import inspect
+import itertools
+import json
+import manifest
+import math
+import mirrors
+import multiprocessing
+import os
+import pipes
+import prefetch
+import probe
+import re
+import shutil
+import s3upload
+import socket
+import stat
+import sys
+import tarfile
+import tempfile
 from StringIO import StringIO
 import threading
+import traceback
+import urllib2
+import uuid
 
 
 #import logging
@@ -22,8 +61,8 @@ import threading
 ##############
 
 VOLUME_SIZE = getattr(config, 'VOLUME_SIZE', 15)
-MAIN_PARTITION_SIZE = getattr(config, 'MAIN_PARTITION_SIZE', VOLUME_SIZE-2)
-SWAP_PARTITION_SIZE = VOLUME_SIZE-MAIN_PARTITION_SIZE
+AUTO_VOLUME_SIZE = getattr(config, 'AUTO_VOLUME_SIZE', not hasattr(config, 'VOLUME_SIZE'))
+VOLUME_HEADROOM = getattr(config, 'VOLUME_HEADROOM', 1.5)
 MAIN_PARTITION_MOUNT_POINT = getattr(config, 'MAIN_PARTITION_MOUNT_POINT', '/mnt/archec2build')
 HOSTNAME = getattr(config, 'HOSTNAME', 'archec2')
 LANG = getattr(config, 'LANG', 'fr_FR.UTF-8')
@@ -33,7 +72,47 @@ PACKAGES_FILENAME = getattr(config, 'PACKAGES_FILENAME', 'packages')
 IMAGE_DESCRIPTION = getattr(config, 'IMAGE_DESCRIPTION', 'ArchLinux EC2 Image')
 INSTANCE_KEY_NAME = getattr(config, 'INSTANCE_KEY_NAME', 'default.eu')
 INSTANCE_SECURITY_GROUP = getattr(config, 'INSTANCE_SECURITY_GROUP', 'default')
-EC2_BUILD_INSTANCE = getattr(config, 'EC2_BUILD_INSTANCE', 'Unknown')
+RESOURCE_CACHE_TTL = getattr(config, 'RESOURCE_CACHE_TTL', 60)
+WAIT_TIMEOUT = getattr(config, 'WAIT_TIMEOUT', 3600)
+BATCH_COMMANDS = getattr(config, 'BATCH_COMMANDS', True)
+OVERLAY_DIR = getattr(config, 'OVERLAY_DIR', None)
+BUILD_ARCHS = getattr(config, 'BUILD_ARCHS', ('x86_64', 'i386'))
+REPLICA_REGIONS = getattr(config, 'REPLICA_REGIONS', ())
+STATE_FILE = getattr(config, 'STATE_FILE', '.archec2build.state')
+USE_LAYERS = getattr(config, 'USE_LAYERS', False)
+USE_PACKAGE_CACHE = getattr(config, 'USE_PACKAGE_CACHE', False)
+PACKAGE_CACHE_SIZE = getattr(config, 'PACKAGE_CACHE_SIZE', 5)
+PACKAGE_CACHE_MAX_BYTES = getattr(config, 'PACKAGE_CACHE_MAX_BYTES', PACKAGE_CACHE_SIZE * 1024 ** 3 * 8 / 10)
+PACKAGE_CACHE_MOUNT_POINT = getattr(config, 'PACKAGE_CACHE_MOUNT_POINT', '/mnt/archec2build-pkgcache')
+PREFETCH_PACKAGES = getattr(config, 'PREFETCH_PACKAGES', True)
+PREFETCH_CONNECTIONS = getattr(config, 'PREFETCH_CONNECTIONS', 2)
+CHECK_PACKAGE_VERSIONS = getattr(config, 'CHECK_PACKAGE_VERSIONS', True)
+SYNC_DB_DIR = getattr(config, 'SYNC_DB_DIR', '.archec2build.db')
+MIRROR_SCORES_FILE = getattr(config, 'MIRROR_SCORES_FILE', '.archec2build.mirrors')
+MIRROR_SCORE_TTL = getattr(config, 'MIRROR_SCORE_TTL', 86400)
+S3_UPLOAD_CONNECTIONS = getattr(config, 'S3_UPLOAD_CONNECTIONS', 4)
+S3_ENDPOINT = getattr(config, 'S3_ENDPOINT', None)
+MINIMIZE_IMAGE = getattr(config, 'MINIMIZE_IMAGE', False)
+MINIMIZE_POLICY = getattr(config, 'MINIMIZE_POLICY', [
+    ('package_cache', ['/var/cache/pacman/pkg/*']),
+    ('man_pages', ['/usr/share/man/*']),
+    ('documentation', ['/usr/share/doc/*', '/usr/share/info/*', '/usr/share/gtk-doc/*']),
+    ('locales', ['/usr/share/locale/*']),
+    ('logs', ['/var/log/journal/*', '/var/log/*.log']),
+    ('headers', ['/usr/include/*']),
+])
+MINIMIZE_FREE_SPACE = getattr(config, 'MINIMIZE_FREE_SPACE', 'trim')
+PROBE_DEADLINE = getattr(config, 'PROBE_DEADLINE', 600)
+WORKERS = getattr(config, 'WORKERS', 8)
+GC_KEEP_LAST = getattr(config, 'GC_KEEP_LAST', 0)
+GC_KEEP_DAYS = getattr(config, 'GC_KEEP_DAYS', 0)
+GC_RATE = getattr(config, 'GC_RATE', 5)
+EC2_REQUEST_RATE = getattr(config, 'EC2_REQUEST_RATE', 10)
+EC2_REQUEST_RATES = getattr(config, 'EC2_REQUEST_RATES', {})
+EC2_MAX_RETRIES = getattr(config, 'EC2_MAX_RETRIES', 8)
+EC2_RETRY_DELAY = getattr(config, 'EC2_RETRY_DELAY', 0.5)
+EC2_RETRY_MAX_DELAY = getattr(config, 'EC2_RETRY_MAX_DELAY', 30)
+EC2_CONNECTION_RETRIES = getattr(config, 'EC2_CONNECTION_RETRIES', 2)
 
 ##################
 # TEMPLATES
@@ -82,18 +161,190 @@ Server = http://archlinux.supsec.org/$repo/os/$arch
 """
     
 
-def create_ec2_connection(region=config.EC2_REGION):
+class PooledEC2Connection(EC2Connection):
     """
-    Creates an EC2 connection.
+    EC2 connection shared by the whole fab process.
+    
+    boto keeps the underlying HTTP connections in a thread safe 
+    pool, so a single instance can be used by several threads. 
+    The class counts the HTTP connections it opens and the 
+    requests it makes, to check that connections are reused.
+    
+    The requests of each API action go through a token bucket 
+    allowing ``EC2_REQUEST_RATE`` requests per second (or the 
+    action's rate in ``EC2_REQUEST_RATES``). The requests that EC2 
+    throttles are retried up to ``EC2_MAX_RETRIES`` times with an 
+    exponential backoff and jitter. A 5xx error or a network error 
+    may come after the request was carried out, so they are only 
+    retried for the idempotent actions (see :method:`idempotent`),
+    and the network errors at most ``EC2_CONNECTION_RETRIES`` times.
+    The latency, retries and errors of each action are counted.
+    """
+    
+    THROTTLING_ERRORS = ('RequestLimitExceeded', 'Throttling')
+    IDEMPOTENT_ACTIONS = ('CreateTags', 'DeleteTags')
+    # Actions made idempotent by a ClientToken
+    CLIENT_TOKEN_ACTIONS = ('RunInstances', 'CopyImage')
+    # Network errors raised before the request is sent
+    UNSENT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+    
+    def __init__(self, *args, **kwargs):
+        EC2Connection.__init__(self, *args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.stats = { 'connections' : 0, 'requests' : 0 }
+        self.actions = {}
+        self.limiters = {}
+        
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+        
+    def new_http_connection(self, host, port, is_secure):
+        self.count('connections')
+        return EC2Connection.new_http_connection(self, host, port, is_secure)
+        
+    def limiter(self, action):
+        "Returns the :class:`RateLimiter` of ``action``."
+        with self.stats_lock:
+            limiter = self.limiters.get(action)
+            if limiter is None:
+                rate = EC2_REQUEST_RATES.get(action, EC2_REQUEST_RATE)
+                limiter = self.limiters[action] = RateLimiter(rate, max(1, int(rate * 2)))
+            return limiter
+        
+    def record(self, action, latency, error=None, throttled=False):
+        with self.stats_lock:
+            stats = self.actions.setdefault(action, { 
+                'requests' : 0, 'retries' : 0, 'throttled' : 0, 'errors' : 0, 'time' : 0.0, 'max_time' : 0.0 })
+            stats['requests'] += 1
+            stats['time'] += latency
+            stats['max_time'] = max(stats['max_time'], latency)
+            if error:
+                stats['errors'] += 1
+            if throttled:
+                stats['throttled'] += 1
+                
+    def retry_error(self, response):
+        """
+        Returns the reason to retry the request of ``response``, or 
+        ``None`` if the response is final.
+        """
+        if response.status >= 500:
+            return '%d %s' % (response.status, response.reason)
+        if response.status == 400:
+            # boto caches the body, the caller can read it again
+            body = response.read()
+            for code in self.THROTTLING_ERRORS:
+                if '<Code>%s</Code>' % code in body:
+                    return code
+        return None
+        
+    def idempotent(self, action, params):
+        "Returns ``True`` if repeating the request of ``action`` is harmless."
+        return action.startswith(('Describe', 'Get')) or action in self.IDEMPOTENT_ACTIONS \
+            or 'ClientToken' in (params or {})
+    
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        # Retries are made by make_request, so that they are throttled
+        return EC2Connection._mexe(self, request, sender, 0, retry_handler)
+        
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        limiter = self.limiter(action)
+        if action in self.CLIENT_TOKEN_ACTIONS and 'ClientToken' not in (params or {}):
+            params = dict(params or {}, ClientToken=uuid.uuid4().hex)
+        idempotent = self.idempotent(action, params)
+        network_errors = 0
+        for attempt in range(EC2_MAX_RETRIES + 1):
+            limiter.acquire()
+            self.count('requests')
+            start = time.time()
+            response = error = None
+            try:
+                response = EC2Connection.make_request(self, action, params, path, verb)
+                reason = self.retry_error(response)
+            except BotoServerError, e:
+                # 5xx responses
+                error, reason = e, e.error_code or '%d %s' % (e.status, e.reason)
+                if e.status < 500 and e.error_code not in self.THROTTLING_ERRORS:
+                    self.record(action, time.time() - start, True)
+                    raise
+            except (socket.error, httplib.HTTPException), e:
+                error, reason = e, str(e) or e.__class__.__name__
+                network_errors += 1
+            self.record(action, time.time() - start, reason or response.status >= 300, 
+                reason in self.THROTTLING_ERRORS)
+            if not reason:
+                return response
+            final = attempt == EC2_MAX_RETRIES
+            if reason not in self.THROTTLING_ERRORS and not idempotent \
+                and getattr(error, 'errno', None) not in self.UNSENT_ERRNOS:
+                # The request may have been carried out
+                final = True
+            if network_errors > EC2_CONNECTION_RETRIES:
+                final = True
+            if final:
+                if response is not None:
+                    # The caller raises the EC2 error
+                    return response
+                raise error
+            delay = random.uniform(0, min(EC2_RETRY_MAX_DELAY, EC2_RETRY_DELAY * 2 ** attempt))
+            with self.stats_lock:
+                self.actions[action]['retries'] += 1
+            print yellow('%s failed (%s), retrying in %.1fs' % (action, reason, delay))
+            time.sleep(delay)
+
+EC2_CONNECTIONS = {}
+EC2_CONNECTIONS_LOCK = threading.Lock()
+
+def create_ec2_connection(region=None):
+    """
+    Returns the EC2 connection for ``region``.
+    
+    Connections are kept in a process wide registry keyed by 
+    region and credentials, so that every call with the same 
+    parameters returns the same connection.
     
     :type region: string
     :param region: The region to connect to. By default, connects to
         the region specified in the ``config`` module.
     
-    :rtype: class:`boto.ec2.connection`.
+    :rtype: class:`PooledEC2Connection`.
     :return: The boto connection. 
     """
-    return boto.ec2.connect_to_region(config.EC2_REGION, aws_access_key_id=config.AWS_ACCESS_KEY_ID, aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY)
+    region = region or config.EC2_REGION
+    key = (region, config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY)
+    with EC2_CONNECTIONS_LOCK:
+        connection = EC2_CONNECTIONS.get(key)
+        if connection is None:
+            region_info = boto.ec2.get_region(region)
+            if region_info is None:
+                raise Exception("Unknown region %s" % region)
+            connection = PooledEC2Connection(
+                region=region_info,
+                aws_access_key_id=config.AWS_ACCESS_KEY_ID, 
+                aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY)
+            EC2_CONNECTIONS[key] = connection
+    return connection
+
+def get_connection_stats():
+    """
+    Returns the number of HTTP connections opened and requests 
+    made by the shared EC2 connections, and the statistics of each
+    API action, by region.
+    """
+    with EC2_CONNECTIONS_LOCK:
+        connections = EC2_CONNECTIONS.items()
+    stats = {}
+    for (region, access_key, secret_key), connection in connections:
+        with connection.stats_lock:
+            region_stats = stats.setdefault(region, { 'connections' : 0, 'requests' : 0, 'actions' : {} })
+            for key, value in connection.stats.iteritems():
+                region_stats[key] += value
+            for action, action_stats in connection.actions.iteritems():
+                totals = region_stats['actions'].setdefault(action, dict.fromkeys(action_stats, 0))
+                for key, value in action_stats.iteritems():
+                    totals[key] = max(totals[key], value) if key == 'max_time' else totals[key] + value
+    return stats
 
 def get_instance(connection=create_ec2_connection, instance_id=None):
     if callable(connection):
@@ -104,10 +355,19 @@ def get_instance(connection=create_ec2_connection, instance_id=None):
         raise Exception('No instance with name %s' % instance_id)
     return reservation.instances[0]
 
-def get_arch():
+def get_arch(build=None):
+    """
+    Returns the architecture of the build instance, ``'x86_64'`` if 
+    there is none.
+    """
+    build = build or constants
+    instance_id = build.build_instance_id()
+    if instance_id == 'Unknown':
+        return 'x86_64'
     try:
-        return get_instance().architecture
-    except:
+        return get_instance(instance_id=instance_id).architecture
+    except (BotoServerError, IndexError):
+        # The instance is gone
         return 'x86_64'
     
 def get_hostname_from_instance(connection=create_ec2_connection, instance_id=None):
@@ -119,28 +379,337 @@ SNAPSHOT_NAME_TEMPLATE = '%s.build.%s'
 IMAGE_NAME_TEMPLATE = '%s.image.%s'
 INSTANCE_NAME_TEMPLATE = '%s.instance.%s'
 
-ARCH = getattr(config, 'ARCH', get_arch())
 BASE_PREFIX = getattr(config, 'BASE_PREFIX', 'archec2')
 BASE_S3_PREFIX = getattr(config, 'BASE_S3_PREFIX', '%s.s3' % BASE_PREFIX)
-DATE_STRING = getattr(config, 'DATE_STRING', datetime.datetime.today().strftime('%Y%m%d'))
-PREFIX = getattr(config, 'PREFIX', '%s.%s' % (BASE_PREFIX, DATE_STRING))
-S3_PREFIX = getattr(config, 'S3_PREFIX', '%s.%s' % (BASE_S3_PREFIX, DATE_STRING))
+USE_SNAPSHOT = getattr(config, 'USE_SNAPSHOT', False)
 
-IMAGE_NAME = getattr(config, 'S3_IMAGE_NAME', IMAGE_NAME_TEMPLATE % (PREFIX, ARCH))
-S3_IMAGE_NAME = getattr(config, 'IMAGE_NAME', IMAGE_NAME_TEMPLATE % (S3_PREFIX, ARCH))
-SNAPSHOT_NAME = getattr(config, 'SNAPSHOT_NAME', SNAPSHOT_NAME_TEMPLATE % (PREFIX, ARCH))
-VOLUME_NAME = getattr(config, 'VOLUME_NAME', SNAPSHOT_NAME)
-INSTANCE_NAME = getattr(config, 'INSTANCE_NAME', INSTANCE_NAME_TEMPLATE % (PREFIX, ARCH))
-S3_INSTANCE_NAME = getattr(config, 'S3_INSTANCE_NAME', INSTANCE_NAME_TEMPLATE % (S3_PREFIX, ARCH))
 
-BASE_IMAGE_NAME = getattr(config, 'BASE_IMAGE_NAME', IMAGE_NAME_TEMPLATE % (BASE_PREFIX, ARCH))
-BASE_S3_IMAGE_NAME = getattr(config, 'BASE_S3_IMAGE_NAME', IMAGE_NAME_TEMPLATE % (BASE_S3_PREFIX, ARCH))
-BASE_SNAPSHOT_NAME = getattr(config, 'BASE_SNAPSHOT_NAME', SNAPSHOT_NAME_TEMPLATE % (BASE_PREFIX, ARCH))
-BASE_INSTANCE_NAME = getattr(config, 'BASE_INSTANCE_NAME', INSTANCE_NAME_TEMPLATE % (BASE_PREFIX, ARCH))
-BASE_S3_INSTANCE_NAME = getattr(config, 'BASE_S3_INSTANCE_NAME', INSTANCE_NAME_TEMPLATE % (BASE_S3_PREFIX, ARCH))
+class lazy(object):
+    """
+    Decorator making a method an attribute computed on first 
+    access and memoized on the instance afterwards.
+    
+    Each instance has its own lock, so that the values of different
+    builds are resolved concurrently.
+    """
+    lock = threading.RLock()
+    
+    def __init__(self, method):
+        self.method = method
+        self.__name__ = method.__name__
+        self.__doc__ = method.__doc__
+        
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        with obj.__dict__.setdefault('_lazy_lock', threading.RLock()):
+            if not obj.__dict__.has_key(self.__name__):
+                obj.__dict__[self.__name__] = self.method(obj)
+        return obj.__dict__[self.__name__]
 
 
-def get_kernel(s3=True, region=config.EC2_REGION, arch = ARCH ):
+class Build(object):
+    """
+    A build: its configuration, the names of its resources and the 
+    resources resolved so far (build instance, volume and device).
+    
+    Resolving ``ARCH`` may require looking at the build instance
+    and ``SNAPSHOT_ID`` at the build snapshots, so nothing is 
+    computed when the build is created. Each value is resolved the 
+    first time a task needs it and memoized afterwards. A value 
+    present in ``settings`` or in the ``config`` module always takes 
+    precedence, except for ``arch`` and ``date`` when they are given.
+    
+    The tasks and helpers work on the *current* build of their 
+    thread, through ``constants``. A build is made current with 
+    ``with build:``, and the threads started by :class:`WorkerPool` 
+    and :class:`Pipeline` inherit it. ``Build.default`` is current 
+    when no build is. The build instance is only the Fabric host 
+    within :method:`run` and :method:`resume` (``settings``), and 
+    Fabric's ``env`` is shared by the whole process, so builds run
+    concurrently in separate processes (see :method:`build_matrix`).
+    
+    :type arch: string
+    :param arch: The architecture to build.
+    
+    :type date: string
+    :param date: The date in the names of the build (``DATE_STRING``
+        or today by default).
+    
+    :type settings: object
+    :param settings: Overrides of the ``config`` module values, as 
+        attributes.
+    """
+    
+    local = threading.local()
+    default = None
+    
+    def __init__(self, arch=None, date=None, settings=None):
+        self.arch = arch
+        self.date = date
+        self.settings = settings
+        self.instance_id = None
+        self.lock = threading.RLock()
+        
+    def __repr__(self):
+        return '<Build %s>' % (self.arch or 'default')
+        
+    def __enter__(self):
+        Build.local.__dict__.setdefault('stack', []).append(self)
+        return self
+        
+    def __exit__(self, *args):
+        Build.local.stack.pop()
+        
+    @classmethod
+    def current(cls):
+        "Returns the current build of the thread."
+        stack = getattr(cls.local, 'stack', None)
+        return stack[-1] if stack else cls.default
+        
+    def setting(self, name, default=None):
+        "Returns the configured value of ``name``, from ``settings`` then ``config``."
+        if self.settings is not None and hasattr(self.settings, name):
+            return getattr(self.settings, name)
+        return getattr(config, name, default)
+    
+    @lazy
+    def ARCH(self):
+        return self.arch or self.setting('ARCH') or get_arch(self)
+    
+    @lazy
+    def DATE_STRING(self):
+        return self.date or self.setting('DATE_STRING') or datetime.datetime.today().strftime('%Y%m%d')
+    
+    @lazy
+    def PREFIX(self):
+        return self.setting('PREFIX') or '%s.%s' % (BASE_PREFIX, self.DATE_STRING)
+    
+    @lazy
+    def S3_PREFIX(self):
+        return self.setting('S3_PREFIX') or '%s.%s' % (BASE_S3_PREFIX, self.DATE_STRING)
+    
+    @lazy
+    def IMAGE_NAME(self):
+        return self.setting('IMAGE_NAME') or IMAGE_NAME_TEMPLATE % (self.PREFIX, self.ARCH)
+    
+    @lazy
+    def S3_IMAGE_NAME(self):
+        return self.setting('S3_IMAGE_NAME') or IMAGE_NAME_TEMPLATE % (self.S3_PREFIX, self.ARCH)
+    
+    @lazy
+    def SNAPSHOT_NAME(self):
+        return self.setting('SNAPSHOT_NAME') or SNAPSHOT_NAME_TEMPLATE % (self.PREFIX, self.ARCH)
+    
+    @lazy
+    def VOLUME_NAME(self):
+        return self.setting('VOLUME_NAME') or self.SNAPSHOT_NAME
+    
+    @lazy
+    def INSTANCE_NAME(self):
+        return self.setting('INSTANCE_NAME') or INSTANCE_NAME_TEMPLATE % (self.PREFIX, self.ARCH)
+    
+    @lazy
+    def S3_INSTANCE_NAME(self):
+        return self.setting('S3_INSTANCE_NAME') or INSTANCE_NAME_TEMPLATE % (self.S3_PREFIX, self.ARCH)
+    
+    @lazy
+    def BASE_IMAGE_NAME(self):
+        return self.setting('BASE_IMAGE_NAME') or IMAGE_NAME_TEMPLATE % (BASE_PREFIX, self.ARCH)
+    
+    @lazy
+    def BASE_S3_IMAGE_NAME(self):
+        return self.setting('BASE_S3_IMAGE_NAME') or IMAGE_NAME_TEMPLATE % (BASE_S3_PREFIX, self.ARCH)
+    
+    @lazy
+    def BASE_SNAPSHOT_NAME(self):
+        return self.setting('BASE_SNAPSHOT_NAME') or SNAPSHOT_NAME_TEMPLATE % (BASE_PREFIX, self.ARCH)
+    
+    @lazy
+    def MANIFEST(self):
+        "The packages to install, resolved against the current sync databases."
+        return resolve_manifest(fetch_sync_databases(self.ARCH))
+    
+    @lazy
+    def PACKAGE_CACHE_NAME(self):
+        return self.setting('PACKAGE_CACHE_NAME') or '%s.pkgcache.%s' % (BASE_PREFIX, self.ARCH)
+    
+    @lazy
+    def BASE_INSTANCE_NAME(self):
+        return self.setting('BASE_INSTANCE_NAME') or INSTANCE_NAME_TEMPLATE % (BASE_PREFIX, self.ARCH)
+    
+    @lazy
+    def BASE_S3_INSTANCE_NAME(self):
+        return self.setting('BASE_S3_INSTANCE_NAME') or INSTANCE_NAME_TEMPLATE % (BASE_S3_PREFIX, self.ARCH)
+    
+    @lazy
+    def SNAPSHOT_ID(self):
+        "The id of the snapshot to start the build volume from, or ``None``."
+        if self.setting('SNAPSHOT_ID'):
+            return self.setting('SNAPSHOT_ID')
+        return find_snapshots(name=self.SNAPSHOT_NAME)[0].id if USE_SNAPSHOT else None
+
+    def build_instance_id(self, connection=create_ec2_connection):
+        """
+        Returns the id of the build instance, 'Unknown' if there is none.
+        
+        The build instance is the one set by the build when it 
+        launches or reuses an instance, the one configured by 
+        ``EC2_BUILD_INSTANCE``, or the first running instance named 
+        ``BASE_INSTANCE_NAME`` (see :method:`base_instance_names`).
+        """
+        with self.lock:
+            if self.instance_id is None:
+                self.instance_id = self.setting('EC2_BUILD_INSTANCE')
+            if self.instance_id is None:
+                for name in self.base_instance_names():
+                    running_instances = find_running_instances(connection, name=name)
+                    if running_instances:
+                        self.instance_id = running_instances[0].id
+                        break
+            return self.instance_id or 'Unknown'
+            
+    def base_instance_names(self):
+        """
+        Returns the possible names of the build instance. 
+        
+        ``ARCH`` may be resolved from the build instance, so when it 
+        isn't known yet these are the ``BASE_INSTANCE_NAME`` of each 
+        architecture of ``BUILD_ARCHS``.
+        """
+        if self.setting('BASE_INSTANCE_NAME'):
+            return [self.setting('BASE_INSTANCE_NAME')]
+        known = self.arch or self.setting('ARCH') or self.__dict__.get('ARCH')
+        return [INSTANCE_NAME_TEMPLATE % (BASE_PREFIX, arch) for arch in ([known] if known else BUILD_ARCHS)]
+        
+    def instance(self, connection=create_ec2_connection):
+        "Returns the build instance."
+        return get_instance(connection, self.build_instance_id(connection))
+        
+    def volume(self):
+        """
+        Returns the build instance, the build volume and the device 
+        it is attached to (``None`` if it is not attached).
+        """
+        instance = self.instance()
+        volume, device_name = find_build_device(instance, self.VOLUME_NAME)
+        return (instance, volume, device_name)
+        
+    def run(self, clean=True, force=False):
+        "Runs the build, see :method:`build_all`."
+        with self:
+            manifest = None
+            if CHECK_PACKAGE_VERSIONS:
+                manifest, changes = check_upstream_changes()
+                if not changes and not force:
+                    print green('Nothing changed since %s was built, skipping the build' % self.BASE_IMAGE_NAME)
+                    return (None, None)
+                for change in changes:
+                    print blue('Changed: %s' % change)
+        
+            existing_running_instances = find_running_instances()
+            if existing_running_instances and len(existing_running_instances) > 0:
+                build_instance = existing_running_instances[0]
+                if not check_instance(build_instance):
+                    abort('Build instance %s is not available through SSH' % build_instance.id)
+                print blue('Using existing instance %s...' % build_instance.id)
+                created=False
+            else:     
+                print blue('Launching build instance...')
+                build_instance = launch_instance_and_wait()
+                created=True
+            self.instance_id = build_instance.id
+            with settings(host_string='root@%s' % build_instance.dns_name):
+                print blue('Building images...')
+                checkpoints = Checkpoints()
+                checkpoints.reset()
+                results = build_pipeline(checkpoints, manifest).run()
+                terminate(build_instance)
+            if created:
+                terminate(build_instance)
+            if clean:
+                clean_images()
+            return (results['create_image'], results['create_s3_image'])
+        
+    def resume(self):
+        "Resumes the build, see :method:`resume`."
+        with self:
+            checkpoints = Checkpoints()
+            stages = checkpoints.stages()
+            if not stages:
+                abort('No checkpoint for build %s in %s' % (checkpoints.build, checkpoints.path))
+            if 'create_image' in stages:
+                print green('Build %s is complete (image %s)' % (checkpoints.build, checkpoints.resources()['image_id']))
+                return None
+            instance = verify_checkpoints(checkpoints)
+            self.instance_id = instance.id
+            print blue('Resuming build %s after stage %s' % (checkpoints.build, (checkpoints.stages() or ['none'])[-1]))
+            with settings(host_string='root@%s' % instance.dns_name):
+                results = run_make_image_stages(checkpoints, create_snapshot='create_volume_snapshot' in stages)
+            return results.get('create_image')
+
+class CurrentBuild(object):
+    "Forwards the attribute accesses to the current :class:`Build` of the thread."
+    
+    def __getattr__(self, name):
+        return getattr(Build.current(), name)
+        
+    def __setattr__(self, name, value):
+        setattr(Build.current(), name, value)
+
+Build.default = Build()
+constants = CurrentBuild()
+
+def inherit_build(function):
+    """
+    Returns ``function`` wrapped to run with the current build of 
+    the calling thread, to start a thread with.
+    """
+    build = Build.current()
+    def run(*args, **kwargs):
+        with build:
+            return function(*args, **kwargs)
+    return run
+
+
+class LazyHosts(list):
+    """
+    A host list that calls ``resolver`` the first time it is read.
+    
+    Assigned to ``env.hosts`` so that Fabric only looks up the 
+    build instance when a task is about to be executed, and not 
+    when the fabfile is loaded (``fab -l`` for instance).
+    """
+    
+    def __init__(self, resolver):
+        list.__init__(self)
+        self.resolver = resolver
+        self.resolved = False
+        
+    def resolve(self):
+        with lazy.lock:
+            if not self.resolved:
+                self[:] = self.resolver()
+                self.resolved = True
+        return self
+    
+    def __iter__(self):
+        return list.__iter__(self.resolve())
+    
+    def __len__(self):
+        return list.__len__(self.resolve())
+    
+    def __getitem__(self, index):
+        return list.__getitem__(self.resolve(), index)
+    
+    def __contains__(self, item):
+        return list.__contains__(self.resolve(), item)
+    
+    def __repr__(self):
+        return list.__repr__(self.resolve())
+
+
+def get_kernel(s3=True, region=config.EC2_REGION, arch=None):
     #===========================================================================
     # EC2_PV_KERNELS = {
     # 
@@ -169,7 +738,7 @@ def get_kernel(s3=True, region=config.EC2_REGION, arch = ARCH ):
         raise Exception("Unknown region %s" % region)
     kernels = EC2_PV_KERNELS[region]
     index = 0 if s3 else 2
-    if arch != 'x86_64':
+    if (arch or constants.ARCH) != 'x86_64':
         index = index + 1
     return kernels[index]
 
@@ -181,6 +750,224 @@ def remove_packages(*args):
     with hide('output'):
         run('pacman -Rc --noconfirm --unneeded %s' % ' '.join(args) )
 
+def pacman_arch(arch=None):
+    """
+    Returns the pacman architecture (``uname -m``) matching the
+    EC2 architecture ``arch`` (``ARCH`` by default).
+    """
+    arch = arch or constants.ARCH
+    return 'i686' if arch == 'i386' else arch
+
+class Overlay(object):
+    """
+    An in memory tree of files to install on a remote file system.
+    
+    The files are sent as a single tar archive, keeping their modes
+    and giving them to root (see :method:`RemoteScript.extract`).
+    The archive has an entry for each of their directories, so that
+    the missing ones are created with their mode (``0755`` unless 
+    given with :method:`mkdir`). The existing directories are left
+    as they are.
+    """
+    
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        
+    def __len__(self):
+        "Returns the number of files, directories excluded."
+        return len([info for info, content in self.entries.itervalues() if not info.isdir()])
+        
+    def entry(self, path, content='', mode=0644):
+        info = tarfile.TarInfo(path.strip('/'))
+        info.size = len(content)
+        info.mode = mode
+        info.mtime = time.time()
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        return info
+        
+    def mkdir(self, path, mode=0755):
+        "Adds the directory ``path`` and its parents, with the given ``mode``."
+        parent = os.path.dirname(path.rstrip('/'))
+        if parent.strip('/') and parent.strip('/') not in self.entries:
+            self.mkdir(parent)
+        info = self.entry(path, mode=mode)
+        info.type = tarfile.DIRTYPE
+        self.entries[info.name] = (info, '')
+        
+    def add(self, path, content, mode=0644):
+        """
+        Adds the file ``path`` (absolute in the target file system)
+        with the given ``content`` and ``mode``.
+        """
+        parent = os.path.dirname(path)
+        if parent.strip('/') and parent.strip('/') not in self.entries:
+            self.mkdir(parent)
+        info = self.entry(path, content, mode)
+        self.entries[info.name] = (info, content)
+        
+    def add_directory(self, directory):
+        """
+        Adds the files, symbolic links and directories of the local
+        ``directory``, which mirrors the target file system.
+        """
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            if dirpath != directory:
+                self.mkdir('/' + os.path.relpath(dirpath, directory), stat.S_IMODE(os.stat(dirpath).st_mode))
+            for filename in sorted(filenames):
+                local = os.path.join(dirpath, filename)
+                path = '/' + os.path.relpath(local, directory)
+                if os.path.islink(local):
+                    self.add(path, '', 0777)
+                    info = self.entries[path.lstrip('/')][0]
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = os.readlink(local)
+                else:
+                    with open(local, 'rb') as f:
+                        self.add(path, f.read(), stat.S_IMODE(os.stat(local).st_mode))
+                        
+    def archive(self):
+        "Returns the content of the tree as a gzipped tar archive."
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        for info, content in self.entries.itervalues():
+            tar.addfile(info, StringIO(content) if info.isfile() else None)
+        tar.close()
+        return buf.getvalue()
+
+class RemoteScript(object):
+    """
+    Collects the steps of a task and runs them on the build 
+    instance as a single shell script.
+    
+    Instead of one SSH round trip per command, the script is sent 
+    and executed with a single :method:`run`. Consecutive steps 
+    added with :method:`chroot` share a single ``arch-chroot`` 
+    session. When a step fails, the script stops and the task 
+    aborts with the number, description and command of that step.
+    
+    When ``BATCH_COMMANDS`` is ``False``, the steps are run one by
+    one, which is easier to debug.
+    
+    The script is passed on the command line, unless it is longer 
+    than ``INLINE_LIMIT``. It is then uploaded first, as are the
+    archives of the :method:`extract` steps.
+    """
+    MARKER = 'ARCHEC2BUILD_FAILED_STEP='
+    # arch-chroot mounts a fresh tmpfs on /tmp, so the script goes in /root
+    CHROOT_SCRIPT = '/root/archec2build_chroot.sh'
+    INLINE_LIMIT = 96 * 1024
+    UPLOADED_SCRIPT = '/tmp/archec2build_script'
+    UPLOADED_ARCHIVE = '/tmp/archec2build_overlay.%d.tar.gz'
+    
+    def __init__(self, description, root=MAIN_PARTITION_MOUNT_POINT):
+        self.description = description
+        self.root = root
+        self.steps = []
+        self.uploads = []
+        
+    def run(self, command, description=None):
+        "Adds a step running ``command`` on the build instance."
+        self.steps.append((description or command, command, False))
+        
+    def chroot(self, command, description=None):
+        "Adds a step running ``command`` inside the ``root`` chroot."
+        self.steps.append((description or command, command, True))
+        
+    def extract(self, overlay, root=None, description=None):
+        "Adds a step extracting the :class:`Overlay` ``overlay`` in ``root``."
+        root = root or self.root
+        path = self.UPLOADED_ARCHIVE % len(self.uploads)
+        self.uploads.append((path, overlay.archive()))
+        command = 'tar -xzpf %(path)s --same-owner --no-overwrite-dir -C %(root)s && rm -f %(path)s' % { 
+            'path' : path, 'root' : root }
+        self.run(command, description or 'Extract %d files into %s' % (len(overlay), root))
+        
+    def upload(self):
+        "Uploads the archives of the :method:`extract` steps."
+        for path, content in self.uploads:
+            put(StringIO(content), path, mode=0600)
+        
+    def render_steps(self, steps):
+        lines = []
+        for index, description, command, chrooted in steps:
+            lines.append('STEP=%d' % index)
+            lines.append('echo %s' % pipes.quote('[%d/%d] %s' % (index, len(self.steps), description)))
+            lines.append(command)
+        return lines
+        
+    def header(self):
+        return [
+            '#!/bin/bash',
+            'set -eE',
+            "trap 'echo %s$STEP; exit 1' ERR" % self.MARKER,
+        ]
+        
+    def render(self):
+        "Returns the shell script running all the steps."
+        lines = self.header()
+        numbered = [(index + 1,) + step for index, step in enumerate(self.steps)]
+        for chrooted, group in itertools.groupby(numbered, lambda step: step[3]):
+            group = list(group)
+            if not chrooted:
+                lines.extend(self.render_steps(group))
+                continue
+            inner = '\n'.join(self.header() + self.render_steps(group)) + '\n'
+            path = self.root.rstrip('/') + self.CHROOT_SCRIPT
+            lines.extend([
+                'STEP=%d' % group[0][0],
+                'echo %s | base64 -d > %s' % (base64.b64encode(inner), path),
+                'rc=0',
+                'arch-chroot %s /bin/bash %s || rc=$?' % (self.root, self.CHROOT_SCRIPT),
+                'rm -f %s' % path,
+                '[ $rc -eq 0 ] || exit $rc',
+            ])
+        return '\n'.join(lines) + '\n'
+        
+    def fail(self, index):
+        description, command, chrooted = self.steps[index - 1]
+        if len(command) > 200:
+            command = command[:200] + '...'
+        abort('%s failed at step %d (%s): %s' % (self.description, index, description, command))
+        
+    def execute(self):
+        """
+        Runs all the steps on the build instance.
+        
+        :rtype: string
+        :return: The output of the steps.
+        """
+        start = time.time()
+        self.upload()
+        if BATCH_COMMANDS:
+            script = base64.b64encode(self.render())
+            decode = 'echo %s | base64 -d > $f' % script
+            with settings(warn_only=True):
+                if len(script) > self.INLINE_LIMIT:
+                    # Too long for a command line
+                    put(StringIO(script), self.UPLOADED_SCRIPT)
+                    decode = 'base64 -d %(path)s > $f && rm -f %(path)s' % { 'path' : self.UPLOADED_SCRIPT }
+                out = run('f=$(mktemp) && %s && bash $f; rc=$?; rm -f $f; exit $rc' % decode)
+            if out.failed:
+                match = re.search(r'%s(\d+)' % self.MARKER, out)
+                if match:
+                    self.fail(int(match.group(1)))
+                abort('%s failed' % self.description)
+        else:
+            outputs = []
+            for index, (description, command, chrooted) in enumerate(self.steps):
+                if chrooted:
+                    command = 'arch-chroot %s %s' % (self.root, command)
+                with settings(warn_only=True):
+                    out = run(command)
+                if out.failed:
+                    self.fail(index + 1)
+                outputs.append(out)
+            out = '\n'.join(outputs)
+        print green('%s: %d steps in %.1fs' % (self.description, len(self.steps), time.time() - start))
+        return out
+
 @task()
 def check_install_scripts():
     """
@@ -190,11 +977,78 @@ def check_install_scripts():
     if out.succeeded:
         print yellow('mirrorlist link bug. Patching...')
         run('rm /etc/pacman.d/mirrorlist')
-        put(StringIO(MIRRORLIST), '/etc/pacman.d/mirrorlist.backup')
-        run('rankmirrors -n 3 /etc/pacman.d/mirrorlist.backup > /etc/pacman.d/mirrorlist')
+    rank_mirrors()
+    if out.succeeded:
         run('pacman -Syy')
-    install_packages('arch-install-scripts','ec2-ami-tools')
+    install_packages('arch-install-scripts','ec2-ami-tools', 'python2')
+
+@task
+def check_chroot(root=MAIN_PARTITION_MOUNT_POINT):
+    """
+    Checks that the chrooted steps of a :class:`RemoteScript` run in
+    the build partition mounted on ``root``.
+    """
+    script = RemoteScript('Chroot check', root)
+    script.chroot('echo ARCHEC2BUILD_CHROOT_$(uname -m)', 'Run a command in the chroot')
+    script.chroot('test -x /usr/bin/pacman', 'Find pacman in the chroot')
+    out = script.execute()
+    if 'ARCHEC2BUILD_CHROOT_' not in out:
+        abort('The chrooted steps did not run in %s' % root)
+    print green('Chrooted steps run in %s' % root)
         
+def mirror_servers():
+    "Returns the servers of ``MIRRORLIST``."
+    return re.findall(r'^Server\s*=\s*(\S+)', MIRRORLIST, re.M)
+
+def ranked_mirrors():
+    """
+    Returns the servers of ``MIRRORLIST`` from the best to the worst 
+    according to the scores of ``MIRROR_SCORES_FILE``, without 
+    measuring them.
+    """
+    return mirrors.ScoreCache(MIRROR_SCORES_FILE).ranked(config.EC2_REGION, mirror_servers())
+
+@task
+def rank_mirrors(force=False):
+    """
+    Writes the mirror list of the build instance, the best mirrors 
+    first.
+    
+    The mirrors are measured from the build instance with small range 
+    requests, unless their scores in ``MIRROR_SCORES_FILE`` are less 
+    than ``MIRROR_SCORE_TTL`` seconds old.
+    
+    :rtype: list
+    :return: The servers, in order.
+    """
+    cache = mirrors.ScoreCache(MIRROR_SCORES_FILE)
+    servers = mirror_servers()
+    key = config.EC2_REGION
+    if force or cache.expired(key, servers, MIRROR_SCORE_TTL):
+        arch = run('uname -m', quiet=True).strip() or pacman_arch()
+        urls = [(server, '%s/core.db' % server.replace('$repo', 'core').replace('$arch', arch)) for server in servers]
+        start = time.time()
+        with hide('output'):
+            out = run(mirrors.probe_command(urls), warn_only=True)
+        cache.update(key, mirrors.parse_probes(out))
+        cache.save()
+        print green('Measured %d mirrors in %.1fs' % (len(servers), time.time() - start))
+        for server in cache.ranked(key, servers):
+            score = cache.scores(key).get(server, {})
+            print '%8.0fKB/s %3.0f%% failures  %s' % (score.get('throughput', 0) / 1024, 
+                score.get('failure_rate', 1) * 100, server)
+    ordered = cache.ranked(key, servers)
+    put(StringIO(mirrors.mirrorlist(ordered)), '/etc/pacman.d/mirrorlist')
+    return ordered
+
+def bootstrap_pacman_conf():
+    """
+    Returns the pacman configuration used to install the packages, 
+    with the ranked mirrors instead of the mirror list include.
+    """
+    servers = mirrors.mirrorlist(ranked_mirrors()).strip()
+    return (MINIMAL_PACMAN_CONF % { 'arch' : pacman_arch() }).replace('Include = /etc/pacman.d/mirrorlist', servers)
+
 @task()
 def clean_env():
     """
@@ -202,6 +1056,231 @@ def clean_env():
     """
     remove_packages('arch-install-scripts', 'ec2-ami-tools')
     
+#
+# Wait methods
+#
+class WaitTimeout(Exception):
+    pass
+
+WAIT_LOG = []
+WAIT_LOG_LOCK = threading.Lock()
+
+def wait_until(poll, target, description, delay=1, backoff=1.5, max_delay=15, jitter=0.2, timeout=None):
+    """
+    Polls until ``poll()`` returns ``target``.
+    
+    The first poll is immediate. The interval between polls starts 
+    at ``delay`` seconds and is multiplied by ``backoff`` after each
+    poll, up to ``max_delay``, with a random ``jitter`` ratio. EC2
+    ``*.NotFound`` errors, returned while a new resource propagates,
+    count as a poll that didn't reach the target.
+    
+    The time taken is printed and recorded in ``WAIT_LOG``.
+    
+    :type poll: callable
+    :param poll: Returns the current state.
+    
+    :type target: object or callable
+    :param target: The state to wait for, or a predicate on the state.
+    
+    :type description: string
+    :param description: What is waited for, used in the reports.
+    
+    :type timeout: int
+    :param timeout: Deadline in seconds (``WAIT_TIMEOUT`` by default).
+        :class:`WaitTimeout` is raised when it expires.
+    
+    :return: The last value returned by ``poll``.
+    """
+    timeout = WAIT_TIMEOUT if timeout is None else timeout
+    reached = target if callable(target) else lambda value: value == target
+    start = time.time()
+    deadline = start + timeout
+    polls = 0
+    while True:
+        polls += 1
+        try:
+            value = poll()
+        except EC2ResponseError, e:
+            if not (e.error_code or '').endswith('.NotFound'):
+                raise
+            value = None
+        if reached(value):
+            break
+        now = time.time()
+        if now >= deadline:
+            raise WaitTimeout('%s: still %s after %ds' % (description, value, timeout))
+        time.sleep(min(delay * random.uniform(1 - jitter, 1 + jitter), deadline - now))
+        delay = min(delay * backoff, max_delay)
+    elapsed = time.time() - start
+    with WAIT_LOG_LOCK:
+        WAIT_LOG.append((description, elapsed, polls))
+    print white('%s after %.1fs (%d polls)' % (description, elapsed, polls))
+    return value
+
+class StatePoller(object):
+    """
+    Coalesces the state polls of the instances or volumes of a 
+    connection.
+    
+    Waiters register the resources they watch. A refresh describes 
+    all the watched resources with a single call filtered on their 
+    ids, and updates them in place. A thread asking for a refresh 
+    while another one describing its resources is in flight waits 
+    for that one instead of issuing its own, and results younger 
+    than ``min_interval`` seconds are reused.
+    """
+    
+    def __init__(self, connection, kind, min_interval=1):
+        self.connection = connection
+        self.kind = kind
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.in_flight = None
+        self.refreshed = 0
+        self.refreshed_ids = set()
+        
+    def watch(self, resource):
+        with self.lock:
+            self.watched.setdefault(resource.id, []).append(resource)
+            
+    def unwatch(self, resource):
+        with self.lock:
+            resources = self.watched.get(resource.id, [])
+            if resource in resources:
+                resources.remove(resource)
+            if not resources:
+                self.watched.pop(resource.id, None)
+                
+    def describe(self, ids):
+        if self.kind == 'instances':
+            reservations = self.connection.get_all_instances(filters={'instance-id' : ids})
+            return [instance for reservation in reservations for instance in reservation.instances]
+        else:
+            return self.connection.get_all_volumes(filters={'volume-id' : ids})
+    
+    def refresh(self, force=False, ids=None):
+        """
+        Refreshes every watched resource, unless the resources ``ids``
+        (every watched resource by default) were refreshed less than
+        ``min_interval`` seconds ago and ``force`` is ``False``.
+        
+        A refresh in flight is shared if it describes ``ids``. 
+        Otherwise it is waited for, and a new one is started.
+        """
+        while True:
+            with self.lock:
+                needed = set(self.watched if ids is None else ids)
+                if self.in_flight is None:
+                    if not force and needed <= self.refreshed_ids \
+                        and time.time() - self.refreshed < self.min_interval:
+                        return
+                    event, round_ids = self.in_flight = (threading.Event(), set(self.watched))
+                    break
+                event, round_ids = self.in_flight
+            event.wait()
+            if needed <= round_ids:
+                return
+        try:
+            if round_ids:
+                fetched = self.describe(list(round_ids))
+                with self.lock:
+                    for updated in fetched:
+                        for resource in self.watched.get(updated.id, []):
+                            resource._update(updated)
+                    self.refreshed = time.time()
+                    self.refreshed_ids = round_ids
+        finally:
+            with self.lock:
+                self.in_flight = None
+            event.set()
+            
+    def state(self, resource):
+        "Returns the state of the watched ``resource`` after a refresh."
+        self.refresh(ids=(resource.id,))
+        return resource.state if self.kind == 'instances' else resource.status
+
+STATE_POLLERS = {}
+
+def get_state_poller(connection, kind):
+    """
+    Returns the :class:`StatePoller` of ``connection`` for ``kind``
+    ('instances' or 'volumes').
+    """
+    with EC2_CONNECTIONS_LOCK:
+        poller = STATE_POLLERS.get((connection, kind))
+        if poller is None:
+            poller = STATE_POLLERS[(connection, kind)] = StatePoller(connection, kind)
+    return poller
+
+def poller_kind(resource):
+    if isinstance(resource, Instance):
+        return 'instances'
+    elif isinstance(resource, Volume):
+        return 'volumes'
+    return None
+
+def update_states(resources):
+    """
+    Refreshes instances or volumes with one Describe call per 
+    connection, instead of one call per resource.
+    """
+    groups = {}
+    for resource in resources:
+        groups.setdefault((resource.connection, poller_kind(resource)), []).append(resource)
+    for (connection, kind), group in groups.iteritems():
+        if kind is None:
+            for resource in group:
+                resource.update()
+            continue
+        poller = get_state_poller(connection, kind)
+        for resource in group:
+            poller.watch(resource)
+        try:
+            poller.refresh(force=True, ids=[resource.id for resource in group])
+        finally:
+            for resource in group:
+                poller.unwatch(resource)
+
+def wait_for(resource, target, **kwargs):
+    """
+    Waits for an EC2 ``resource`` (volume, snapshot, instance, image)
+    to reach the ``target`` state.
+    
+    Instances and volumes are polled through their connection's
+    :class:`StatePoller`, so that concurrent waits share their 
+    Describe calls. Other resources are polled with ``update``.
+    
+    See :method:`wait_until` for the keyword arguments.
+    """
+    description = '%s is %s' % (resource.id, target)
+    kind = poller_kind(resource)
+    if kind is None:
+        return wait_until(resource.update, target, description, **kwargs)
+    poller = get_state_poller(resource.connection, kind)
+    poller.watch(resource)
+    try:
+        return wait_until(lambda: poller.state(resource), target, description, **kwargs)
+    finally:
+        poller.unwatch(resource)
+
+def wait_for_image(connection, image_id):
+    """
+    Waits for a newly registered image to be visible and returns it.
+    """
+    def poll():
+        images = connection.get_all_images((image_id,))
+        return images[0] if images else None
+    return wait_until(poll, lambda image: image is not None, 'Image %s registered' % image_id)
+
+def wait_for_device(device_name):
+    """
+    Waits for ``device_name`` to show up on the build instance.
+    """
+    return wait_until(lambda: run('test -b %s' % device_name, quiet=True).succeeded, True, 
+        'Device %s is attached' % device_name, timeout=120)
+
 #
 # Find methods
 #    
@@ -214,40 +1293,161 @@ def find_free_device(instance):
         value = '/dev/sd%s' % letter
     return value
 
-def find_build_device(instance):
+def find_build_device(instance, name=None):
+    name = name or constants.VOLUME_NAME
     for mount_point, device in instance.block_device_mapping.iteritems():
         if not device.delete_on_termination:
             volume =  instance.connection.get_all_volumes((device.volume_id,))[0]
-            if volume.tags.has_key(VOLUME_NAME):
+            if volume.tags.has_key(name):
                 return (volume, mount_point.replace('/sd', '/xvd'))
     return (None,None)
 
-def find_snapshots(connection=create_ec2_connection, name=SNAPSHOT_NAME):
-    if callable(connection):
-        connection=connection()
-    result = connection.get_all_snapshots(filters={'tag:%s' % name : ''})
-    if not result or len(result) == 0:
-        result =  connection.get_all_snapshots(filters={'tag:Name' : name})
-    return result
+class ResourceIndex(object):
+    """
+    In memory index of the images, snapshots and instances of a
+    connection that carry a ``BASE_PREFIX`` tag.
+    
+    Each resource type is fetched with one Describe call and every
+    lookup by name is then answered from memory until the entry is
+    older than ``RESOURCE_CACHE_TTL`` seconds. The mutation helpers
+    (:method:`add_name`, :method:`remove_tag`, :method:`deregister`,
+    :method:`delete`, :method:`terminate`) keep it up to date.
+    """
+    
+    KINDS = {
+        Image : 'images',
+        Snapshot : 'snapshots',
+        Instance : 'instances',
+    }
+    
+    def __init__(self, connection, prefix=BASE_PREFIX, ttl=None):
+        self.connection = connection
+        self.prefix = prefix
+        self.ttl = RESOURCE_CACHE_TTL if ttl is None else ttl
+        self.lock = threading.RLock()
+        self.resources = {}
+        
+    def kind_of(self, obj):
+        for cls, kind in self.KINDS.iteritems():
+            if isinstance(obj, cls):
+                return kind
+        return None
+        
+    def covers(self, name):
+        "Returns ``True`` if resources named ``name`` are indexed."
+        return name.startswith('%s.' % self.prefix)
+    
+    def fetch(self, kind):
+        filters = {'tag-key' : '%s.*' % self.prefix}
+        if kind == 'images':
+            return self.connection.get_all_images(filters=filters)
+        elif kind == 'snapshots':
+            return self.connection.get_all_snapshots(filters=filters)
+        else:
+            reservations = self.connection.get_all_instances(filters=filters)
+            return [instance for reservation in reservations for instance in reservation.instances]
+        
+    def get(self, kind):
+        """
+        Returns all the indexed resources of ``kind`` ('images', 
+        'snapshots' or 'instances'), fetching them if needed.
+        """
+        with self.lock:
+            fetched, items = self.resources.get(kind, (None, None))
+            if fetched is None or time.time() - fetched > self.ttl:
+                items = list(self.fetch(kind))
+                self.resources[kind] = (time.time(), items)
+            return list(items)
+        
+    def find(self, kind, name):
+        """
+        Returns the resources of ``kind`` tagged with ``name``, or 
+        if there is none, the resources whose ``Name`` tag is ``name``.
+        """
+        items = self.get(kind)
+        result = [item for item in items if item.tags.has_key(name)]
+        if not result:
+            result = [item for item in items if item.tags.get('Name') == name]
+        return result
+        
+    def invalidate(self, kind=None):
+        with self.lock:
+            if kind is None:
+                self.resources.clear()
+            else:
+                self.resources.pop(kind, None)
+        
+    def update(self, obj):
+        "Writes ``obj`` through to the index."
+        kind = self.kind_of(obj)
+        with self.lock:
+            if not self.resources.has_key(kind):
+                return
+            items = [item for item in self.resources[kind][1] if item.id != obj.id]
+            if [key for key in obj.tags if self.covers(key)]:
+                items.append(obj)
+            self.resources[kind] = (self.resources[kind][0], items)
+            
+    def discard(self, obj):
+        "Removes ``obj`` from the index."
+        kind = self.kind_of(obj)
+        with self.lock:
+            if self.resources.has_key(kind):
+                items = [item for item in self.resources[kind][1] if item.id != obj.id]
+                self.resources[kind] = (self.resources[kind][0], items)
+
+RESOURCE_INDEXES = {}
 
-def find_images(connection=create_ec2_connection, name=IMAGE_NAME):
+def get_resource_index(connection=create_ec2_connection):
+    """
+    Returns the :class:`ResourceIndex` of ``connection``.
+    """
     if callable(connection):
-        connection=connection()
-    result = connection.get_all_images(filters={'tag:%s' % name : ''})
+        connection = connection()
+    with EC2_CONNECTIONS_LOCK:
+        index = RESOURCE_INDEXES.get(connection)
+        if index is None:
+            index = RESOURCE_INDEXES[connection] = ResourceIndex(connection)
+    return index
+
+def describe_resources(connection, kind, name):
+    """
+    Looks up the resources of ``kind`` named ``name`` with 
+    Describe calls, for names the resource index doesn't cover.
+    """
+    method = getattr(connection, 'get_all_%s' % kind)
+    result = method(filters={'tag:%s' % name : ''})
     if not result or len(result) == 0:
-        result =  connection.get_all_images(filters={'tag:Name' : name})
+        result = method(filters={'tag:Name' : name})
+    if kind == 'instances':
+        result = [res.instances[0] for res in result]
     return result
 
-def find_instances(connection=create_ec2_connection, name=INSTANCE_NAME):
+def find_resources(connection, kind, name):
     if callable(connection):
-        connection=connection()
-    result = connection.get_all_instances(filters={'tag:%s' % name : ''})
-    if not result or len(result) == 0:
-        result =  connection.get_all_instances(filters={'tag:Name' : name})
-    return [res.instances[0] for res in result]
+        connection = connection()
+    index = get_resource_index(connection)
+    if index.covers(name):
+        return index.find(kind, name)
+    return describe_resources(connection, kind, name)
+
+def find_snapshots(connection=create_ec2_connection, name=None):
+    name = name or constants.SNAPSHOT_NAME
+    return find_resources(connection, 'snapshots', name)
+
+def find_images(connection=create_ec2_connection, name=None):
+    name = name or constants.IMAGE_NAME
+    return find_resources(connection, 'images', name)
+
+def find_instances(connection=create_ec2_connection, name=None):
+    name = name or constants.INSTANCE_NAME
+    return find_resources(connection, 'instances', name)
 
-def find_running_instances(connection=create_ec2_connection, name=BASE_INSTANCE_NAME):
-    return filter(lambda x : x.update() == 'running', find_instances(connection,name))
+def find_running_instances(connection=create_ec2_connection, name=None):
+    name = name or constants.BASE_INSTANCE_NAME
+    instances = find_instances(connection,name)
+    update_states(instances)
+    return filter(lambda x : x.state == 'running', instances)
     
 def get_build_instance(connection=create_ec2_connection):
     """
@@ -258,66 +1458,114 @@ def get_build_instance(connection=create_ec2_connection):
     The method will take the first running instance tagged with
     ``BASE_INSTANCE_NAME`` as the running instance.
     """
-    global EC2_BUILD_INSTANCE,env    
-    if EC2_BUILD_INSTANCE == 'Unknown':
-        if callable(connection):
-            connection = connection()        
-        running_instances = find_running_instances(connection)
-        if running_instances and len(running_instances) > 0:
-            build_instance = running_instances[0]
-            EC2_BUILD_INSTANCE = build_instance.id
-            env.hosts = [ build_instance.dns_name ]
-    return EC2_BUILD_INSTANCE
-
-def delete_snapshots(name=SNAPSHOT_NAME):
-    for snapshot in find_snapshots(name=name):
-        print green('Deleting snapshot with id %s' % snapshot.id)
-        snapshot.delete()
+    return constants.build_instance_id(connection)
+
+def delete_snapshots(name=None):
+    name = name or constants.SNAPSHOT_NAME
+    check_garbage_failures(collect_garbage([('snapshots', snapshot) for snapshot in find_snapshots(name=name)], 
+        retention=False))
         
 def add_name(obj, name):
     obj.add_tag(name, '')
     obj.add_tag('Name', name)
+    get_resource_index(obj.connection).update(obj)
+    
+def remove_tag(obj, name):
+    obj.remove_tag(name)
+    get_resource_index(obj.connection).update(obj)
+    
+def deregister(image):
+    image.deregister()
+    get_resource_index(image.connection).discard(image)
+    
+def delete(obj):
+    obj.delete()
+    get_resource_index(obj.connection).discard(obj)
+    
+def terminate(instance):
+    instance.terminate()
+    get_resource_index(instance.connection).discard(instance)
     
 
 @task
 def delete_build_snapshots():
     "Deletes the snapshots taken after the build."
-    delete_snapshots(name=SNAPSHOT_NAME)
+    delete_snapshots(name=constants.SNAPSHOT_NAME)
 
 @task
 def delete_image_snapshots():
     "Deletes the snapshot from which the image is derived."
-    delete_snapshots(name=IMAGE_NAME)
-
-USE_SNAPSHOT = getattr(config, 'USE_SNAPSHOT', False)
-SNAPSHOT_ID = getattr(config, 'SNAPSHOT_ID', find_snapshots()[0] if USE_SNAPSHOT else None)
+    delete_snapshots(name=constants.IMAGE_NAME)
 
 @task
-def create_and_attach_volume():
+def create_and_attach_volume(snapshot_id=None):
     """
     Creates the build volume an attaches it to the build instance.
     
     If a snapshot id is specified or USE_SNAPSHOT is True, 
     instead of building a new volume,it creates the volume 
     from the snapshot.
+    
+    :type snapshot_id: string
+    :param snapshot_id: The snapshot to create the volume from
+        (``SNAPSHOT_ID`` by default).
     """
+    snapshot_id = snapshot_id or constants.SNAPSHOT_ID
     connection = create_ec2_connection()
     instance = get_instance(connection)
-    print green('Attach volume using snapshot %s' % SNAPSHOT_ID)
-    vol = connection.create_volume(VOLUME_SIZE, instance.placement, snapshot=SNAPSHOT_ID)
-    add_name(vol, SNAPSHOT_NAME)
+    size = build_volume_size(connection, snapshot_id)
+    print green('Attach %dGB volume using snapshot %s' % (size, snapshot_id))
+    vol = connection.create_volume(size, instance.placement, snapshot=snapshot_id)
+    add_name(vol, constants.SNAPSHOT_NAME)
     mount_point = find_free_device(instance)
     vol.attach(instance.id, mount_point)
-    status = vol.update()
-    while status != 'in-use':
-        time.sleep(5)
-        status = vol.update()
+    wait_for(vol, 'in-use')
     return (vol, mount_point)
 
+def build_volume_size(connection, snapshot_id=None):
+    """
+    Returns the size in GB of the build volume.
+    
+    If ``AUTO_VOLUME_SIZE`` is True, the size is the installed size 
+    of the resolved packages (plus their download size when they are 
+    cached on the volume) times ``VOLUME_HEADROOM``, and at least the 
+    size of ``snapshot_id``. Otherwise it is ``VOLUME_SIZE``.
+    """
+    if not AUTO_VOLUME_SIZE:
+        return VOLUME_SIZE
+    footprint = constants.MANIFEST.installed_size
+    if not USE_PACKAGE_CACHE:
+        footprint += constants.MANIFEST.download_size
+    size = int(math.ceil(footprint * VOLUME_HEADROOM / 1024.0 ** 3))
+    if snapshot_id:
+        size = max(size, connection.get_all_snapshots((snapshot_id,))[0].volume_size)
+    return max(size, 1)
+
+def footprint_step(script, root):
+    "Adds to ``script`` the step measuring the space used on ``root``."
+    script.run("df -P -B1 %s | awk 'NR == 2 { print \"%s\", $3, $2 }'" % (root, FOOTPRINT_MARKER), 
+        'Measure the footprint')
+
+def report_footprint(out):
+    """
+    Prints the space used on the build volume found in ``out``, 
+    next to the installed size predicted from the packages.
+    """
+    match = re.search(r'%s (\d+) (\d+)' % FOOTPRINT_MARKER, out)
+    if not match:
+        return
+    used, total = [int(value) for value in match.groups()]
+    if AUTO_VOLUME_SIZE or CHECK_PACKAGE_VERSIONS:
+        predicted = constants.MANIFEST.installed_size
+        print green('Footprint: %s used of %s, %s predicted (%+.0f%%)' % (format_size(used), format_size(total), 
+            format_size(predicted), (used - predicted) * 100.0 / max(predicted, 1)))
+    else:
+        print green('Footprint: %s used of %s' % (format_size(used), format_size(total)))
+
+FOOTPRINT_MARKER = 'ARCHEC2BUILD_FOOTPRINT'
+
 def get_volume():
-    instance = get_instance()
-    volume, device_name = find_build_device(instance)
-    return (instance, volume, device_name)
+    return constants.volume()
     
 @task
 def decomission_volume():
@@ -332,10 +1580,7 @@ def decomission_volume():
     else:
         print green("Detaching volume at device %s" % mount_point)
         volume.detach()
-        status = volume.update()
-        while status != 'available':
-            time.sleep(5)
-            status = volume.update()
+        wait_for(volume, 'available')
         print green("Deleting volume %s" % volume.id)
         volume.delete()        
     
@@ -346,13 +1591,21 @@ def format_volume_partitions():
     instance, volume, device_name = get_volume()
     run("mkfs.ext4 -L ac2root %s" % device_name)
 
+def mount_command(device_name, mount_point):
+    """
+    Returns the command mounting ``device_name`` on ``mount_point``,
+    unless it is mounted already (by a build step that failed before
+    unmounting it).
+    """
+    return 'mkdir -p %(mount_point)s && (mountpoint -q %(mount_point)s || mount %(device_name)s %(mount_point)s)' % {
+        'device_name' : device_name, 'mount_point' : mount_point }
+
 def mount_main_partition(device_name):
     """
     Mounts the main build volume partition in the directory
     specified by ``MAIN_PARTITION_MOUNT_POINT``.
     """
-    run('mkdir -p %s' % MAIN_PARTITION_MOUNT_POINT)
-    run('mount %s %s' % (device_name, MAIN_PARTITION_MOUNT_POINT))
+    run(mount_command(device_name, MAIN_PARTITION_MOUNT_POINT))
     
 @task               
 def unmount_main_partition():
@@ -363,7 +1616,7 @@ def unmount_main_partition():
     run('umount %s' % MAIN_PARTITION_MOUNT_POINT)
     run('rm -rf %s' % MAIN_PARTITION_MOUNT_POINT)
 
-def create_snapshot(name=SNAPSHOT_NAME):
+def create_snapshot(name=None):
     """
     Creates a snapshot of the build volume.
     
@@ -375,57 +1628,440 @@ def create_snapshot(name=SNAPSHOT_NAME):
     :rtype: class:`boto.ec2.snapshot` or ``None``.
     :return: The snapshot created.
     """
+    name = name or constants.SNAPSHOT_NAME
+    snapshot = start_snapshot(name)
+    if snapshot:
+        return complete_snapshot(snapshot, name)
+    return None
+
+def start_snapshot(name):
+    """
+    Starts a snapshot of the build volume, without waiting for 
+    it to be completed. The volume can be modified as soon as 
+    the method returns.
+    
+    :rtype: class:`boto.ec2.snapshot` or ``None``.
+    :return: The snapshot started.
+    """
     instance, volume, device_name = get_volume()
     snapshot = volume.connection.create_snapshot(volume.id, name)
     if snapshot:    
         print green('Snapshot %s created with name %s' % (snapshot.id, name))
-        status = snapshot.update()
-        while status != '100%':
-            time.sleep(3)
-            status = snapshot.update()
-        add_name(snapshot, name)
-        return snapshot
     else:
         print red('Snapshot not created')
-        return None
+    return snapshot
+
+def complete_snapshot(snapshot, name):
+    """
+    Waits for ``snapshot`` to be completed and names it ``name``.
+    """
+    wait_for(snapshot, '100%', delay=3, max_delay=30)
+    add_name(snapshot, name)
+    return snapshot
                 
 @task
 def create_volume_snapshot():
     "Creates a snapshot of the build volume"
     create_snapshot()
     
-def get_packages(filename=PACKAGES_FILENAME):
+def get_package_list(filename=PACKAGES_FILENAME):
     """
-    Returns the packages contained in ``filename`` as a space 
-    delimited string.
+    Returns the packages contained in ``filename``.
     
-    Every line starting by # is skipped. 
+    Blank lines and lines starting by # are skipped. On i386, 
+    the ``linux`` kernel is replaced by ``linux-ec2``.
     
     :type filename: string
     :param filename: The name of the file containing the packages 
         to be installed.
     """
-    value = ' '.join(filter(lambda line: not line.startswith('#'), [line[:-1] for line in open(filename)]))
-    if ARCH == 'i386':
-        value = value.replace(" linux", " linux-ec2")
-    return value
+    packages = manifest.read_packages(filename)
+    if constants.ARCH == 'i386':
+        packages = ['linux-ec2' if package == 'linux' else package for package in packages]
+    return packages
+
+def get_packages(filename=PACKAGES_FILENAME):
+    """
+    Returns the packages contained in ``filename`` as a space 
+    delimited string.
+    """
+    return ' '.join(get_package_list(filename))
+
+def pacman_repositories():
+    "Returns the repositories of the build pacman configuration, in order."
+    return [name for name in re.findall(r'^\[(\S+)\]', MINIMAL_PACMAN_CONF, re.M) if name != 'options']
+
+def resolve_manifest(dbpath):
+    """
+    Resolves the packages and their dependencies against the sync
+    databases (``<repository>.db``) found in ``dbpath``.
+    
+    :rtype: :class:`manifest.Manifest`
+    """
+    filenames = [os.path.join(dbpath, '%s.db' % name) for name in pacman_repositories()]
+    filenames = [filename for filename in filenames if os.path.exists(filename)]
+    if not filenames:
+        abort('No sync database in %s' % dbpath)
+    try:
+        return manifest.Database.load(filenames).resolve(get_package_list())
+    except manifest.UnresolvedError, e:
+        abort('Unresolved packages: %s' % e)
+
+@task
+@hosts('localhost')
+def resolve_packages(dbpath='.'):
+    """
+    Prints the packages to install, with their dependencies, 
+    versions and sizes, from the sync databases in ``dbpath``.
+    """
+    for line in resolve_manifest(dbpath).lines():
+        print line
+
+def repository_servers(arch=None):
+    """
+    Returns the servers of each repository of the build pacman 
+    configuration, the ranked mirrors of ``MIRRORLIST`` standing 
+    for the included mirror list.
+    
+    :rtype: :class:`collections.OrderedDict`
+    """
+    arch = pacman_arch(arch)
+    ranked = ranked_mirrors()
+    servers = collections.OrderedDict()
+    repository = None
+    for line in MINIMAL_PACMAN_CONF.splitlines():
+        match = re.match(r'^\[(\S+)\]$', line)
+        if match:
+            repository = match.group(1)
+        elif repository and repository != 'options' and '=' in line:
+            key, value = [part.strip() for part in line.split('=', 1)]
+            urls = ranked if key == 'Include' else [value] if key == 'Server' else []
+            servers.setdefault(repository, []).extend(
+                url.replace('$repo', repository).replace('$arch', arch).rstrip('/') for url in urls)
+    return servers
+
+def fetch_sync_databases(arch=None, path=None):
+    """
+    Downloads the sync databases of the build repositories, and
+    nothing else, into ``path`` (a directory of ``SYNC_DB_DIR``
+    by default).
+    
+    :rtype: string
+    :return: The directory containing the ``<repository>.db`` files.
+    """
+    path = path or os.path.join(SYNC_DB_DIR, pacman_arch(arch))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for repository, urls in repository_servers(arch).iteritems():
+        filename = os.path.join(path, '%s.db' % repository)
+        for url in urls:
+            url = '%s/%s.db' % (url, repository)
+            try:
+                response = urllib2.urlopen(url, timeout=60)
+                with open(filename + '.tmp', 'wb') as f:
+                    f.write(response.read())
+                os.rename(filename + '.tmp', filename)
+                break
+            except (urllib2.URLError, IOError), e:
+                print yellow('Could not download %s: %s' % (url, e))
+        else:
+            abort('Could not download the %s database' % repository)
+    return path
+
+def format_size(value):
+    "Returns ``value`` bytes in a human readable form."
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return '%d%s' % (value, unit)
+        value /= 1024.0
+    return '%.1fGB' % value
+
+def attach_package_cache(connection=create_ec2_connection):
+    """
+    Attaches the package cache volume of the current architecture 
+    to the build instance.
+    
+    The cache is an EBS volume named ``PACKAGE_CACHE_NAME`` kept 
+    across builds, one per architecture and availability zone. It
+    is created empty the first time. A cache used by another build
+    is left alone.
+    
+    :rtype: tuple
+    :return: The volume, its device name on the build instance and 
+        whether it was just created, or ``None`` if the cache is busy.
+    """
+    if callable(connection):
+        connection = connection()
+    instance = get_instance(connection)
+    name = constants.PACKAGE_CACHE_NAME
+    volumes = [volume for volume in describe_resources(connection, 'volumes', name) 
+        if volume.zone == instance.placement]
+    available = [volume for volume in volumes if volume.status == 'available']
+    created = False
+    if available:
+        volume = available[0]
+    elif volumes:
+        print yellow('Package cache %s is in use, downloading every package' % name)
+        return None
+    else:
+        print green('Creating package cache %s in %s' % (name, instance.placement))
+        volume = connection.create_volume(PACKAGE_CACHE_SIZE, instance.placement)
+        add_name(volume, name)
+        wait_for(volume, 'available')
+        created = True
+    mount_point = find_free_device(instance)
+    volume.attach(instance.id, mount_point)
+    wait_for(volume, 'in-use')
+    device_name = mount_point.replace('/sd', '/xvd')
+    wait_for_device(device_name)
+    return (volume, device_name, created)
+
+def list_package_cache(script, cachedir):
+    "Adds to ``script`` the step listing the packages present in the cache before the install."
+    script.run('ls %s > %s' % (cachedir, PACKAGE_CACHE_LISTING), 'List the cached packages')
+
+def package_cache_steps(script, root, cachedir):
+    """
+    Adds to ``script`` the steps run on ``cachedir`` once the 
+    packages are installed.
+    
+    The packages already present in the cache count as hits and the 
+    downloaded ones as misses. The cache then keeps only the latest 
+    version of each package and is trimmed down to 
+    ``PACKAGE_CACHE_MAX_BYTES``, least recently used packages first.
+    """
+    listing = PACKAGE_CACHE_LISTING
+    script.run("""(
+cd %(cachedir)s
+hits=0; hit=0; misses=0; miss=0
+for package in $(pacman -r %(root)s -Q | tr ' ' '-'); do
+  for f in $package-*.pkg.tar.*; do
+    case "$f" in *.sig) continue;; esac
+    [ -f "$f" ] || continue
+    size=$(stat -c %%s "$f")
+    if grep -qxF "$f" %(listing)s; then hits=$((hits+1)); hit=$((hit+size)); else misses=$((misses+1)); miss=$((miss+size)); fi
+  done
+done
+echo "%(marker)s $hits $hit $misses $miss"
+rm -f %(listing)s
+)""" % { 'cachedir' : cachedir, 'root' : root, 'listing' : listing, 'marker' : PACKAGE_CACHE_MARKER }, 
+        'Count the package cache hits')
+    script.run("""if command -v paccache > /dev/null; then paccache -q -r -k 1 -c %(cachedir)s; fi
+total=$(find %(cachedir)s -type f -printf '%%s\\n' | awk '{ total += $1 } END { print total + 0 }')
+if [ $total -gt %(limit)d ]; then
+  find %(cachedir)s -type f -printf '%%A@ %%s %%p\\n' | sort -n | while read atime size path; do
+    [ $total -gt %(limit)d ] || break
+    rm -f "$path"; total=$((total-size))
+  done
+fi""" % { 'cachedir' : cachedir, 'limit' : PACKAGE_CACHE_MAX_BYTES }, 'Evict the stale packages from the cache')
+
+def report_package_cache(out):
+    "Prints the package cache hits and misses found in ``out``."
+    match = re.search(r'%s (\d+) (\d+) (\d+) (\d+)' % PACKAGE_CACHE_MARKER, out)
+    if not match:
+        return
+    hits, hit, misses, miss = [int(value) for value in match.groups()]
+    print green('Package cache: %d hits (%s), %d misses (%s downloaded)' % (
+        hits, format_size(hit), misses, format_size(miss)))
+
+def prefetch_steps(script, root, cachedir, packages):
+    """
+    Adds to ``script`` the steps downloading the packages into 
+    ``cachedir`` with the :mod:`prefetch` module, ahead of pacstrap.
+    
+    The package databases are synchronized in the build volume and
+    pacman resolves the package files, which are then downloaded 
+    concurrently from the mirrors. The packages that could not be 
+    prefetched are downloaded by pacstrap.
+    """
+    values = {
+        'conf' : PACMAN_CONF_FILENAME,
+        'root' : root,
+        'dbpath' : '%s/var/lib/pacman' % root,
+        'cachedir' : cachedir,
+        'packages' : packages,
+        'prefetch' : PREFETCH_FILENAME,
+        'arch' : pacman_arch(),
+        'connections' : PREFETCH_CONNECTIONS,
+    }
+    script.run('mkdir -p %(dbpath)s %(cachedir)s && pacman --config %(conf)s -r %(root)s -Sy' % values, 
+        'Synchronize the package databases')
+    script.run("pacman --config %(conf)s -r %(root)s -Sp --noconfirm --print-format '%%r %%f' %(packages)s"
+        " | python2 %(prefetch)s --config %(conf)s --dbpath %(dbpath)s --cachedir %(cachedir)s"
+        " --arch %(arch)s --connections %(connections)d"
+        " || echo 'prefetch: incomplete, pacstrap downloads the missing packages'" % values, 
+        'Prefetch the packages')
+
+def report_prefetch(out):
+    "Prints the prefetch report found in ``out``."
+    for line in out.splitlines():
+        if line.startswith('prefetch: '):
+            print green('Prefetch: %s' % line[len('prefetch: '):])
+
+@task
+@hosts('localhost')
+def check_prefetch(packages=8, connections=2):
+    """
+    Checks the package prefetch of :method:`bootstrap_archlinux` 
+    against two local mirrors serving a fixture repository of 
+    ``packages`` packages and a corrupt one.
+    
+    The good packages must reach the cache, the corrupt one must be
+    rejected by its checksum on both mirrors, and no mirror may 
+    serve more than ``connections`` downloads at a time.
+    """
+    packages, connections = int(packages), int(connections)
+    directory = tempfile.mkdtemp(prefix='archec2build_prefetch.')
+    dbpath = os.path.join(directory, 'db')
+    cachedir = os.path.join(directory, 'cache')
+    os.makedirs(os.path.join(dbpath, 'sync'))
+    good = dict(('pkg%d-1.0-1-x86_64.pkg.tar.xz' % index, os.urandom(64 * 1024)) for index in range(packages))
+    corrupt = 'corrupt-1.0-1-x86_64.pkg.tar.xz'
+    expected = dict(good, **{ corrupt : os.urandom(64 * 1024) })
+    
+    db = tarfile.open(os.path.join(dbpath, 'sync', 'core.db'), 'w:gz')
+    for name, data in sorted(expected.items()):
+        desc = '%%FILENAME%%\n%s\n\n%%CSIZE%%\n%d\n\n%%SHA256SUM%%\n%s\n' % (name, len(data), 
+            hashlib.sha256(data).hexdigest())
+        info = tarfile.TarInfo('%s/desc' % name[:-len('-x86_64.pkg.tar.xz')])
+        info.size = len(desc)
+        db.addfile(info, StringIO(desc))
+    db.close()
+    # same size, other content
+    served = dict(('/core/os/x86_64/%s' % name, data) for name, data in good.items())
+    served['/core/os/x86_64/%s' % corrupt] = os.urandom(64 * 1024)
+    
+    try:
+        with prefetch.StandIn(served, 0.1) as first, prefetch.StandIn(served, 0.1) as second:
+            with open(os.path.join(directory, 'pacman.conf'), 'w') as f:
+                f.write('[options]\nArchitecture = x86_64\n\n[core]\n' + ''.join(
+                    'Server = %s/$repo/os/$arch\n' % mirror.url for mirror in (first, second)))
+            with open(os.path.join(directory, 'prefetch.py'), 'w') as f:
+                f.write(inspect.getsource(prefetch))
+            with settings(warn_only=True), hide('everything'):
+                out = local('printf "%(lines)s" | %(python)s %(directory)s/prefetch.py --config %(directory)s/pacman.conf'
+                    ' --dbpath %(dbpath)s --cachedir %(cachedir)s --connections %(connections)d --timeout 10 2>&1' % {
+                    'lines' : ''.join('core %s\\n' % name for name in sorted(expected)),
+                    'python' : sys.executable, 'directory' : directory, 'dbpath' : dbpath, 
+                    'cachedir' : cachedir, 'connections' : connections }, capture=True)
+        report_prefetch(out)
+        peaks = [mirror.peak for mirror in (first, second)]
+        print green('Peak concurrent downloads per mirror: %s' % ', '.join(str(peak) for peak in peaks))
+        cached = os.listdir(cachedir)
+        if not out.failed:
+            abort('The prefetch succeeded despite the corrupt package')
+        if corrupt in cached:
+            abort('The corrupt package was accepted')
+        missing = [name for name, data in good.items() if name not in cached 
+            or open(os.path.join(cachedir, name), 'rb').read() != data]
+        if missing:
+            abort('Packages missing from the cache: %s' % ', '.join(sorted(missing)))
+        if set(cached) != set(good):
+            abort('Unexpected files in the cache: %s' % ', '.join(sorted(set(cached) - set(good))))
+        if max(peaks) > connections:
+            abort('More than %d concurrent downloads from a mirror' % connections)
+    finally:
+        shutil.rmtree(directory)
+    print green('Prefetched %d packages, rejected the corrupt one' % len(good))
+
+PACMAN_CONF_FILENAME = '/tmp/archec2build_pacman.conf'
+PREFETCH_FILENAME = '/tmp/archec2build_prefetch.py'
+PACKAGE_CACHE_LISTING = '/tmp/archec2build_cache_listing'
+PACKAGE_CACHE_MARKER = 'ARCHEC2BUILD_PACKAGE_CACHE'
 
 @task 
 def bootstrap_archlinux():
     "Installs the base packages on the build volume."
     instance, volume, device_name = get_volume()
-    mount_main_partition(device_name)
-    arch = run('uname -m', quiet=True)    
-    pacman_filename = '/tmp/archec2build_pacman.conf'
-    put(StringIO(MINIMAL_PACMAN_CONF % { 'arch' : arch}), pacman_filename )
-    with hide('output'):
-        if USE_SNAPSHOT:
-            run('arch-chroot %s pacman -Syu --noconfirm' % MAIN_PARTITION_MOUNT_POINT)
-        else:    
-            run('pacstrap -C %s %s %s' % (pacman_filename, MAIN_PARTITION_MOUNT_POINT, get_packages()))
-    unmount_main_partition()
-    run('rm -rf %s' % pacman_filename)    
+    root = MAIN_PARTITION_MOUNT_POINT
+    script = RemoteScript('bootstrap_archlinux', root)
+    script.run(mount_command(device_name, root), 'Mount the build volume')
+    cache = None
+    if USE_SNAPSHOT:
+        script.chroot('pacman -Syu --noconfirm', 'Upgrade the build snapshot packages')
+    else:
+        pacman_conf = bootstrap_pacman_conf()
+        if USE_PACKAGE_CACHE:
+            cache = attach_package_cache(instance.connection)
+        if cache:
+            cachedir = PACKAGE_CACHE_MOUNT_POINT
+            cache_volume, cache_device, created = cache
+            if created:
+                script.run('mkfs.ext4 -q %s' % cache_device, 'Format the package cache')
+            script.run(mount_command(cache_device, cachedir), 'Mount the package cache')
+            pacman_conf = pacman_conf.replace('[options]\n', '[options]\nCacheDir = %s/\n' % cachedir, 1)
+        else:
+            cachedir = '%s/var/cache/pacman/pkg' % root
+        packages = get_packages()
+        overlay = Overlay()
+        overlay.add(PACMAN_CONF_FILENAME, pacman_conf)
+        if PREFETCH_PACKAGES:
+            overlay.add(PREFETCH_FILENAME, inspect.getsource(prefetch))
+        script.extract(overlay, '/', 'Write the build pacman configuration')
+        if cache:
+            list_package_cache(script, cachedir)
+        if PREFETCH_PACKAGES:
+            prefetch_steps(script, root, cachedir, packages)
+        script.run('pacstrap %s-C %s %s %s' % ('-c ' if cache else '', PACMAN_CONF_FILENAME, root, packages), 
+            'Install the packages')
+        if cache:
+            package_cache_steps(script, root, cachedir)
+            script.run('umount %s && rm -rf %s' % (cachedir, cachedir), 'Unmount the package cache')
+        script.run('rm -rf %s %s' % (PACMAN_CONF_FILENAME, PREFETCH_FILENAME))
+        footprint_step(script, root)
+    script.run('umount %s && rm -rf %s' % (root, root), 'Unmount the build volume')
+    try:
+        with hide('output'):
+            out = script.execute()
+    finally:
+        if cache:
+            # Kept for the next builds, once unmounted by the script 
+            # or here if it failed
+            with settings(warn_only=True), hide('everything'):
+                run('umount %s' % PACKAGE_CACHE_MOUNT_POINT)
+            cache[0].detach()
+            wait_for(cache[0], 'available')
+    report_prefetch(out)
+    report_footprint(out)
+    if cache:
+        report_package_cache(out)
+    
+def configure_overlay():
+    """
+    Renders the configuration files of the build volume.
+    
+    :rtype: :class:`Overlay`
+    :return: The files to install, with the content of ``OVERLAY_DIR`` 
+        if it is configured.
+    """
+    overlay = Overlay()
+    
+    # locales to generate
+    lang_string = "en_US.UTF-8 UTF-8\n"
+    if LANG != 'en_US.UTF-8':
+        lang_string = '\n'.join([ '%s UTF-8' % LANG, lang_string])
+    overlay.add('/etc/locale.gen', lang_string)
+    
+    # menu.lst
+    gru_menu = GRUB_MENU_LST %  { 'ext' : '-ec2' if constants.ARCH  == 'i386' else '' }
+    overlay.add('/boot/grub/menu.lst', gru_menu)
     
+    # sudo configuration
+    overlay.add('/etc/sudoers.d/wheel', "%wheel ALL=(ALL) NOPASSWD: ALL", mode=0440)
+    
+    # fstab
+    overlay.add('/etc/fstab', FSTAB_TEMPLATE)
+    
+    # nameserver
+    overlay.add('/etc/resolv.conf', "nameserver 172.16.0.23\n")
+    
+    # pacman.conf
+    overlay.add('/etc/pacman.conf', MINIMAL_PACMAN_CONF % { 'arch' : pacman_arch() })
+    
+    if OVERLAY_DIR:
+        overlay.add_directory(OVERLAY_DIR)
+    return overlay
+
 @task
 def configure_archlinux():
     """
@@ -440,74 +2076,127 @@ def configure_archlinux():
     - Add the wheel group to the sudoers.
     - Generate the fstab.
     - Install the default pacman.conf.    
+    - Install the files of ``OVERLAY_DIR``.
+    
+    All the steps are run as a single remote script (see
+    :class:`RemoteScript`) and the files are installed from
+    a single archive (see :class:`Overlay`).
     """
     instance, volume, device_name = get_volume()
+    root = MAIN_PARTITION_MOUNT_POINT
+    script = RemoteScript('configure_archlinux', root)
 
-    mount_main_partition(device_name)
+    script.run(mount_command(device_name, root), 'Mount the build volume')
     
     # hostname
-    run('echo %s > %s/etc/hostname' % (HOSTNAME, MAIN_PARTITION_MOUNT_POINT))
-    # timezone
-    run('arch-chroot %s ln -s /usr/share/zoneinfo/%s /etc/localtime' % ( MAIN_PARTITION_MOUNT_POINT, TIMEZONE))
+    script.run('echo %s > %s/etc/hostname' % (HOSTNAME, root), 'Set hostname')
     # lang & keymap
-    run('echo "LANG=%s" > %s/etc/locale.conf' % (LANG, MAIN_PARTITION_MOUNT_POINT))
-    run('echo "KEYMAP=%s" > %s/etc/vconsole.conf' % (KEYMAP, MAIN_PARTITION_MOUNT_POINT))
+    script.run('echo "LANG=%s" > %s/etc/locale.conf' % (LANG, root), 'Set language')
+    script.run('echo "KEYMAP=%s" > %s/etc/vconsole.conf' % (KEYMAP, root), 'Set keymap')
     
-    # generate locale
-    locale_gen_filename = '%s/etc/locale.gen' % MAIN_PARTITION_MOUNT_POINT
-    run('mv %(path)s %(path)s.orig' % { 'path' : locale_gen_filename })
-    lang_string = "en_US.UTF-8 UTF-8\n"
-    if LANG != 'en_US.UTF-8':
-        lang_string = '\n'.join([ '%s UTF-8' % LANG, lang_string])
-   
-    put(StringIO(lang_string), locale_gen_filename)
-    run('arch-chroot %s locale-gen' % MAIN_PARTITION_MOUNT_POINT)
-    run('arch-chroot %s systemctl enable sshd.service' % MAIN_PARTITION_MOUNT_POINT)
-    run('arch-chroot %s systemctl enable cronie.service' % MAIN_PARTITION_MOUNT_POINT)
-    run('arch-chroot %s systemctl enable dhcpcd\\@eth0.service' % MAIN_PARTITION_MOUNT_POINT)
-    run('arch-chroot %s systemctl enable ec2.service' % MAIN_PARTITION_MOUNT_POINT)
-    run('arch-chroot %s hwclock --systohc --utc' % MAIN_PARTITION_MOUNT_POINT)
+    # keep the original files replaced by the overlay
+    for path in ('etc/locale.gen', 'etc/fstab', 'etc/resolv.conf'):
+        script.run('mv %(path)s %(path)s.orig' % { 'path' : '%s/%s' % (root, path) })
     
-    # menu.lst
-    run('mkdir -p %s/boot/grub' % MAIN_PARTITION_MOUNT_POINT)
-    gru_menu = GRUB_MENU_LST %  { 'ext' : '-ec2' if ARCH  == 'i386' else '' }
-    put(StringIO(gru_menu), '%s/boot/grub/menu.lst' % MAIN_PARTITION_MOUNT_POINT)
+    # locales, menu.lst, sudoers, fstab, nameserver, pacman.conf
+    # and the user files in OVERLAY_DIR
+    script.extract(configure_overlay(), root, 'Install the configuration files')
 
     # ssh configuration
-    sshd_config_filename = '%s/etc/ssh/sshd_config' % MAIN_PARTITION_MOUNT_POINT
-    run('cp %(path)s %(path)s.orig' % { 'path' : sshd_config_filename })
-    run("sed -i 's/#PasswordAuthentication yes/PasswordAuthentication no/' %s" % sshd_config_filename)
-    run("sed -i 's/#UseDNS yes/UseDNS no/' %s" % sshd_config_filename)
+    sshd_config_filename = '%s/etc/ssh/sshd_config' % root
+    script.run('cp %(path)s %(path)s.orig' % { 'path' : sshd_config_filename })
+    script.run("sed -i 's/#PasswordAuthentication yes/PasswordAuthentication no/' %s" % sshd_config_filename, 'Disable SSH password authentication')
+    script.run("sed -i 's/#UseDNS yes/UseDNS no/' %s" % sshd_config_filename, 'Disable SSH DNS lookups')
     
     # basic root creation
-    root_dir = '%s/root' % MAIN_PARTITION_MOUNT_POINT
-    run('cp %s/etc/skel/.bash* %s' % (MAIN_PARTITION_MOUNT_POINT, root_dir))
-    run('touch %s/firstboot' % root_dir)
+    root_dir = '%s/root' % root
+    script.run('cp %s/etc/skel/.bash* %s' % (root, root_dir), 'Create root profile')
+    script.run('touch %s/firstboot' % root_dir)
     
-    # sudo configuration
-    sudo_file = '%s/etc/sudoers.d/wheel' % MAIN_PARTITION_MOUNT_POINT
-    put(StringIO("%wheel ALL=(ALL) NOPASSWD: ALL"), sudo_file)
-    run('chmod 440 %s' % sudo_file) 
+    # Steps inside the chroot, run in a single arch-chroot session
+    script.chroot('ln -s /usr/share/zoneinfo/%s /etc/localtime' % TIMEZONE, 'Set timezone')
+    script.chroot('locale-gen', 'Generate locales')
+    script.chroot('systemctl enable sshd.service')
+    script.chroot('systemctl enable cronie.service')
+    script.chroot('systemctl enable dhcpcd\\@eth0.service')
+    script.chroot('systemctl enable ec2.service')
+    script.chroot('hwclock --systohc --utc')
     
-    # fstab
-    fstab = '%s/etc/fstab' % MAIN_PARTITION_MOUNT_POINT
-    run('mv %(path)s %(path)s.orig' % { 'path' : fstab})
-    put(StringIO(FSTAB_TEMPLATE), fstab)
-    
-    # nameserver
-    resolv = '%s/etc/resolv.conf' % MAIN_PARTITION_MOUNT_POINT
-    run('mv %(path)s %(path)s.orig' % { 'path' : resolv})
-    put(StringIO("nameserver 172.16.0.23\n"), resolv)
+    footprint_step(script, root)
+    script.run('umount %s && rm -rf %s' % (root, root), 'Unmount the build volume')
+    report_footprint(script.execute())
+
+def minimize_keep():
+    "Returns the paths of the ``locale`` category kept for ``LANG``."
+    language = LANG.split('.')[0]
+    return ['/usr/share/locale/%s' % name for name in (language, language.split('_')[0], 'locale.alias')]
+
+def minimize_steps(script, root, policy, keep=()):
+    """
+    Adds to ``script`` the steps removing the files of each category 
+    of ``policy`` (a list of ``(category, glob patterns)``), except 
+    the ``keep`` paths, and printing the bytes of each category 
+    before and after.
+    """
+    keep = '|'.join(pipes.quote(root + path) for path in keep) or "''"
+    for category, patterns in policy:
+        globs = ' '.join(root + pattern for pattern in patterns)
+        script.run("""measure() { [ $# -eq 0 ] && echo 0 || du -scb "$@" 2> /dev/null | tail -1 | cut -f1; }
+files=(); kept=()
+for path in %(globs)s; do
+  [ -e "$path" ] || continue
+  case "$path" in %(keep)s) kept+=("$path");; *) files+=("$path");; esac
+done
+before=$(( $(measure "${files[@]}") + $(measure "${kept[@]}") ))
+[ ${#files[@]} -eq 0 ] || rm -rf "${files[@]}"
+echo %(marker)s %(category)s $before $(measure "${kept[@]}")""" % { 
+            'globs' : globs, 'keep' : keep, 'marker' : MINIMIZE_MARKER, 'category' : category }, 
+            'Remove the %s' % category.replace('_', ' '))
+
+def report_minimize(out):
+    "Prints the bytes of each category before and after the minimization, found in ``out``."
+    total_before = total_after = 0
+    for category, before, after in re.findall(r'%s (\S+) (\d+) (\d+)' % MINIMIZE_MARKER, out):
+        before, after = int(before), int(after)
+        total_before += before
+        total_after += after
+        print green('%-16s %10s -> %10s' % (category, format_size(before), format_size(after)))
+    print green('%-16s %10s -> %10s' % ('total', format_size(total_before), format_size(total_after)))
 
-    # pacman.conf    
-    arch = run('uname -m', quiet=True)    
-    pacman_filename = '%s/etc/pacman.conf' % MAIN_PARTITION_MOUNT_POINT
-    put(StringIO(MINIMAL_PACMAN_CONF % { 'arch' : arch}), pacman_filename )
+MINIMIZE_MARKER = 'ARCHEC2BUILD_MINIMIZE'
+
+@task
+def minimize_image():
+    """
+    Removes the files of the build volume that the image doesn't 
+    need, according to ``MINIMIZE_POLICY``, and prints the space 
+    used by each category before and after.
     
-    unmount_main_partition()
+    The free blocks are then trimmed, or zeroed if 
+    ``MINIMIZE_FREE_SPACE`` is ``'zero'``.
+    """
+    instance, volume, device_name = get_volume()
+    root = MAIN_PARTITION_MOUNT_POINT
+    script = RemoteScript('minimize_image', root)
+    script.run(mount_command(device_name, root), 'Mount the build volume')
+    footprint_step(script, root)
+    minimize_steps(script, root, MINIMIZE_POLICY, minimize_keep())
+    if MINIMIZE_FREE_SPACE == 'trim':
+        script.run('fstrim %s || echo "fstrim is not supported"' % root, 'Trim the free blocks')
+    elif MINIMIZE_FREE_SPACE == 'zero':
+        script.run('dd if=/dev/zero of=%(root)s/.zero bs=1M 2> /dev/null || true; sync; rm -f %(root)s/.zero' % { 'root' : root }, 
+            'Zero the free blocks')
+    footprint_step(script, root)
+    script.run('umount %s && rm -rf %s' % (root, root), 'Unmount the build volume')
+    with hide('output'):
+        out = script.execute()
+    report_minimize(out)
+    used = [format_size(int(value)) for value in re.findall(r'%s (\d+) \d+' % FOOTPRINT_MARKER, out)]
+    if len(used) == 2:
+        print green('Space used on the build volume: %s -> %s' % tuple(used))
     
 @task
-def create_image(name=IMAGE_NAME, description=IMAGE_DESCRIPTION):
+def create_image(name=None, description=IMAGE_DESCRIPTION, snapshot=None):
     """
     Create an EBS AMI from the build volume.
     
@@ -517,41 +2206,162 @@ def create_image(name=IMAGE_NAME, description=IMAGE_DESCRIPTION):
     :type description: string
     :param description: The description of the AMI.
     
+    :type snapshot: class:`boto.ec2.snapshot`
+    :param snapshot: A snapshot of the build volume started with
+        :method:`start_snapshot`. A new snapshot is taken if not 
+        specified.
+    
     :rtype: class:`boto.ec2.Image` or ``None``
     :return: The image produced.
     """
+    name = name or constants.IMAGE_NAME
     instance, volume, device_name = get_volume()
-    snapshot = create_snapshot(IMAGE_NAME)
+    if snapshot is None:
+        snapshot = create_snapshot(constants.IMAGE_NAME)
+    else:
+        snapshot = complete_snapshot(snapshot, constants.IMAGE_NAME)
     image = None
     if snapshot is None:
         print red('Cannot create image with no snapshot')
     else:
-        # Create block device mapping
-        ebs = EBSBlockDeviceType(snapshot_id=snapshot.id, delete_on_termination=True)
-        ephemeral0 = BlockDeviceType(ephemeral_name='ephemeral0')
-        swap = BlockDeviceType(ephemeral_name='ephemeral1')
-        block_map = BlockDeviceMapping() 
-        block_map['/dev/sda1'] = ebs 
-        block_map['/dev/sda2'] = ephemeral0 
-        block_map['/dev/sda3'] = swap 
-        
-        image_id = instance.connection.register_image(
-            name,
-            description,
-            architecture = instance.architecture,
-            kernel_id = get_kernel(),
-            root_device_name = '/dev/sda1',
-            block_device_map = block_map
-        )
-        
-        print green('Image id is %s' % image_id)
-        time.sleep(5)
-        image = instance.connection.get_all_images((image_id,))[0]
-        add_name(image, name)
+        image = register_ebs_image(instance.connection, name, description, snapshot.id, instance.architecture)
+    return image
+
+def register_ebs_image(connection, name, description, snapshot_id, architecture, region=None):
+    """
+    Registers an EBS AMI whose root device is created from 
+    ``snapshot_id`` and waits for it to be available.
+    
+    :type region: string
+    :param region: The region of ``connection``, used to choose the 
+        kernel (``config.EC2_REGION`` by default).
+    
+    :rtype: class:`boto.ec2.Image`
+    :return: The registered image, named ``name``.
+    """
+    # Create block device mapping
+    ebs = EBSBlockDeviceType(snapshot_id=snapshot_id, delete_on_termination=True)
+    ephemeral0 = BlockDeviceType(ephemeral_name='ephemeral0')
+    swap = BlockDeviceType(ephemeral_name='ephemeral1')
+    block_map = BlockDeviceMapping() 
+    block_map['/dev/sda1'] = ebs 
+    block_map['/dev/sda2'] = ephemeral0 
+    block_map['/dev/sda3'] = swap 
+    
+    image_id = connection.register_image(
+        name,
+        description,
+        architecture = architecture,
+        kernel_id = get_kernel(region=region or config.EC2_REGION, arch=architecture),
+        root_device_name = '/dev/sda1',
+        block_device_map = block_map
+    )
+    
+    print green('Image id is %s' % image_id)
+    image = wait_for_image(connection, image_id)
+    add_name(image, name)
     return image
 
+class ProgressView(object):
+    """
+    Status board shared by concurrent operations.
+    
+    Each operation updates its own line with :method:`update` and
+    the whole board is printed on a single line on every change.
+    """
+    
+    def __init__(self, title):
+        self.title = title
+        self.lock = threading.Lock()
+        self.states = collections.OrderedDict()
+        
+    def update(self, key, state):
+        with self.lock:
+            if self.states.get(key) == state:
+                return
+            self.states[key] = state
+            print white('%s: %s' % (self.title, ' | '.join('%s %s' % item for item in self.states.iteritems())))
+
+def copy_image_to_region(image, region, progress):
+    """
+    Copies the EBS ``image`` to ``region``.
+    
+    Only the root snapshot is copied. The image is then registered
+    in ``region`` with the kernel of that region and the tags of 
+    ``image``.
+    
+    :type progress: :class:`ProgressView`
+    :param progress: Where the copy reports its progress.
+    
+    :rtype: class:`boto.ec2.Image`
+    :return: The image in ``region``.
+    """
+    connection = create_ec2_connection(region)
+    progress.update(region, 'copying snapshot')
+    source_snapshot_id = image.block_device_mapping['/dev/sda1'].snapshot_id
+    snapshot_id = connection.copy_snapshot(config.EC2_REGION, source_snapshot_id, 
+        'Copy of %s from %s' % (image.name, config.EC2_REGION))
+    snapshot = wait_until(lambda: (connection.get_all_snapshots((snapshot_id,)) or [None])[0], 
+        lambda snapshot: snapshot is not None, 'Snapshot %s visible in %s' % (snapshot_id, region))
+    def poll():
+        snapshot.update()
+        progress.update(region, 'snapshot %s' % (snapshot.progress or '0%'))
+        return snapshot.progress
+    wait_until(poll, '100%', 'Snapshot %s copied to %s' % (snapshot_id, region), delay=5, max_delay=30)
+    progress.update(region, 'registering')
+    copy = register_ebs_image(connection, image.name, image.description, snapshot_id, image.architecture, region)
+    connection.create_tags((snapshot_id, copy.id), image.tags)
+    get_resource_index(connection).invalidate()
+    progress.update(region, 'done (%s)' % copy.id)
+    return copy
+    
 @task
-def deregister_images(name=IMAGE_NAME):
+def replicate_image(regions=None, name=None):
+    """
+    Copies the EBS image to other regions.
+    
+    The regions are copied concurrently, each with one snapshot 
+    copy (see :method:`copy_image_to_region`).
+    
+    :type regions: string
+    :param regions: Comma separated regions to copy the image to
+        (``REPLICA_REGIONS`` by default).
+    
+    :type name: string
+    :param name: The name of the image to copy (``IMAGE_NAME`` by
+        default).
+    
+    :rtype: dict
+    :return: The copied images by region.
+    """
+    name = name or constants.IMAGE_NAME
+    regions = regions.split(',') if regions else list(REPLICA_REGIONS)
+    regions = [region for region in regions if region != config.EC2_REGION]
+    if not regions:
+        print yellow('No region to replicate the image to')
+        return {}
+    for region in regions:
+        # Fails early for unknown regions
+        get_kernel(region=region)
+    images = find_images(name=name)
+    if not images:
+        abort('No image with name %s' % name)
+    image = images[0]
+    
+    print blue('Replicating image %s to %s' % (image.id, ', '.join(regions)))
+    progress = ProgressView('Replication')
+    results = WorkerPool(len(regions)).run(lambda region: copy_image_to_region(image, region, progress), 
+        regions, 'Replication')
+    for result in results:
+        if not result.ok:
+            progress.update(result.item, 'failed (%s)' % result.error)
+    failed = [result.item for result in results if not result.ok]
+    if failed:
+        abort('Replication failed for %s' % ', '.join(failed))
+    return dict((result.item, result.value) for result in results)
+
+@task
+def deregister_images(name=None):
     """
     Deregister the images with the given ``name``.
     
@@ -559,12 +2369,11 @@ def deregister_images(name=IMAGE_NAME):
     :param name: The name of the image to delete. By default,
         deletes the current build image (``IMAGE_NAME``).
     """
-    for image in find_images(name=name):
-        print green('Deleting image %s' % image.id)
-        image.deregister()
+    name = name or constants.IMAGE_NAME
+    check_garbage_failures(collect_garbage([('images', image) for image in find_images(name=name)], retention=False))
 
 @task
-def launch_instance(image_name=BASE_IMAGE_NAME, instance_name=BASE_INSTANCE_NAME, wait=False):
+def launch_instance(image_name=None, instance_name=None, wait=False):
     """
     Launch an instance. 
     
@@ -584,6 +2393,8 @@ def launch_instance(image_name=BASE_IMAGE_NAME, instance_name=BASE_INSTANCE_NAME
     :rtype: class:`boto.ec2.Instance` or ``None``.
     :return: the launched instance.
     """
+    image_name = image_name or constants.BASE_IMAGE_NAME
+    instance_name = instance_name or constants.BASE_INSTANCE_NAME
     images = find_images(name=image_name)
     instance = None
     if not images or len(images) == 0:
@@ -603,16 +2414,11 @@ def launch_instance(image_name=BASE_IMAGE_NAME, instance_name=BASE_INSTANCE_NAME
         if reservation:
             instance = reservation.instances[0]
             print green('Waiting for instance %s to be available...' % instance.id)
-            time.sleep(3)
-            status = instance.update()
-            while status != 'running':
-                print white('Waiting...') 
-                time.sleep(3)
-                status = instance.update()
+            wait_for(instance, 'running', delay=3)
             add_name(instance, instance_name)
             print green('Instance %s with dns_name %s launched' % (instance.id, instance.dns_name))
-            if wait:
-                check_instance(instance)
+            if wait and not check_instance(instance):
+                abort('Instance %s is not available through SSH' % instance.id)
     return instance
 
 
@@ -622,39 +2428,39 @@ def launch_build_instance(s3=False,wait=False):
     Launches the build instance.
     """
     if s3:
-        return launch_instance(S3_IMAGE_NAME, S3_INSTANCE_NAME, wait)
+        return launch_instance(constants.S3_IMAGE_NAME, constants.S3_INSTANCE_NAME, wait)
     else:
-        return launch_instance(IMAGE_NAME, INSTANCE_NAME, wait)
+        return launch_instance(constants.IMAGE_NAME, constants.INSTANCE_NAME, wait)
 
 @task
-def terminate_instances(name=BASE_INSTANCE_NAME):
+def terminate_instances(name=None):
     """
     Terminate instances with the given name.
     
     :type name: string
     :param name: the name of the instances to terminate.
     """
-    instances = []
-    for instance in find_running_instances(name=name):
+    name = name or constants.BASE_INSTANCE_NAME
+    def terminate_instance(instance):
         print green('Deleting running instance with id %s and dns_name %s' % (instance.id, instance.dns_name))
-        instance.terminate()
-        instances.append(instance)
-    return instances
+        terminate(instance)
+        return instance
+    return WorkerPool().map(terminate_instance, find_running_instances(name=name))
 
 @task
-def reboot_instances(name=INSTANCE_NAME):
+def reboot_instances(name=None):
     """
     Terminate instances with the given name.
     
     :type name: string
     :param name: the name of the instances to terminate.
     """
-    instances = []
-    for instance in find_running_instances(name=name):
+    name = name or constants.INSTANCE_NAME
+    def reboot_instance(instance):
         print green('Rebooting running instance with id %s and dns_name %s' % (instance.id, instance.dns_name))
         instance.reboot()
-        instances.append(instance)
-    return instances
+        return instance
+    return WorkerPool().map(reboot_instance, find_running_instances(name=name))
 
 
 @task
@@ -663,40 +2469,188 @@ def terminate_build_instances(s3=False):
     Terminates the build instances running.
     """
     if s3:
-        return terminate_instances(S3_INSTANCE_NAME)
+        return terminate_instances(constants.S3_INSTANCE_NAME)
     else:
-        return terminate_instances(INSTANCE_NAME)
+        return terminate_instances(constants.INSTANCE_NAME)
+        
+
+class TaskResult(object):
+    """
+    The outcome of a :class:`WorkerPool` task: the ``value`` returned
+    or the ``error`` raised, and when the task ran.
+    """
+    
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None
+        self.traceback = None
+        self.cancelled = False
+        self.start = None
+        self.end = None
+        
+    @property
+    def ok(self):
+        return self.end is not None and self.error is None
+        
+    @property
+    def elapsed(self):
+        if self.start is None:
+            return 0
+        return (self.end or time.time()) - self.start
+        
+class PoolError(Exception):
+    """
+    Raised once every task of a :class:`WorkerPool` is over, when 
+    some of them failed. ``failures`` holds their :class:`TaskResult`.
+    """
+    
+    def __init__(self, description, failures):
+        self.failures = failures
+        Exception.__init__(self, '%s failed for %d items (%s)' % (description, len(failures), 
+            '; '.join('%s: %s' % (item_label(result.item), result.error) for result in failures)))
+        
+def item_label(item):
+    "Returns the id of an EC2 resource, the item itself otherwise."
+    return getattr(item, 'id', item)
+            
+class WorkerPool(object):
+    """
+    Runs a function on each item of a sequence, with at most 
+    ``workers`` threads at a time.
+    
+    Every task gets a :class:`TaskResult`. An exception in a task
+    doesn't stop the others, unless ``fail_fast`` is set: the 
+    remaining tasks are then cancelled, as they are when 
+    :method:`cancel` is called or the run is interrupted.
+    
+    :type workers: int
+    :param workers: The maximum number of concurrent tasks
+        (``WORKERS`` by default).
+    """
+    
+    def __init__(self, workers=None, fail_fast=False):
+        self.workers = workers or WORKERS
+        self.fail_fast = fail_fast
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        
+    def cancel(self):
+        "Prevents the tasks not started yet from running."
+        self.cancelled.set()
+        
+    def run(self, target, items, description=None):
+        """
+        Calls ``target`` on each of ``items``.
+        
+        :type description: string
+        :param description: If set, a summary of the run is printed
+            under this description.
+        
+        :rtype: list
+        :return: The :class:`TaskResult` of each item, in order.
+        """
+        results = [TaskResult(item) for item in items]
+        pending = list(reversed(results))
+        threads = [threading.Thread(target=inherit_build(self.work), args=(target, pending)) 
+            for i in range(min(self.workers, len(results)))]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                # Joins with a timeout so that Ctrl-C is handled
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        for result in results:
+            if result.start is None:
+                result.cancelled = True
+        if description:
+            for line in self.report(results, time.time() - start):
+                print (green if all(result.ok for result in results) else red)('%s: %s' % (description, line))
+        return results
+        
+    def work(self, target, pending):
+        while not self.cancelled.is_set():
+            with self.lock:
+                if not pending:
+                    return
+                result = pending.pop()
+            result.start = time.time()
+            try:
+                result.value = target(result.item)
+            except Exception, e:
+                result.error = e
+                result.traceback = traceback.format_exc()
+                if self.fail_fast:
+                    self.cancel()
+            except SystemExit:
+                # abort() has already printed its message
+                result.error = 'aborted'
+                result.traceback = traceback.format_exc()
+                if self.fail_fast:
+                    self.cancel()
+            result.end = time.time()
+            
+    def report(self, results, elapsed):
+        "Returns the summary of a run, failures included."
+        done = [result for result in results if result.ok]
+        failed = [result for result in results if result.error is not None]
+        cancelled = [result for result in results if result.cancelled]
+        lines = ['%d done, %d failed, %d cancelled in %.1fs' % (len(done), len(failed), len(cancelled), elapsed)]
+        if done:
+            slowest = max(done, key=lambda result: result.elapsed)
+            lines[0] += ' (slowest %s: %.1fs)' % (item_label(slowest.item), slowest.elapsed)
+        for result in failed:
+            lines.append('%s failed after %.1fs: %s' % (item_label(result.item), result.elapsed, result.error))
+        return lines
+        
+    def map(self, target, items, description=None):
+        """
+        Calls ``target`` on each of ``items``, and raises a 
+        :class:`PoolError` if some calls failed or were cancelled.
         
+        :rtype: list
+        :return: The values returned, in order.
+        """
+        results = self.run(target, items, description)
+        failures = [result for result in results if not result.ok]
+        for result in failures:
+            if result.cancelled:
+                result.error = 'cancelled'
+        if failures:
+            raise PoolError(description or getattr(target, '__name__', 'tasks'), failures)
+        return [result.value for result in results]
 
-class Joiner(object):
+class RateLimiter(object):
     """
-    Launches threads on a sequence and synchronize termination
+    Token bucket shared by several threads, allowing ``rate`` calls
+    per second on average and bursts of ``burst`` calls.
     """
     
-    def __init__(self):
-        self.semaphore = threading.Semaphore()
-        self.event = threading.Event()
-        
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
         
-    def run(self, target, args):
-        self.threads = []
-        self.count = len(args)
-        for arg in args:
-            thread = threading.Thread(target=self.work, args=(target, arg))
-            self.threads.append(thread)
-            thread.start()
-        self.event.wait()             
-        
-    def work(self, target, arg):
-        try:
-            target(arg)
-        finally:
-            with self.semaphore:
-                self.count -= 1
-                if self.count == 0:
-                    self.event.set() 
-            
-                
+    def acquire(self):
+        "Waits until a call is allowed."
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
 
 @task
 def reboot_build_instances(s3=False, wait=False):
@@ -705,24 +2659,19 @@ def reboot_build_instances(s3=False, wait=False):
     """
     instances = None
     if s3:
-        instances = reboot_instances(S3_INSTANCE_NAME)
+        instances = reboot_instances(constants.S3_INSTANCE_NAME)
     else:
-        instances = reboot_instances(INSTANCE_NAME)
+        instances = reboot_instances(constants.INSTANCE_NAME)
 
     if wait and instances and len(instances) > 0:
-        def wait_running(instance):
-            time.sleep(2)
-            while instance.update() != 'running':
-                print white('Waiting on %s' % instance.id)
-                time.sleep(3)
-            check_instance(instance)
-        Joiner().run(wait_running, instances)
+        WorkerPool().map(lambda instance: wait_for(instance, 'running', delay=2), instances, 'Waiting for running')
+        check_instances(instances)
                 
             
         
             
 @task
-def create_s3_image(name=S3_IMAGE_NAME, description=IMAGE_DESCRIPTION):
+def create_s3_image(name=None, description=IMAGE_DESCRIPTION):
     """
     Creates an instance store (S3) based image from the build volume.
     
@@ -746,6 +2695,7 @@ def create_s3_image(name=S3_IMAGE_NAME, description=IMAGE_DESCRIPTION):
     :rtype: class:`boto.ec2.Image` or ``None``
     :return: the built image.
     """
+    name = name or constants.S3_IMAGE_NAME
     instance, volume, device_name = get_volume()
     mount_main_partition(device_name)
     
@@ -763,7 +2713,7 @@ def create_s3_image(name=S3_IMAGE_NAME, description=IMAGE_DESCRIPTION):
         'user' : config.AWS_ACCOUNT_ID,
         'cert' : cert,
         'pk' : pk,
-        'arch' : ARCH,
+        'arch' : constants.ARCH,
         'prefix' : name,
         'kernel': get_kernel(),
         'path' : MAIN_PARTITION_MOUNT_POINT.rstrip('/'),
@@ -774,17 +2724,30 @@ def create_s3_image(name=S3_IMAGE_NAME, description=IMAGE_DESCRIPTION):
         'region' : config.EC2_REGION,
     }
     
-    with settings(warn_only=True):
-        print green('Creating image bundle')
-        out = run('ec2-bundle-vol -u %(user)s -c %(cert)s -k %(pk)s -d /mnt -p %(prefix)s -r %(arch)s --kernel %(kernel)s -v %(path)s -B "ami=sda1,root=/dev/sda1,ephemeral0=sda2,ephemeral1=sda3"' % parameters)
+    # The parts are uploaded while the bundle is made
+    parameters.update({
+        'uploader' : '/tmp/archec2build_s3upload.py',
+        'done' : '/tmp/archec2build_bundle.rc',
+        'log' : '/tmp/archec2build_bundle.log',
+        'connections' : S3_UPLOAD_CONNECTIONS,
+        'endpoint' : ' --endpoint %s' % S3_ENDPOINT if S3_ENDPOINT else '',
+    })
+    put(StringIO(inspect.getsource(s3upload)), parameters['uploader'])
+    
+    with settings(shell_env(AWS_ACCESS_KEY_ID=config.AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY=config.AWS_SECRET_ACCESS_KEY), 
+            warn_only=True):
+        print green('Creating and uploading image bundle')
+        out = run('rm -f %(done)s; (ec2-bundle-vol -u %(user)s -c %(cert)s -k %(pk)s -d /mnt -p %(prefix)s -r %(arch)s --kernel %(kernel)s -v %(path)s -B "ami=sda1,root=/dev/sda1,ephemeral0=sda2,ephemeral1=sda3" > %(log)s 2>&1; echo $? > %(done)s) & '
+            'python2 %(uploader)s --dir /mnt --prefix %(prefix)s --bucket %(bucket)s --done-file %(done)s --connections %(connections)d%(endpoint)s; '
+            'rc=$?; wait; cat %(log)s; rm -f %(done)s %(log)s %(uploader)s; exit $rc' % parameters)
         #run('ec2-migrate-manifest -c %(cert)s -k %(pk)s -a %(access)s -s %(secret)s -m %(manifest)s --region %(region)s' % parameters)
         run('rm -rf %s %s' % (cert, pk))
         unmount_main_partition()
+        for line in out.splitlines():
+            if line.startswith('upload: '):
+                print green('Upload: %s' % line[len('upload: '):])
         if out.failed:
-            abort('Failed to build bundle')
-
-    print green('Uploading bundle to S3')
-    run('yes | ec2-upload-bundle -b %(bucket)s -m %(manifest)s -a %(access)s -s %(secret)s' % parameters)
+            abort('Failed to build or upload bundle')
     
     image_id = instance.connection.register_image(
         name,
@@ -793,17 +2756,81 @@ def create_s3_image(name=S3_IMAGE_NAME, description=IMAGE_DESCRIPTION):
     )
     
     print green('Image id is %s' % image_id)
-    time.sleep(3)
-    image = instance.connection.get_all_images((image_id,))[0]
+    image = wait_for_image(instance.connection, image_id)
     add_name(image, name)
     
     print green('cleaning')
-    run('rm /mnt/%s*' % name) 
+    # the uploader deletes the bundle files it uploaded
+    run('rm -f /mnt/%s*' % name) 
     return image
     
+@task
+@hosts('localhost')
+def check_s3_upload(parts=6, failures=2):
+    """
+    Checks the bundle uploader of :method:`create_s3_image` against 
+    a local S3 stand-in, and the first ``failures`` uploads fail.
+    
+    Like ``ec2-bundle-vol``, the fake bundler writes the image, 
+    splits it into ``parts`` parts at the end, and then reads every
+    part again to write the manifest, failing if one is missing.
+    """
+    parts, failures = int(parts), int(failures)
+    directory = tempfile.mkdtemp(prefix='archec2build_s3upload.')
+    done_file = os.path.join(directory, 'bundle.rc')
+    prefix = 'check'
+    files = [('%s.part.%02d' % (prefix, index), os.urandom(256 * 1024)) for index in range(parts)]
+    files.append(('%s.manifest.xml' % prefix, '<manifest/>'))
+    
+    def bundle():
+        image = os.path.join(directory, prefix)
+        with open(image, 'wb') as f:
+            f.write(''.join(data for name, data in files[:-1]))
+        time.sleep(0.2)
+        for name, data in files[:-1]:
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+            time.sleep(0.05)
+        status = 0
+        for name, data in files[:-1]:
+            time.sleep(0.05)
+            try:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    hashlib.sha1(f.read())
+            except IOError:
+                status = 1
+        os.remove(image)
+        name, data = files[-1]
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        with open(done_file, 'w') as f:
+            f.write('%d\n' % status)
+    
+    try:
+        with s3upload.StandIn('access', 'secret', failures) as server:
+            client = s3upload.S3Client('bucket', 'access', 'secret', server.endpoint)
+            uploader = s3upload.BundleUploader(client, directory, prefix, connections=2, poll=0.05)
+            bundler = threading.Thread(target=bundle)
+            bundler.start()
+            complete = uploader.run(done_file, timeout=60)
+            bundler.join()
+        for line in uploader.report():
+            print blue('Upload: %s' % line)
+        if not complete:
+            abort('The bundle was not uploaded')
+        uploaded = dict((key, data) for (bucket, key), (data, acl) in server.objects.items())
+        if uploaded != dict(files):
+            abort('The uploaded bundle differs: %s' % ', '.join(sorted(set(uploaded) ^ set(dict(files)))))
+        left = [name for name in os.listdir(directory) if name != os.path.basename(done_file)]
+        if left:
+            abort('The uploaded files were not deleted: %s' % ', '.join(sorted(left)))
+    finally:
+        shutil.rmtree(directory)
+    print green('Uploaded %d files in %d requests, %d failed' % (len(files), server.requests, failures))
+    
     
 @task
-def deregister_s3_image(name=S3_IMAGE_NAME):
+def deregister_s3_image(name=None):
     """
     Deregister the S3 image with the specified ``name``.
     
@@ -814,18 +2841,12 @@ def deregister_s3_image(name=S3_IMAGE_NAME):
     :param name: the name of the image to delete.
         ``S3_IMAGE_NAME`` by default.
     """
-    for image in find_images(name=name):
-        print green('Deleting image %s' % image.id)
-        image.deregister()
-    parameters = {
-        'access' : config.AWS_ACCESS_KEY_ID,
-        'secret' : config.AWS_SECRET_ACCESS_KEY,
-        'manifest' : '%s.manifest.xml' % name,
-        'prefix' : name,
-        'bucket' : config.S3_AMI_BUCKET,
-        'region' : config.EC2_REGION,
-    }
-    local('ec2-delete-bundle -b %(bucket)s -p %(prefix)s -a %(access)s -s %(secret)s -y' % parameters)
+    name = name or constants.S3_IMAGE_NAME
+    images = find_images(name=name)
+    check_garbage_failures(collect_garbage([('images', image) for image in images], retention=False, s3_keys=True))
+    if not images:
+        # The bundle of an image that failed to register
+        delete_image_keys(name, bundle=True)
         
         
     
@@ -847,25 +2868,393 @@ def make_image(create_snapshot=False):
     - :method:`configure_archlinux`
     - :method:`create_image`
     
+    When ``USE_LAYERS`` is ``True`` and no ``SNAPSHOT_ID`` is given, 
+    the volume is snapshotted after :method:`bootstrap_archlinux` and
+    after :method:`configure_archlinux`. The snapshots are named after
+    the hash of the inputs of these stages (see :method:`layer_hashes`)
+    and the next build with the same inputs starts from the deepest
+    matching one, skipping the stages it covers. The packages of the
+    restored layer are upgraded (see :method:`upgrade_layer`).
+    
     :type create_snapshot: boolean
     :param create_snapshot: Create a build snapshot just after
         the call to :method:`bootstrap_archlinux` if ``True``.
         
     :rtype: :class:`boto.ec2.Image` or ``None``.
     :return: The build image.
+    
+    Each stage is checkpointed (see :class:`Checkpoints`), so that 
+    :method:`resume` can continue a failed build.
+    """
+    checkpoints = Checkpoints()
+    checkpoints.reset()
+    return run_make_image_stages(checkpoints, create_snapshot=create_snapshot).get('create_image')
+    
+def prepare_volume(create_snapshot=False, checkpoints=None):
+    """
+    Creates, installs and configures the build volume.
+    
+    This is :method:`make_image` without the final call to
+    :method:`create_image`.
+    """
+    run_make_image_stages(checkpoints or Checkpoints(), 'configure_archlinux', create_snapshot)
+
+MAKE_IMAGE_STAGES = (
+    'check_install_scripts',
+    'create_and_attach_volume',
+    'format_volume_partitions',
+    'bootstrap_archlinux',
+    'snapshot_base_layer',
+    'create_volume_snapshot',
+    'configure_archlinux',
+    'snapshot_configured_layer',
+    'minimize_image',
+    'start_snapshot',
+    'create_image',
+)
+
+#
+# Layers
+#
+def layer_hashes(versions=True):
+    """
+    Returns the hashes of the inputs of the build layers, from the
+    shallowest to the deepest.
+    
+    - The ``base`` layer is the volume after :method:`bootstrap_archlinux`. 
+      It depends on the architecture, the packages file and the 
+      pacman configuration and, if ``CHECK_PACKAGE_VERSIONS`` is
+      True, on the versions of the packages currently available.
+    - The ``configured`` layer is the volume after 
+      :method:`configure_archlinux`. It also depends on the hostname, 
+      language, keymap, timezone, templates and overlay files.
+    """
+    def digest(value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+    base = digest({
+        'arch' : constants.ARCH,
+        'packages' : get_package_list(),
+        'versions' : constants.MANIFEST.versions() if versions and CHECK_PACKAGE_VERSIONS else None,
+        'pacman_conf' : MINIMAL_PACMAN_CONF % { 'arch' : pacman_arch() },
+    })
+    overlay = [(name, info.mode, info.linkname, hashlib.sha1(content).hexdigest()) 
+        for name, (info, content) in configure_overlay().entries.iteritems()]
+    configured = digest({
+        'base' : base,
+        'hostname' : HOSTNAME,
+        'lang' : LANG,
+        'keymap' : KEYMAP,
+        'timezone' : TIMEZONE,
+        'templates' : [GRUB_MENU_LST, FSTAB_TEMPLATE],
+        'overlay' : overlay,
+    })
+    return collections.OrderedDict([('base', base), ('configured', configured)])
+
+@task
+def upgrade_layer():
+    """
+    Upgrades the packages of a build volume restored from a layer
+    snapshot, which may be older than the packages available.
+    """
+    instance, volume, device_name = get_volume()
+    root = MAIN_PARTITION_MOUNT_POINT
+    script = RemoteScript('upgrade_layer', root)
+    script.run(mount_command(device_name, root), 'Mount the build volume')
+    script.chroot('pacman -Syu --noconfirm', 'Upgrade the layer packages')
+    script.run('umount %s && rm -rf %s' % (root, root), 'Unmount the build volume')
+    script.execute()
+
+def layer_name(layer, digest):
+    return '%s.layer.%s.%s.%s' % (BASE_PREFIX, constants.ARCH, layer, digest[:16])
+
+def find_layer():
+    """
+    Returns the deepest layer whose inputs match the current build,
+    and its completed snapshot, or ``(None, None)``.
+    """
+    for layer, digest in reversed(layer_hashes().items()):
+        snapshots = [snapshot for snapshot in find_snapshots(name=layer_name(layer, digest)) if snapshot.status == 'completed']
+        if snapshots:
+            return (layer, snapshots[0])
+    return (None, None)
+
+def snapshot_layer(layer):
+    """
+    Starts a snapshot of the build volume for ``layer``, named
+    after the hash of its inputs.
+    """
+    name = layer_name(layer, layer_hashes()[layer])
+    snapshot = start_snapshot(name)
+    if snapshot:
+        add_name(snapshot, name)
+    return snapshot
+
+class Checkpoints(object):
+    """
+    The stages of :method:`make_image` that are done for a build, 
+    with the resources they produced (instance, volume and device, 
+    snapshot and image ids).
+    
+    They are saved in the local ``STATE_FILE`` after each stage, 
+    under the name of the build image (``IMAGE_NAME`` by default, 
+    which contains the date: set ``DATE_STRING`` in the 
+    configuration to resume a build started on another day).
+    
+    The builds of :method:`build_matrix` share the state file, so 
+    it is updated under a lock on ``STATE_FILE.lock``, held by one 
+    thread of one process at a time.
+    """
+    lock = threading.RLock()
+    locked_files = {}
+    
+    def __init__(self, build=None, path=None):
+        self.build = build or constants.IMAGE_NAME
+        self.path = path or STATE_FILE
+        
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if self.path not in self.locked_files:
+                lock_file = open(self.path + '.lock', 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.locked_files[self.path] = [lock_file, 0]
+            self.locked_files[self.path][1] += 1
+        except:
+            self.lock.release()
+            raise
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        try:
+            self.locked_files[self.path][1] -= 1
+            if not self.locked_files[self.path][1]:
+                # closing the file releases the lock
+                self.locked_files.pop(self.path)[0].close()
+        finally:
+            self.lock.release()
+        
+    def load_all(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+        
+    def state(self):
+        with self:
+            return self.load_all().get(self.build, { 'stages' : [], 'resources' : {} })
+        
+    def save(self, state):
+        with self:
+            states = self.load_all()
+            if state is None:
+                states.pop(self.build, None)
+            else:
+                state['updated'] = datetime.datetime.now().isoformat()
+                states[self.build] = state
+            fd, path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', 
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(states, f, indent=2, sort_keys=True)
+                os.rename(path, self.path)
+            except:
+                os.remove(path)
+                raise
+            
+    def stages(self):
+        return self.state()['stages']
+    
+    def resources(self):
+        return self.state()['resources']
+        
+    def done(self, stage, **resources):
+        "Records that ``stage`` is done and produced ``resources``."
+        with self:
+            state = self.state()
+            if stage not in state['stages']:
+                state['stages'].append(stage)
+            state['resources'].update(resources)
+            self.save(state)
+            
+    def rewind(self, stage):
+        "Forgets ``stage`` and the stages after it."
+        with self:
+            state = self.state()
+            index = MAKE_IMAGE_STAGES.index(stage)
+            state['stages'] = [name for name in state['stages'] if MAKE_IMAGE_STAGES.index(name) < index]
+            self.save(state)
+            
+    def reset(self):
+        "Forgets the whole build."
+        self.save(None)
+
+def make_image_stage(name, resources, connection=create_ec2_connection):
+    """
+    Runs the :method:`make_image` stage ``name``.
+    
+    :type resources: dict
+    :param resources: The resources produced by the previous stages.
+    
+    :rtype: tuple
+    :return: The resources to checkpoint and the result of the stage.
+    """
+    if callable(connection):
+        connection = connection()
+    if name == 'check_install_scripts':
+        check_install_scripts()
+        return ({ 'instance_id' : get_build_instance() }, None)
+    elif name == 'create_and_attach_volume':
+        layers = USE_LAYERS and constants.SNAPSHOT_ID is None
+        layer, snapshot = find_layer() if layers else (None, None)
+        if layer:
+            print green('Starting from the %s layer (snapshot %s)' % (layer, snapshot.id))
+        volume, mount_point = create_and_attach_volume(snapshot.id if snapshot else None)
+        wait_for_device(mount_point.replace('/sd', '/xvd'))
+        return ({ 'volume_id' : volume.id, 'device' : mount_point, 'layers' : layers, 'layer' : layer }, volume)
+    elif name == 'bootstrap_archlinux' and resources.get('layer'):
+        # The layer key may not cover the package versions
+        print yellow('Upgrading the packages of the %s layer' % resources['layer'])
+        upgrade_layer()
+        return ({}, None)
+    elif name == 'format_volume_partitions' and resources.get('layer') \
+        or name == 'configure_archlinux' and resources.get('layer') == 'configured':
+        print yellow('Skipping %s, done in the %s layer' % (name, resources['layer']))
+        return ({}, None)
+    elif name in ('snapshot_base_layer', 'snapshot_configured_layer'):
+        layer = name.split('_')[1]
+        if not resources.get('layers') or resources.get('layer') in (layer, 'configured'):
+            return ({}, None)
+        snapshot = snapshot_layer(layer)
+        return ({ '%s_layer_snapshot_id' % layer : snapshot.id if snapshot else None }, snapshot)
+    elif name == 'start_snapshot':
+        snapshot = start_snapshot(constants.IMAGE_NAME)
+        if snapshot is None:
+            abort('Could not snapshot the build volume')
+        return ({ 'snapshot_id' : snapshot.id }, snapshot)
+    elif name == 'create_image':
+        snapshot = connection.get_all_snapshots((resources['snapshot_id'],))[0]
+        image = create_image(snapshot=snapshot)
+        if image is None:
+            abort('Could not create the image')
+        return ({ 'image_id' : image.id }, image)
+    tasks = {
+        'format_volume_partitions' : format_volume_partitions,
+        'bootstrap_archlinux' : bootstrap_archlinux,
+        'create_volume_snapshot' : create_volume_snapshot,
+        'configure_archlinux' : configure_archlinux,
+        'minimize_image' : minimize_image,
+    }
+    tasks[name]()
+    return ({}, None)
+
+def run_make_image_stages(checkpoints, last='create_image', create_snapshot=False):
+    """
+    Runs the :method:`make_image` stages up to ``last`` that are not
+    done yet according to ``checkpoints``, and checkpoints them.
+    
+    :rtype: dict
+    :return: The results of the stages run, by name.
+    """
+    results = {}
+    for name in MAKE_IMAGE_STAGES[:MAKE_IMAGE_STAGES.index(last) + 1]:
+        if name == 'create_volume_snapshot' and not create_snapshot \
+            or name == 'minimize_image' and not MINIMIZE_IMAGE:
+            continue
+        if name in checkpoints.stages():
+            continue
+        resources, results[name] = make_image_stage(name, checkpoints.resources())
+        checkpoints.done(name, **resources)
+    return results
+
+def verify_checkpoints(checkpoints, connection=create_ec2_connection):
+    """
+    Checks that the resources recorded in ``checkpoints`` still 
+    exist, and rewinds the checkpoints to the stage producing the 
+    first missing one.
+    
+    :rtype: class:`boto.ec2.Instance`
+    :return: The build instance.
+    """
+    if callable(connection):
+        connection = connection()
+    resources = checkpoints.resources()
+    try:
+        instance = get_instance(connection, resources.get('instance_id'))
+    except Exception:
+        instance = None
+    if instance is None or instance.state != 'running':
+        abort('Build instance %s is not running anymore' % resources.get('instance_id'))
+    
+    stages = checkpoints.stages()
+    if 'create_and_attach_volume' in stages:
+        volumes = connection.get_all_volumes(filters={'volume-id' : resources['volume_id']})
+        if not volumes or volumes[0].attach_data.instance_id != instance.id:
+            print yellow('Build volume %s is gone' % resources['volume_id'])
+            checkpoints.rewind('create_and_attach_volume')
+            return instance
+    if 'start_snapshot' in stages:
+        snapshots = connection.get_all_snapshots(filters={'snapshot-id' : resources['snapshot_id']})
+        if not snapshots or snapshots[0].status == 'error':
+            print yellow('Image snapshot %s is gone' % resources['snapshot_id'])
+            checkpoints.rewind('start_snapshot')
+    return instance
+
+@task
+def resume():
+    """
+    Resumes a failed :method:`make_image` from its last completed stage.
+    
+    The resources recorded by the completed stages are checked 
+    first (see :method:`verify_checkpoints`).
+    
+    :rtype: :class:`boto.ec2.Image` or ``None``.
+    :return: The build image.
+    """
+    return Build.current().resume()
+    
+    
+def ssh_command_check(host, timeout):
     """
-    check_install_scripts()
-    create_and_attach_volume()
-    time.sleep(10)
-    format_volume_partitions()
-    bootstrap_archlinux()
-    if create_snapshot:
-        create_volume_snapshot()
-    configure_archlinux()
-    return create_image()
+    Runs ``uname -a`` on ``host`` as root.
     
+    The check uses its own SSH connection and leaves Fabric's ``env``
+    untouched, so that it can run while another thread is working 
+    on the build instance. It is run with ``abort_on_prompts`` set
+    (see :method:`check_instances`), so that a password or host key
+    prompt fails the check instead of blocking it.
+    """
+    client = fabric.network.connect('root', host, 22, fabric.state.connections, seek_gateway=False)
+    try:
+        stdin, stdout, stderr = client.exec_command('uname -a', timeout=timeout)
+        return stdout.channel.recv_exit_status() == 0
+    finally:
+        client.close()
+
+def check_instances(instances, deadline=None):
+    """
+    Waits for ``instances`` to be available through SSH, all at once.
     
-def check_instance(instance):
+    Each instance must accept TCP connections on port 22, then send 
+    the SSH banner, then run a command (see :mod:`probe`).
+    
+    :type deadline: int
+    :param deadline: The number of seconds after which the instances
+        that are not available are given up (``PROBE_DEADLINE`` by 
+        default).
+    
+    :rtype: dict
+    :return: The :class:`probe.ProbeResult` of each instance, by id.
+    """
+    hosts = dict((instance.dns_name, instance) for instance in instances)
+    print green('Waiting for %s to answer...' % ', '.join(instance.id for instance in instances))
+    # env is shared with the probe threads, set it once for them
+    with settings(abort_on_prompts=True):
+        results = probe.Probe(hosts, ssh_command_check, deadline=deadline or PROBE_DEADLINE).run()
+    for host, result in results.items():
+        print (green if result.ok else red)('%s: %r' % (hosts[host].id, result))
+    return dict((hosts[host].id, result) for host, result in results.items())
+
+def check_instance(instance, deadline=None):
     """
     Checks that the instance is available through SSH.
     
@@ -876,16 +3265,10 @@ def check_instance(instance):
     :return: ``True`` if the instance is available, ``False``
         if not.
     """
-    with settings(
-        hide('output'),
-        host_string='root@%s' % instance.dns_name, 
-        warn_only=True,
-        connection_attempts=5):
-        print green('Waiting for server to answser...')
-        run('uname -a')    
+    return check_instances([instance], deadline)[instance.id].ok
     
 @task 
-def launch_instance_and_wait(image_name=BASE_IMAGE_NAME, instance_name=BASE_INSTANCE_NAME):
+def launch_instance_and_wait(image_name=None, instance_name=None):
     """
     Launch an instance with the specified image and waits for it to be available.
     
@@ -900,8 +3283,11 @@ def launch_instance_and_wait(image_name=BASE_IMAGE_NAME, instance_name=BASE_INST
     :param instance_name: The name to give to the instance.
         ``BASE_INSTANCE_NAME`` by default.
     """
+    image_name = image_name or constants.BASE_IMAGE_NAME
+    instance_name = instance_name or constants.BASE_INSTANCE_NAME
     instance = launch_instance(image_name, instance_name)
-    check_instance(instance)
+    if not check_instance(instance):
+        abort('Instance %s of %s is not available through SSH' % (instance.id, image_name))
     return instance
 
 @task 
@@ -910,12 +3296,12 @@ def launch_build_instance_and_wait(s3=False):
     Launches the build instance and wait
     """
     if s3:
-        return launch_instance_and_wait(S3_IMAGE_NAME, S3_INSTANCE_NAME)
+        return launch_instance_and_wait(constants.S3_IMAGE_NAME, constants.S3_INSTANCE_NAME)
     else:
-        return launch_instance_and_wait(IMAGE_NAME, INSTANCE_NAME)
+        return launch_instance_and_wait(constants.IMAGE_NAME, constants.INSTANCE_NAME)
 
 @task
-def check_access(name=INSTANCE_NAME):
+def check_access(name=None):
     """
     Check SSH access for instances of the specified name.
     
@@ -923,9 +3309,10 @@ def check_access(name=INSTANCE_NAME):
     :param name: the name of the instances to check.
         ``INSTANCE_NAME`` by default.
     """
+    name = name or constants.INSTANCE_NAME
     instances = find_running_instances(name=name)
-    for instance in instances:
-        check_instance(instance) 
+    if instances:
+        check_instances(instances)
 
 
 def change_base(find_method, base_name, new_name=None):
@@ -966,8 +3353,9 @@ def change_base(find_method, base_name, new_name=None):
         pass
     _new = find_method(name=new_name)[0] if new_name else find_method()[0]
     if old:  
-        old.remove_tag(base_name)
+        remove_tag(old, base_name)
     _new.add_tag(base_name, '')
+    get_resource_index(_new.connection).update(_new)
     
 @task
 def promote_build_images():
@@ -975,77 +3363,723 @@ def promote_build_images():
     Promote build images as public images.
     """
     print blue('Promoting new image to base image')
-    change_base(find_images, BASE_IMAGE_NAME)
-    change_base(find_snapshots, BASE_IMAGE_NAME, IMAGE_NAME)        
-    change_base(find_images, BASE_S3_IMAGE_NAME, S3_IMAGE_NAME)
+    change_base(find_images, constants.BASE_IMAGE_NAME)
+    change_base(find_snapshots, constants.BASE_IMAGE_NAME, constants.IMAGE_NAME)        
+    change_base(find_images, constants.BASE_S3_IMAGE_NAME, constants.S3_IMAGE_NAME)
     print blue('Making images public')
-    image = find_images(name=BASE_IMAGE_NAME)[0]
-    s3_image = find_images(name=BASE_S3_IMAGE_NAME)[0]
+    image = find_images(name=constants.BASE_IMAGE_NAME)[0]
+    s3_image = find_images(name=constants.BASE_S3_IMAGE_NAME)[0]
     image.connection.modify_image_attribute(image.id,groups='all')
     s3_image.connection.modify_image_attribute(s3_image.id,groups='all')
     
     
+#
+# Garbage collection
+#
+GC_PHASES = ('instances', 'images', 'snapshots')
+RESOURCE_NAME_PATTERN = re.compile(r'^(.+)\.(image|build|instance)\.([^.]+)$')
+LAYER_NAME_PATTERN = re.compile(r'^%s\.layer\.([^.]+)\.([^.]+)\.[0-9a-f]+$' % re.escape(BASE_PREFIX))
+
+def resource_names(resource):
+    "Returns the ``Name`` tag of ``resource`` followed by its other tag keys."
+    names = [resource.tags['Name']] if resource.tags.get('Name') else []
+    return names + sorted(key for key in resource.tags if key != 'Name' and key not in names)
+
+def resource_family(resource):
+    """
+    Returns the family and the architecture of a build resource, 
+    from its names.
+    
+    The family is ``base`` for the resources carrying a base name 
+    (of any architecture), ``image``, ``build`` or ``instance`` for 
+    the dated resources, prefixed by ``s3`` for the S3 builds, and 
+    ``layer <layer>`` for the layer snapshots. It is ``None`` for
+    the other resources.
+    
+    :rtype: tuple
+    """
+    names = resource_names(resource)
+    for name in names:
+        match = RESOURCE_NAME_PATTERN.match(name)
+        if match and match.group(1) in (BASE_PREFIX, BASE_S3_PREFIX):
+            return ('base', match.group(3))
+    for name in names:
+        match = LAYER_NAME_PATTERN.match(name)
+        if match:
+            return ('layer %s' % match.group(2), match.group(1))
+        match = RESOURCE_NAME_PATTERN.match(name)
+        if not match:
+            continue
+        prefix, kind, arch = match.groups()
+        if prefix.startswith('%s.' % BASE_S3_PREFIX):
+            return ('s3 %s' % kind, arch)
+        if prefix.startswith('%s.' % BASE_PREFIX):
+            return (kind, arch)
+    return (None, None)
+
+def resource_time(resource):
+    """
+    Returns the creation time of ``resource`` (UTC), or the date in
+    its name when EC2 doesn't tell.
+    
+    :rtype: :class:`datetime.datetime` or ``None``
+    """
+    for attribute in ('creationDate', 'start_time', 'launch_time'):
+        value = getattr(resource, attribute, None)
+        if value:
+            try:
+                return boto.utils.parse_ts(value)
+            except ValueError:
+                pass
+    for name in resource_names(resource):
+        match = re.search(r'\.(\d{8})\.', name)
+        if match:
+            return datetime.datetime.strptime(match.group(1), '%Y%m%d')
+    return None
+
+def ami_bucket():
+    "Returns the ``S3_AMI_BUCKET`` bucket."
+    return boto.connect_s3(config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY).get_bucket(config.S3_AMI_BUCKET)
+
+def delete_image_keys(name, bundle=False):
+    """
+    Deletes the build manifest of the image ``name`` from S3 and, 
+    if ``bundle`` is set, its bundle, with batched delete requests.
+    """
+    if not getattr(config, 'S3_AMI_BUCKET', None):
+        return
+    bucket = ami_bucket()
+    if bundle:
+        keys = [key.name for key in bucket.list(prefix='%s.' % name)]
+    else:
+        keys = ['%s.buildmanifest.json' % name]
+    for i in range(0, len(keys), 1000):
+        result = bucket.delete_keys(keys[i:i + 1000], quiet=True)
+        errors = [error for error in result.errors if error.code != 'NoSuchKey']
+        if errors:
+            raise Exception('Could not delete %s' % ', '.join('%s (%s)' % (error.key, error.message) for error in errors))
+
+def remove_resource(kind, resource, s3_keys=False):
+    """
+    Terminates, de-registers or deletes ``resource``. 
+    
+    If ``s3_keys`` is set, the S3 build manifest of a de-registered
+    image is deleted as well, and its bundle for an S3 image.
+    """
+    if kind == 'instances':
+        print green('Terminating instance %s' % resource.id)
+        terminate(resource)
+    elif kind == 'images':
+        print green('De-registering image %s with name %s' % (resource.id, resource.name))
+        deregister(resource)
+        if s3_keys:
+            delete_image_keys(resource.tags.get('Name', resource.name), resource.root_device_type == 'instance-store')
+    else:
+        print green('Deleting snapshot %s with name %s' % (resource.id, resource.tags.get('Name')))
+        delete(resource)
+
+def describe_resource(resource):
+    created = resource_time(resource)
+    names = resource_names(resource)
+    return '%s %s, %s' % (resource.id, names[0] if names else getattr(resource, 'name', None) or 'unnamed', 
+        created.strftime('%Y-%m-%d') if created else 'creation date unknown')
+
+class GarbagePlan(object):
+    """
+    The resources to delete, by kind, and the resources kept, with 
+    the reason of each decision.
+    """
+    
+    def __init__(self):
+        self.deletions = dict((kind, []) for kind in GC_PHASES)
+        self.kept = []
+        # The deleted images using each deleted snapshot
+        self.users = {}
+        
+    def __len__(self):
+        return sum(len(deletions) for deletions in self.deletions.values())
+        
+    def delete(self, kind, resource, reason):
+        self.deletions[kind].append((resource, reason))
+        
+    def keep(self, kind, resource, reason):
+        self.kept.append((kind, resource, reason))
+        
+    def lines(self):
+        lines = []
+        for kind in GC_PHASES:
+            for resource, reason in self.deletions[kind]:
+                lines.append('delete %s %s (%s)' % (kind[:-1], describe_resource(resource), reason))
+        for kind, resource, reason in self.kept:
+            lines.append('keep %s %s (%s)' % (kind[:-1], describe_resource(resource), reason))
+        return lines
+        
+    def execute(self, workers=None, rate=None, s3_keys=False):
+        """
+        Deletes the resources concurrently, at most ``rate`` 
+        (``GC_RATE`` by default) deletions per second. See 
+        :method:`remove_resource` for ``s3_keys``.
+        
+        The instances go first, then the images, then the snapshots
+        which the images may use. A failed deletion doesn't stop the 
+        others, but the snapshots of an image that could not be 
+        de-registered are left alone.
+        
+        :rtype: list
+        :return: The :class:`TaskResult` of the failed deletions.
+        """
+        limiter = RateLimiter(rate or GC_RATE)
+        failures = []
+        for kind in GC_PHASES:
+            failed = set(result.item.id for result in failures)
+            resources = []
+            for resource, reason in self.deletions[kind]:
+                users = [image for image in self.users.get(resource.id, ()) if image in failed]
+                if users:
+                    print yellow('Keeping snapshot %s used by image %s' % (resource.id, ', '.join(users)))
+                else:
+                    resources.append(resource)
+            if not resources:
+                continue
+            def remove(resource, kind=kind):
+                limiter.acquire()
+                remove_resource(kind, resource, s3_keys)
+            results = WorkerPool(workers).run(remove, resources, 'Deleting %s' % kind)
+            failures.extend(result for result in results if not result.ok)
+        return failures
+
+def plan_garbage(candidates, images=(), keep_last=0, keep_days=0, now=None, retention=True):
+    """
+    Decides which resources of ``candidates`` to delete.
+    
+    The base resources are always kept. The others are grouped by 
+    kind, family and architecture (see :method:`resource_family`), 
+    and the ``keep_last`` most recent of each group are kept, as 
+    well as those created less than ``keep_days`` days ago. A 
+    snapshot used by one of ``images`` that is not deleted is kept.
+    
+    If ``retention`` is ``False``, as for the resources given by 
+    name, only the snapshots used by the remaining images are kept.
+    
+    :type candidates: list
+    :param candidates: ``(kind, resource)`` pairs, the kind being
+        'instances', 'images' or 'snapshots'.
+    
+    :rtype: :class:`GarbagePlan`
+    """
+    now = now or datetime.datetime.utcnow()
+    plan = GarbagePlan()
+    groups = {}
+    seen = set()
+    for kind, resource in candidates:
+        if resource.id in seen:
+            continue
+        seen.add(resource.id)
+        family, arch = resource_family(resource)
+        if not retention:
+            groups.setdefault((kind, None, None), []).append(resource)
+        elif family == 'base':
+            plan.keep(kind, resource, 'base %s' % kind[:-1])
+        else:
+            groups.setdefault((kind, family, arch), []).append(resource)
+    deleted = set()
+    snapshots = []
+    for (kind, family, arch), resources in sorted(groups.items()):
+        resources.sort(key=lambda resource: resource_time(resource) or datetime.datetime.min, reverse=True)
+        for position, resource in enumerate(resources):
+            created = resource_time(resource)
+            if retention and position < keep_last:
+                plan.keep(kind, resource, 'one of the last %d %s' % (keep_last, ' '.join(filter(None, (family, arch))) or kind))
+            elif retention and keep_days and created and now - created < datetime.timedelta(days=keep_days):
+                plan.keep(kind, resource, 'less than %d days old' % keep_days)
+            elif kind == 'snapshots':
+                snapshots.append(resource)
+            else:
+                plan.delete(kind, resource, 'expired' if retention else 'requested')
+                deleted.add(resource.id)
+    used = {}
+    for image in images:
+        for device in image.block_device_mapping.values():
+            if device.snapshot_id:
+                used.setdefault(device.snapshot_id, []).append(image.id)
+    for snapshot in snapshots:
+        kept = [image for image in used.get(snapshot.id, ()) if image not in deleted]
+        if kept:
+            plan.keep('snapshots', snapshot, 'used by image %s' % ', '.join(kept))
+        else:
+            plan.delete('snapshots', snapshot, 'expired' if retention else 'requested')
+            plan.users[snapshot.id] = used.get(snapshot.id, [])
+    return plan
+
+def collect_garbage(candidates, images=None, keep_last=0, keep_days=0, dry_run=False, retention=True, s3_keys=False):
+    """
+    Plans the deletion of ``candidates`` (see :method:`plan_garbage`) 
+    and executes it (see :method:`GarbagePlan.execute`), unless 
+    ``dry_run`` is set.
+    
+    :type images: list
+    :param images: The images whose snapshots must not be deleted.
+        By default, every indexed image.
+    
+    :rtype: list
+    :return: The :class:`TaskResult` of the failed deletions.
+    """
+    if images is None:
+        images = get_resource_index().get('images')
+    plan = plan_garbage(candidates, images, keep_last, keep_days, retention=retention)
+    for line in plan.lines():
+        print (yellow if dry_run else blue)(line)
+    if dry_run or not len(plan):
+        print yellow('Nothing deleted (dry run)' if dry_run else 'Nothing to delete')
+        return []
+    return plan.execute(s3_keys=s3_keys)
+
+def check_garbage_failures(failures):
+    "Raises a :class:`PoolError` if deletions failed."
+    if failures:
+        raise PoolError('Garbage collection', failures)
+
 @task
-def clean_images(connection=create_ec2_connection):
+def clean_images(keep=None, days=None, layers=False, s3=False, dry_run=False, connection=create_ec2_connection):
+    """
+    Deletes the images of past builds and their snapshots.
+    
+    The base images and snapshots are kept, as well as the images 
+    and snapshots retained by the policy.
+    
+    :type keep: int
+    :param keep: The number of most recent images and snapshots kept 
+        per architecture (``GC_KEEP_LAST`` by default).
+    
+    :type days: int
+    :param days: Keeps the images and snapshots less than ``days`` 
+        days old (``GC_KEEP_DAYS`` by default).
+    
+    :type layers: boolean
+    :param layers: Delete the layer snapshots as well, with the same 
+        retention per layer.
+    
+    :type s3: boolean
+    :param s3: Also delete from ``S3_AMI_BUCKET`` the build manifests
+        of the de-registered images, and the bundles of the S3 images.
+    
+    :type dry_run: boolean
+    :param dry_run: Only print what would be deleted and kept.
+    """
+    keep = GC_KEEP_LAST if keep is None else int(keep)
+    days = GC_KEEP_DAYS if days is None else int(days)
+    index = get_resource_index(connection)
+    index.invalidate()
+    images = index.get('images')
+    candidates = [('images', image) for image in images]
+    for snapshot in index.get('snapshots'):
+        family = resource_family(snapshot)[0] or ''
+        if fnmatch.filter(snapshot.tags.keys(), '%s.*.image.*' % BASE_PREFIX) or (layers and family.startswith('layer ')):
+            candidates.append(('snapshots', snapshot))
+    check_garbage_failures(collect_garbage(candidates, images, keep, days, dry_run, s3_keys=s3))
+
+#
+# Build avoidance
+#
+BUILD_MANIFEST_TAG = 'archec2build:manifest'
+
+def build_manifest():
+    """
+    Returns what a build depends on: the versions of the packages 
+    available upstream and the hash of the configuration and 
+    templates.
+    """
+    return {
+        'arch' : constants.ARCH,
+        'config' : layer_hashes(versions=False)['configured'],
+        'packages' : constants.MANIFEST.versions(),
+    }
+
+def manifest_digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+def manifest_key(image):
+    """
+    Returns the S3 key of the manifest of ``image``, in the 
+    ``S3_AMI_BUCKET`` bucket.
+    """
+    return ami_bucket().new_key('%s.buildmanifest.json' % image.tags.get('Name', image.name))
+
+def record_build_manifest(images, manifest):
+    """
+    Tags ``images`` with the digest of ``manifest``, and saves the 
+    manifest itself next to them in S3.
+    """
+    digest = manifest_digest(manifest)
+    def record(image):
+        image.add_tag(BUILD_MANIFEST_TAG, digest)
+        get_resource_index(image.connection).update(image)
+        manifest_key(image).set_contents_from_string(json.dumps(manifest, indent=1, sort_keys=True))
+        print green('Recorded the build manifest of %s (%s)' % (image.id, digest[:12]))
+    WorkerPool().map(record, filter(None, images))
+
+def manifest_changes(old, new):
+    """
+    Returns a description of each difference between two manifests.
+    """
+    changes = []
+    if old.get('config') != new['config']:
+        changes.append('configuration or templates changed')
+    packages = old.get('packages', {})
+    for name in sorted(set(packages) | set(new['packages'])):
+        before, after = packages.get(name), new['packages'].get(name)
+        if before != after:
+            changes.append('%s %s -> %s' % (name, before or '(none)', after or '(removed)'))
+    return changes
+
+def check_upstream_changes(connection=create_ec2_connection):
+    """
+    Compares the current build manifest with the one recorded on the 
+    base image.
+    
+    :rtype: tuple
+    :return: The current manifest and the list of changes, empty if 
+        the base image is up to date.
+    """
     if callable(connection):
         connection = connection()
+    manifest = build_manifest()
+    images = find_images(connection, constants.BASE_IMAGE_NAME)
+    if not images:
+        return (manifest, ['no base image %s' % constants.BASE_IMAGE_NAME])
+    image = images[0]
+    digest = image.tags.get(BUILD_MANIFEST_TAG)
+    if digest == manifest_digest(manifest):
+        return (manifest, [])
+    if digest is None:
+        return (manifest, ['no manifest recorded on base image %s' % image.id])
+    try:
+        old = json.loads(manifest_key(image).get_contents_as_string())
+    except Exception, e:
+        return (manifest, ['manifest of base image %s changed (%s)' % (image.id, e)])
+    return (manifest, manifest_changes(old, manifest) or ['manifest of base image %s changed' % image.id])
+
+@task
+def check_upstream():
+    """
+    Tells whether the packages or the configuration changed since
+    the base image was built.
+    """
+    start = time.time()
+    manifest, changes = check_upstream_changes()
+    if not changes:
+        print green('Base image %s is up to date (%d packages checked in %.1fs)' % (
+            constants.BASE_IMAGE_NAME, len(manifest['packages']), time.time() - start))
+    for change in changes:
+        print yellow(change)
+    return changes
+
+class Stage(object):
+    """
+    A stage of a :class:`Pipeline`.
+    
+    :type name: string
+    :param name: The name of the stage.
+    
+    :type function: callable
+    :param function: Called with the results of the previous stages,
+        by name. Its return value is the result of the stage.
+        
+    :type requires: sequence
+    :param requires: The names of the stages that must be done
+        before this one starts.
+        
+    :type resources: sequence
+    :param resources: Names of resources that the stage uses 
+        exclusively. Stages sharing a resource never run at the same
+        time (e.g. ``'host'`` for the stages that use the build 
+        instance through Fabric's ``env``).
+    """
+    
+    def __init__(self, name, function, requires=(), resources=()):
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+        self.resources = tuple(resources)
+        self.start = self.end = None
+        self.error = None
+        
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start if self.start else 0
+
+class Pipeline(object):
+    """
+    Runs a graph of :class:`Stage` objects.
+    
+    Each stage starts in its own thread as soon as the stages it 
+    requires are done and its resources are free. When a stage
+    fails, no new stage is started and :method:`run` aborts once the 
+    running ones are done.
+    """
+    
+    def __init__(self, stages):
+        self.stages = collections.OrderedDict((stage.name, stage) for stage in stages)
+        for stage in stages:
+            for name in stage.requires:
+                if not self.stages.has_key(name):
+                    raise Exception('Stage %s requires unknown stage %s' % (stage.name, name))
+        self.results = {}
+        self.condition = threading.Condition()
+        
+    def ready(self, stage, busy):
+        return stage.start is None \
+            and all(self.stages[name].end and not self.stages[name].error for name in stage.requires) \
+            and not busy.intersection(stage.resources)
+        
+    def work(self, stage):
+        try:
+            result = stage.function(self.results)
+        except (Exception, SystemExit), e:
+            result = None
+            stage.error = e
+        with self.condition:
+            self.results[stage.name] = result
+            stage.end = time.time()
+            self.condition.notify_all()
+        
+    def run(self):
+        """
+        Runs all the stages and returns their results by name.
+        """
+        self.start = time.time()
+        with self.condition:
+            while True:
+                running = [stage for stage in self.stages.itervalues() if stage.start and not stage.end]
+                failed = [stage for stage in self.stages.itervalues() if stage.error]
+                if not failed:
+                    busy = set(resource for stage in running for resource in stage.resources)
+                    for stage in self.stages.itervalues():
+                        if self.ready(stage, busy):
+                            print blue('Starting stage %s' % stage.name)
+                            stage.start = time.time()
+                            busy.update(stage.resources)
+                            running.append(stage)
+                            threading.Thread(target=inherit_build(self.work), args=(stage,), name=stage.name).start()
+                if not running:
+                    break
+                self.condition.wait()
+        self.end = time.time()
+        self.report()
+        failed = [stage for stage in self.stages.itervalues() if stage.error]
+        if failed:
+            abort('Stage %s failed: %s' % (failed[0].name, failed[0].error))
+        return self.results
         
-    images = connection.get_all_images(filters={'tag-key' : '%s.*' % BASE_PREFIX})
-    for image in filter(lambda image: not ( image.tags.has_key(BASE_IMAGE_NAME) or image.tags.has_key(BASE_S3_IMAGE_NAME)), images):
-        print green('De-registering image %s with name %s' % (image.id, image.name))
-        image.deregister()
+    def critical_path(self):
+        """
+        Returns the chain of done stages that determined the 
+        pipeline duration: starting from the last stage to finish, 
+        the required stage that finished last, and so on.
+        """
+        done = [stage for stage in self.stages.itervalues() if stage.end]
+        if not done:
+            return []
+        path = [max(done, key=lambda stage: stage.end)]
+        while path[-1].requires:
+            path.append(max((self.stages[name] for name in path[-1].requires), key=lambda stage: stage.end))
+        path.reverse()
+        return path
+        
+    def report(self):
+        print blue('Stage timings:')
+        for stage in sorted(self.stages.itervalues(), key=lambda stage: stage.start or self.end):
+            if stage.start is None:
+                print white('  %-26s not run' % stage.name)
+                continue
+            status = 'failed' if stage.error else 'done'
+            print (red if stage.error else white)('  %-26s %-6s start +%4ds  duration %4ds' % (
+                stage.name, status, stage.start - self.start, stage.duration))
+        print blue('Critical path: %s' % ' -> '.join('%s (%ds)' % (stage.name, stage.duration) for stage in self.critical_path()))
+        print blue('Total: %ds' % (self.end - self.start))
+
+def check_image(image_name, instance_name):
+    """
+    Launches an instance of ``image_name``, waits for it to answer
+    over SSH and terminates it.
+    """
+    instance = launch_instance(image_name, instance_name)
+    available = check_instance(instance)
+    terminate(instance)
+    if not available:
+        abort('Image %s is broken: its instance %s is not available through SSH' % (image_name, instance.id))
+    return instance
+
+def build_pipeline(checkpoints, manifest=None):
+    """
+    Returns the :class:`Pipeline` of stages of :method:`build_all`.
     
-    snapshots = connection.get_all_snapshots(filters={'tag-key' : '%s.*.image.*' % BASE_PREFIX})
-    for snapshot in filter(lambda snapshot: not ( snapshot.tags.has_key(BASE_IMAGE_NAME) or snapshot.tags.has_key(BASE_S3_IMAGE_NAME)), snapshots):
-        print green('Deleting snapshot %s with name %s' % (snapshot.id, snapshot.tags['Name']))
-        snapshot.delete()
+    The S3 bundle is made as soon as the EBS snapshot is started, 
+    while the snapshot completes and the EBS image is checked.
+    The stages of :method:`make_image` are recorded in ``checkpoints``.
+    The build ``manifest``, if any, is recorded on the images before
+    they are promoted.
+    """
+    stages = [
+        Stage('prepare_volume', lambda results: prepare_volume(checkpoints=checkpoints), resources=('host',)),
+        Stage('start_snapshot', lambda results: run_make_image_stages(checkpoints, 'start_snapshot'), 
+            requires=('prepare_volume',)),
+        Stage('create_image', lambda results: run_make_image_stages(checkpoints)['create_image'], 
+            requires=('start_snapshot',)),
+        Stage('check_image', lambda results: check_image(constants.IMAGE_NAME, constants.INSTANCE_NAME), 
+            requires=('create_image',)),
+        Stage('create_s3_image', lambda results: create_s3_image(), 
+            requires=('start_snapshot',), resources=('host',)),
+        Stage('check_s3_image', lambda results: check_image(constants.S3_IMAGE_NAME, constants.S3_INSTANCE_NAME), 
+            requires=('create_s3_image',)),
+        Stage('decomission_volume', lambda results: decomission_volume(), 
+            requires=('create_image', 'create_s3_image'), resources=('host',)),
+    ]
+    promote_requires = ['check_image', 'check_s3_image', 'decomission_volume']
+    if REPLICA_REGIONS:
+        stages.append(Stage('replicate_image', lambda results: replicate_image(), requires=('check_image',)))
+        promote_requires.append('replicate_image')
+    if manifest:
+        stages.append(Stage('record_build_manifest', 
+            lambda results: record_build_manifest((results['create_image'], results['create_s3_image']), manifest), 
+            requires=('check_image', 'check_s3_image')))
+        promote_requires.append('record_build_manifest')
+    stages.append(Stage('promote_build_images', lambda results: promote_build_images(), requires=promote_requires))
+    return Pipeline(stages)
 
 @task(default=True)
-def build_all():
+def build_all(clean=True, force=False):
     """
     Builds the EBS and S3 based images.
     
     This task does the following:
+    - Checks that a package or the configuration changed since the
+      base image was built (if ``CHECK_PACKAGE_VERSIONS`` is True).
     - Launches an instance of the current _working_ image.
     - Build a new new image on this instance.
     - Launches an instance with the new image to check that the image works.
     - Sets the newly build image as the base image.
+    
+    Independent stages run concurrently (see :method:`build_pipeline`).
+    
+    :type clean: boolean
+    :param clean: Call :method:`clean_images` at the end of the build.
+    
+    :type force: boolean
+    :param force: Build even if nothing changed.
+    
+    :rtype: tuple
+    :return: The EBS and S3 images built, ``None`` if the build was 
+        skipped.
+    """
+    return Build.current().run(clean, force)
+        
+def reset_connections():
+    """
+    Forgets the EC2 and SSH connections inherited from the parent
+    process, without closing them.
+    """
+    with EC2_CONNECTIONS_LOCK:
+        EC2_CONNECTIONS.clear()
+        RESOURCE_INDEXES.clear()
+        STATE_POLLERS.clear()
+    fabric.state.connections.clear()
+    
+def run_build(build):
     """
+    Runs ``build`` for :method:`build_matrix`.
+    
+    :rtype: tuple
+    :return: The architecture, whether the build succeeded, the ids
+        of the images built (``None`` if the build was skipped) or 
+        the error, and the duration of the build.
+    """
+    start = time.time()
+    try:
+        image, s3_image = build.run(clean=False)
+        return (build.arch, True, image and (image.id, s3_image.id), time.time() - start)
+    except SystemExit:
+        # abort() already printed the reason
+        return (build.arch, False, 'aborted', time.time() - start)
+    except Exception, e:
+        return (build.arch, False, str(e) or e.__class__.__name__, time.time() - start)
 
-    existing_running_instances = find_running_instances()
-    if existing_running_instances and len(existing_running_instances) > 0:
-        build_instance = existing_running_instances[0]
-        check_instance(build_instance)
-        print blue('Using existing instance %s...' % build_instance.id)
-        created=False
-    else:     
-        print blue('Launching build instance...')
-        build_instance = launch_instance_and_wait()
-        created=True
-    global EC2_BUILD_INSTANCE
-    EC2_BUILD_INSTANCE = build_instance.id
-    with settings(host_string='root@%s' % build_instance.dns_name):
-        print blue('Building image...')
-        image = make_image()
-        print blue('Checking that image works...')
-        new_instance = launch_instance_and_wait(IMAGE_NAME, INSTANCE_NAME)
-        new_instance.terminate()
-        print blue('Building S3 image...')
-        s3_image = create_s3_image()
-        print blue('Checking that image works...')
-        new_instance = launch_instance_and_wait(S3_IMAGE_NAME, S3_INSTANCE_NAME)
-        new_instance.terminate()        
-        print blue('Cleaning build workspace...')
-        decomission_volume()
-        build_instance.terminate()
-        promote_build_images()
-    if created:
-        build_instance.terminate()
+def build_arch(arch, results):
+    """
+    Runs the build of ``arch`` in a child process of 
+    :method:`build_matrix` and puts the outcome in the ``results``
+    queue.
+    """
+    Build.default = Build(arch)
+    reset_connections()
+    results.put(run_build(Build.default))
+    
+@task
+def build_matrix(archs=None):
+    """
+    Builds the images of several architectures at the same time.
+    
+    Each architecture is built by its own :class:`Build` in its own 
+    process, with its own build instance, volume and names. The 
+    unused images are cleaned once all the builds are done.
+    
+    :type archs: string
+    :param archs: Comma separated architectures to build
+        (``BUILD_ARCHS`` by default).
+    """
+    archs = archs.split(',') if archs else list(BUILD_ARCHS)
+    start = time.time()
+    reports = {}
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=build_arch, args=(arch, results), name=arch) for arch in archs]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    while not results.empty():
+        arch, success, value, duration = results.get()
+        reports[arch] = (success, value, duration)
+    elapsed = time.time() - start
+    
+    print blue('Build matrix results:')
+    failed = []
+    for arch in archs:
+        success, value, duration = reports.get(arch, (False, 'No result', 0))
+        if success and value is None:
+            print green('  %-8s skipped, nothing changed' % arch)
+        elif success:
+            print green('  %-8s built EBS image %s and S3 image %s in %ds' % ((arch,) + value + (duration,)))
+        else:
+            print red('  %-8s failed after %ds: %s' % (arch, duration, value))
+            failed.append(arch)
+    serial = sum(report[2] for report in reports.itervalues())
+    print blue('Total wall-clock time %ds (%ds if built one after the other)' % (elapsed, serial))
+    
     clean_images()
+    if failed:
+        abort('Build failed for %s' % ', '.join(failed))
         
         
 @task
-def clean_all():
+def connection_stats():
+    """
+    Prints the EC2 connections opened and requests made so far.
+    
+    Useful at the end of a task list, e.g. ``fab build_all connection_stats``.
+    """
+    stats = get_connection_stats()
+    if not stats:
+        print yellow('No EC2 connection opened')
+    for region, region_stats in sorted(stats.iteritems()):
+        print green('%s: %d HTTP connection(s) opened, %d request(s) made' % (region, region_stats['connections'], region_stats['requests']))
+        for action, stats in sorted(region_stats['actions'].iteritems()):
+            print (yellow if stats['retries'] or stats['errors'] else green)(
+                '    %s: %d request(s), %d retried (%d throttled), %d error(s), %.0fms average, %.0fms max' % (
+                action, stats['requests'], stats['retries'], stats['throttled'], stats['errors'], 
+                stats['time'] * 1000 / stats['requests'], stats['max_time'] * 1000))
+
+@task
+def clean_all(dry_run=False):
     """
     Cleans all the build environment.
     
@@ -1054,20 +4088,35 @@ def clean_all():
     - De-register EBS and S3 images.
     - Delete image snapshots.
     - Unmount and delete the build volume.
+    
+    The instances, images and snapshots are deleted as one plan 
+    (see :method:`collect_garbage`), which ``dry_run`` only prints.
     """
-    terminate_instances(INSTANCE_NAME)
-    terminate_instances(S3_INSTANCE_NAME)
-    deregister_images()
-    deregister_s3_image()
-    delete_image_snapshots()
+    candidates = [('instances', instance) for name in (constants.INSTANCE_NAME, constants.S3_INSTANCE_NAME) 
+        for instance in find_running_instances(name=name)]
+    candidates += [('images', image) for name in (constants.IMAGE_NAME, constants.S3_IMAGE_NAME) 
+        for image in find_images(name=name)]
+    candidates += [('snapshots', snapshot) for snapshot in find_snapshots(name=constants.IMAGE_NAME)]
+    failures = collect_garbage(candidates, dry_run=dry_run, s3_keys=True)
+    if dry_run:
+        print yellow('The build volume would be decomissioned')
+        return
     decomission_volume()
+    check_garbage_failures(failures)
         
     
     
+def get_build_hosts():
+    """
+    Returns the host list of the build instance, or an empty
+    list if there is no build instance.
+    """
+    try:
+        return [ get_hostname_from_instance() ]
+    except:
+        # There may be no current instance
+        return []
+
 env.user = 'root'
-try:  
-    # There may be no current instance
-    env.hosts = [ get_hostname_from_instance()]
-except:
-    # Try to find a valid running instance
-    get_build_instance()
+if not env.hosts:
+    env.hosts = LazyHosts(get_build_hosts)
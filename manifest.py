@@ -0,0 +1,380 @@
+"""
+Offline resolution of the packages manifest against pacman sync
+databases.
+
+The module only depends on the standard library. It reads the sync
+databases (the ``core.db``, ``extra.db``... tarballs of the mirrors),
+and computes the dependency closure of a list of packages as pacman
+would install it::
+
+    python manifest.py --db ec2.db --db core.db --db extra.db \\
+        --db community.db --packages packages
+
+The databases are looked up in the order they are given, like the
+repositories of ``pacman.conf``.
+"""
+import argparse
+import collections
+import re
+import sys
+import tarfile
+import zlib
+
+DEPENDENCY_PATTERN = re.compile(r'^([^<>=]+)(?:(<=|>=|=|<|>)(.+))?$')
+
+def read_packages(filename):
+    """
+    Returns the package names listed in ``filename``, one per line.
+
+    Blank lines and lines starting by # are skipped, and the names are
+    stripped of surrounding white space.
+
+    :rtype: list
+    """
+    packages = []
+    for line in open(filename):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            packages.append(line)
+    return packages
+
+#
+# Versions
+#
+def rpmvercmp(a, b):
+    """
+    Compares two version strings like pacman's ``rpmvercmp``.
+
+    :rtype: int
+    :return: -1, 0 or 1.
+    """
+    if a == b:
+        return 0
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start_i, start_j = i, j
+        while i < len(a) and not a[i].isalnum():
+            i += 1
+        while j < len(b) and not b[j].isalnum():
+            j += 1
+        if i == len(a) or j == len(b):
+            break
+        if i - start_i != j - start_j:
+            return -1 if i - start_i < j - start_j else 1
+        start_i, start_j = i, j
+        numeric = a[i].isdigit()
+        kind = (lambda c: c.isdigit()) if numeric else (lambda c: c.isalpha())
+        while i < len(a) and kind(a[i]):
+            i += 1
+        while j < len(b) and kind(b[j]):
+            j += 1
+        one, two = a[start_i:i], b[start_j:j]
+        if not two:
+            return 1 if numeric else -1
+        if numeric:
+            one, two = one.lstrip('0'), two.lstrip('0')
+            if len(one) != len(two):
+                return 1 if len(one) > len(two) else -1
+        if one != two:
+            return 1 if one > two else -1
+    rest_a, rest_b = a[i:], b[j:]
+    if not rest_a and not rest_b:
+        return 0
+    if (not rest_a and not rest_b[0].isalpha()) or (rest_a and rest_a[0].isalpha()):
+        return -1
+    return 1
+
+def split_version(version):
+    "Returns the epoch, version and release of ``[epoch:]version[-release]``."
+    epoch, _, version = version.rpartition(':') if ':' in version else ('0', '', version)
+    version, _, release = version.rpartition('-') if '-' in version else (version, '', None)
+    return (epoch or '0', version, release)
+
+def vercmp(a, b):
+    """
+    Compares two package versions like ``vercmp``.
+
+    :rtype: int
+    :return: -1, 0 or 1.
+    """
+    if a == b:
+        return 0
+    epoch_a, version_a, release_a = split_version(a)
+    epoch_b, version_b, release_b = split_version(b)
+    result = rpmvercmp(epoch_a, epoch_b) or rpmvercmp(version_a, version_b)
+    if not result and release_a is not None and release_b is not None:
+        result = rpmvercmp(release_a, release_b)
+    return result
+
+def parse_dependency(value):
+    """
+    Returns the name, operator and version of a dependency such as
+    ``glibc>=2.17``. The operator and version are ``None`` when the
+    dependency has no version constraint.
+    """
+    match = DEPENDENCY_PATTERN.match(value)
+    if not match:
+        return (value, None, None)
+    return match.groups()
+
+def satisfies(version, operator, required):
+    "Returns True if ``version`` matches the ``operator required`` constraint."
+    if operator is None:
+        return True
+    if version is None:
+        return False
+    if operator == '=' and '-' not in required:
+        # A constraint without release matches every release
+        version = version.rsplit('-', 1)[0]
+    result = vercmp(version, required)
+    return {
+        '=' : result == 0,
+        '<' : result < 0,
+        '<=' : result <= 0,
+        '>' : result > 0,
+        '>=' : result >= 0,
+    }[operator]
+
+#
+# Databases
+#
+class Package(object):
+    "A package of a sync database."
+
+    __slots__ = ('repository', 'name', 'version', 'filename', 'csize', 'isize',
+        'md5sum', 'sha256sum', 'depends', 'provides', 'groups')
+
+    def __init__(self, repository, fields):
+        self.repository = repository
+        self.name = fields['NAME'][0]
+        self.version = fields['VERSION'][0]
+        self.filename = fields.get('FILENAME', [None])[0]
+        self.csize = int(fields.get('CSIZE', [0])[0])
+        self.isize = int(fields.get('ISIZE', [0])[0])
+        self.md5sum = fields.get('MD5SUM', [None])[0]
+        self.sha256sum = fields.get('SHA256SUM', [None])[0]
+        self.depends = fields.get('DEPENDS', [])
+        self.provides = fields.get('PROVIDES', [])
+        self.groups = fields.get('GROUPS', [])
+
+    def __repr__(self):
+        return '<Package %s/%s %s>' % (self.repository, self.name, self.version)
+
+def parse_fields(text, fields):
+    "Adds the ``%KEY%`` sections of a database entry to ``fields``."
+    key = None
+    for line in text.splitlines():
+        if line.startswith('%') and line.endswith('%'):
+            key = line[1:-1]
+            fields.setdefault(key, [])
+        elif line and key:
+            fields[key].append(line)
+    return fields
+
+def read_tar(filename):
+    """
+    Yields the path and content of the regular files of the tarball
+    ``filename``.
+    
+    Gzip compressed and uncompressed archives are read directly, 
+    which is several times faster than :mod:`tarfile` on databases 
+    made of thousands of small files. Other formats go through 
+    :mod:`tarfile`.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif data[257:262] != b'ustar':
+        db = tarfile.open(filename)
+        try:
+            for member in db:
+                if member.isfile():
+                    yield member.name, db.extractfile(member).read()
+        finally:
+            db.close()
+        return
+    offset = 0
+    longname = None
+    while offset + 512 <= len(data):
+        header = data[offset:offset + 512]
+        if header.count(b'\0') == 512:
+            break
+        name = header[:100].split(b'\0', 1)[0]
+        prefix = header[345:500].split(b'\0', 1)[0] if header[257:262] == b'ustar' else b''
+        size = int(header[124:136].replace(b'\0', b' ').strip() or b'0', 8)
+        kind = header[156:157]
+        content = data[offset + 512:offset + 512 + size]
+        offset += 512 + (size + 511) // 512 * 512
+        if kind == b'L':
+            longname = content.split(b'\0', 1)[0]
+            continue
+        if kind in (b'0', b'\0'):
+            path = longname or (prefix + b'/' + name if prefix else name)
+            yield path.decode('utf-8'), content
+        longname = None
+
+def parse_db(filename, repository=None):
+    """
+    Returns the packages of the sync database ``filename``.
+
+    Both the single ``desc`` file entries and the older entries split
+    in ``desc`` and ``depends`` files are supported.
+
+    :type repository: string
+    :param repository: The repository name (the file name without
+        extension by default).
+
+    :rtype: list
+    :return: The :class:`Package` objects.
+    """
+    if repository is None:
+        repository = filename.rsplit('/', 1)[-1].split('.', 1)[0]
+    entries = {}
+    for path, data in read_tar(filename):
+        directory, _, name = path.rpartition('/')
+        if name in ('desc', 'depends'):
+            parse_fields(data.decode('utf-8'), entries.setdefault(directory, {}))
+    return [Package(repository, entries[key]) for key in sorted(entries) if 'NAME' in entries[key]]
+
+class UnresolvedError(Exception):
+    pass
+
+class Database(object):
+    """
+    The packages of several sync databases, indexed by name, by
+    provided name and by group.
+
+    A package name present in several databases is taken from the
+    first one, as pacman does.
+    """
+
+    def __init__(self, packages=()):
+        self.packages = {}
+        self.providers = {}
+        self.groups = {}
+        self.add(packages)
+
+    @classmethod
+    def load(cls, filenames):
+        "Returns the database of the sync database files ``filenames``."
+        database = cls()
+        for filename in filenames:
+            database.add(parse_db(filename))
+        return database
+
+    def add(self, packages):
+        for package in packages:
+            if package.name in self.packages:
+                continue
+            self.packages[package.name] = package
+            for value in package.provides:
+                name, operator, version = parse_dependency(value)
+                self.providers.setdefault(name, []).append((package, version))
+            for group in package.groups:
+                self.groups.setdefault(group, []).append(package)
+
+    def find(self, dependency, selected=None):
+        """
+        Returns the package satisfying ``dependency``.
+
+        A package with the dependency name is preferred, then a package
+        already ``selected`` providing it, then the first provider.
+
+        :rtype: :class:`Package`
+        :return: The package or ``None``.
+        """
+        name, operator, version = parse_dependency(dependency)
+        package = self.packages.get(name)
+        if package and satisfies(package.version, operator, version):
+            return package
+        providers = [provider for provider, provided in self.providers.get(name, ())
+            if satisfies(provided, operator, version)]
+        if selected:
+            for provider in providers:
+                if provider.name in selected:
+                    return provider
+        return providers[0] if providers else None
+
+    def resolve(self, names):
+        """
+        Returns the dependency closure of ``names``.
+
+        A name that is not a package but a group stands for all the
+        packages of the group.
+
+        :rtype: :class:`Manifest`
+        :raise UnresolvedError: If a package or dependency can't be
+            satisfied.
+        """
+        selected = {}
+        order = []
+        missing = []
+        queue = collections.deque()
+        for name in names:
+            if name not in self.packages and name in self.groups:
+                queue.extend((package.name, None) for package in self.groups[name])
+            else:
+                queue.append((name, None))
+        while queue:
+            dependency, parent = queue.popleft()
+            package = self.find(dependency, selected)
+            if package is None:
+                missing.append((dependency, parent))
+                continue
+            if package.name in selected:
+                continue
+            selected[package.name] = package
+            order.append(package)
+            queue.extend((value, package.name) for value in package.depends)
+        if missing:
+            raise UnresolvedError(', '.join(
+                '%s (required by %s)' % (dependency, parent) if parent else dependency
+                for dependency, parent in missing))
+        return Manifest(order)
+
+class Manifest(object):
+    "The resolved packages of a build."
+
+    def __init__(self, packages):
+        self.packages = sorted(packages, key=lambda package: package.name)
+
+    @property
+    def download_size(self):
+        return sum(package.csize for package in self.packages)
+
+    @property
+    def installed_size(self):
+        return sum(package.isize for package in self.packages)
+
+    def versions(self):
+        "Returns the version of each package, by name."
+        return dict((package.name, package.version) for package in self.packages)
+
+    def lines(self):
+        "Returns one line per package followed by the totals."
+        lines = ['%s/%s %s %d %d' % (package.repository, package.name, package.version,
+            package.csize, package.isize) for package in self.packages]
+        lines.append('%d packages, %.1fMB to download, %.1fMB installed' % (
+            len(self.packages), self.download_size / 1048576.0, self.installed_size / 1048576.0))
+        return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resolves packages against pacman sync databases.')
+    parser.add_argument('--db', action='append', default=[], required=True,
+        help='sync database, in the order of pacman.conf')
+    parser.add_argument('--packages', help='file listing the packages, one per line')
+    parser.add_argument('names', nargs='*', help='packages or groups')
+    args = parser.parse_args(argv)
+    names = args.names + (read_packages(args.packages) if args.packages else [])
+    try:
+        manifest = Database.load(args.db).resolve(names)
+    except UnresolvedError as e:
+        sys.stderr.write('unresolved: %s\n' % e)
+        return 1
+    for line in manifest.lines():
+        print(line)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Ranking of pacman mirrors by measured download throughput and
+failure rate.
+
+The measures are small range requests made with ``curl`` on the
+host that downloads the packages (see :func:`probe_command` and
+:func:`parse_probes`). They are kept in a :class:`ScoreCache`, where
+older measures count less and less, so that the mirrors are only
+measured again once the scores have expired.
+"""
+import json
+import os
+import pipes
+import time
+
+MARKER = 'ARCHEC2BUILD_MIRROR'
+
+def probe_command(urls, size=256 * 1024, samples=2, timeout=10):
+    """
+    Returns a shell command downloading the first ``size`` bytes of
+    each URL ``samples`` times, one after the other.
+
+    :type urls: list
+    :param urls: ``(server, url)`` pairs, the URL being a file of the
+        server.
+    """
+    lines = []
+    for server, url in urls:
+        for i in range(samples):
+            lines.append("echo %s %s $(curl -s -o /dev/null -r 0-%d --max-time %d "
+                "-w '%%{http_code} %%{time_total} %%{size_download}' %s || true)" % (
+                MARKER, pipes.quote(server), size - 1, timeout, pipes.quote(url)))
+    return '\n'.join(lines)
+
+def parse_probes(out):
+    """
+    Returns the measures printed by the :func:`probe_command` command.
+
+    :rtype: dict
+    :return: ``(succeeded, seconds, bytes)`` tuples, by server.
+    """
+    probes = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or fields[0] != MARKER:
+            continue
+        server, values = fields[1], fields[2:]
+        try:
+            code, seconds, size = values[0], float(values[1]), int(float(values[2]))
+        except (IndexError, ValueError):
+            code, seconds, size = '000', 0, 0
+        probes.setdefault(server, []).append((code in ('200', '206') and size > 0, seconds, size))
+    return probes
+
+def mirrorlist(servers):
+    "Returns the pacman mirror list of ``servers``, in order."
+    return ''.join('Server = %s\n' % server for server in servers)
+
+class ScoreCache(object):
+    """
+    Mirror scores saved in the JSON file ``path``, by key (the region
+    the mirrors are measured from, for instance).
+
+    Each server has an average throughput and failure rate. When new
+    measures come in, the previous averages weigh half as much every
+    ``half_life`` seconds.
+    """
+
+    def __init__(self, path, half_life=7 * 86400):
+        self.path = path
+        self.half_life = half_life
+        self.data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def scores(self, key):
+        return self.data.get(key, {}).get('servers', {})
+
+    def update(self, key, probes, now=None):
+        "Adds the measures ``probes`` (see :func:`parse_probes`) to the scores of ``key``."
+        now = now or time.time()
+        entry = self.data.setdefault(key, { 'servers' : {} })
+        entry['measured'] = now
+        for server, results in probes.items():
+            score = entry['servers'].setdefault(server, {
+                'throughput' : 0.0, 'failure_rate' : 0.0, 'successes' : 0.0, 'samples' : 0.0, 'updated' : now })
+            decay = 0.5 ** ((now - score['updated']) / float(self.half_life))
+            successes = [(seconds, size) for succeeded, seconds, size in results if succeeded]
+            old_successes, old_samples = score['successes'] * decay, score['samples'] * decay
+            if successes:
+                throughput = sum(size for seconds, size in successes) / max(sum(seconds for seconds, size in successes), 0.001)
+                score['throughput'] = (score['throughput'] * old_successes + throughput * len(successes)) / (old_successes + len(successes))
+            failures = len(results) - len(successes)
+            score['failure_rate'] = (score['failure_rate'] * old_samples + failures) / (old_samples + len(results))
+            score['successes'] = old_successes + len(successes)
+            score['samples'] = old_samples + len(results)
+            score['updated'] = now
+
+    def score(self, key, server):
+        "Returns the expected throughput of ``server``, failures included."
+        score = self.scores(key).get(server)
+        if score is None:
+            return None
+        return score['throughput'] * (1 - score['failure_rate'])
+
+    def ranked(self, key, servers):
+        "Returns ``servers`` from the best to the worst, the unmeasured ones last."
+        def order(server):
+            score = self.score(key, server)
+            return (score is None, -(score or 0), servers.index(server))
+        return sorted(servers, key=order)
+
+    def expired(self, key, servers, ttl, now=None):
+        "Tells whether ``servers`` must be measured again."
+        now = now or time.time()
+        measured = self.data.get(key, {}).get('measured', 0)
+        return now - measured > ttl or any(server not in self.scores(key) for server in servers)
@@ -0,0 +1,404 @@
+"""
+Concurrent download of pacman packages into a package cache.
+
+The module only depends on the standard library, it is copied to
+the build instance and run ahead of pacstrap::
+
+    pacman -r /mnt -Sp --print-format '%r %f' base | \\
+        python2 prefetch.py --config pacman.conf \\
+            --dbpath /mnt/var/lib/pacman --cachedir /mnt/var/cache/pacman/pkg
+
+It reads ``repository filename`` lines on its standard input. Every
+package is downloaded from one of the servers of its repository, as
+listed in the pacman configuration, with at most ``--connections``
+downloads per server. The files are checked against the checksums
+of the sync databases before being moved into the cache, so pacman
+finds them there and downloads nothing.
+
+:class:`StandIn` is a local mirror for checking the prefetch (see
+the ``check_prefetch`` task).
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tarfile
+import threading
+import time
+
+try:
+    from urllib2 import urlopen
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from urllib.request import urlopen
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+CHUNK_SIZE = 64 * 1024
+
+def parse_config(path, arch):
+    """
+    Returns the servers of each repository of a pacman configuration.
+
+    :type path: string
+    :param path: The pacman configuration file.
+
+    :type arch: string
+    :param arch: The value of ``$arch`` in the server URLs (when
+        ``Architecture`` is not set or is ``auto``).
+
+    :rtype: dict
+    :return: The server URLs, by repository.
+    """
+    servers = {}
+    repository = None
+    for key, value in read_config_lines(path):
+        if key.startswith('['):
+            repository = key.strip('[]')
+            if repository != 'options':
+                servers.setdefault(repository, [])
+        elif repository == 'options' and key == 'Architecture' and value != 'auto':
+            arch = value
+        elif repository and repository != 'options' and key == 'Server':
+            servers[repository].append(value)
+    for repository, urls in servers.items():
+        servers[repository] = [url.replace('$repo', repository).replace('$arch', arch).rstrip('/')
+            for url in urls]
+    return servers
+
+def read_config_lines(path):
+    "Yields the ``(key, value)`` pairs of a pacman configuration, following the includes."
+    for line in open(path):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        key, _, value = [part.strip() for part in line.partition('=')]
+        if key == 'Include':
+            for included in read_config_lines(value):
+                yield included
+        else:
+            yield key, value
+
+def read_checksums(filename):
+    """
+    Returns the size and checksum of the packages of a sync database.
+
+    :rtype: dict
+    :return: ``(size, algorithm, checksum)`` by package file name.
+    """
+    checksums = {}
+    db = tarfile.open(filename)
+    try:
+        for member in db:
+            if not member.name.endswith('/desc'):
+                continue
+            fields = {}
+            key = None
+            for line in db.extractfile(member).read().decode('utf-8').splitlines():
+                if line.startswith('%') and line.endswith('%'):
+                    key = line.strip('%')
+                elif line and key and key not in fields:
+                    fields[key] = line
+            if 'FILENAME' not in fields:
+                continue
+            if 'SHA256SUM' in fields:
+                checksum = ('sha256', fields['SHA256SUM'])
+            else:
+                checksum = ('md5', fields.get('MD5SUM'))
+            checksums[fields['FILENAME']] = (int(fields.get('CSIZE', 0)),) + checksum
+    finally:
+        db.close()
+    return checksums
+
+def file_checksum(filename, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ChecksumError(Exception):
+    pass
+
+class Package(object):
+    "A package file to download."
+
+    def __init__(self, repository, filename, size=0, algorithm=None, checksum=None):
+        self.repository = repository
+        self.filename = filename
+        self.size = size
+        self.algorithm = algorithm
+        self.checksum = checksum
+
+    def verify(self, path):
+        "Raises a :class:`ChecksumError` if ``path`` is not this package."
+        if self.size and os.path.getsize(path) != self.size:
+            raise ChecksumError('%s: expected %d bytes, got %d' % (self.filename, self.size, os.path.getsize(path)))
+        if self.checksum and file_checksum(path, self.algorithm) != self.checksum:
+            raise ChecksumError('%s: %s mismatch' % (self.filename, self.algorithm))
+
+class ServerPool(object):
+    """
+    The servers of every repository, each one accepting a bounded
+    number of concurrent downloads.
+
+    A download goes to the server of its repository with the fewest
+    downloads in progress, waiting for a free slot if necessary.
+    """
+
+    def __init__(self, servers, connections=2):
+        self.servers = servers
+        self.connections = connections
+        self.active = {}
+        self.stats = {}
+        self.condition = threading.Condition()
+        for urls in servers.values():
+            for url in urls:
+                self.active[url] = 0
+                self.stats[url] = { 'files' : 0, 'bytes' : 0, 'failures' : 0 }
+
+    def acquire(self, repository, exclude=()):
+        """
+        Reserves a slot on a server of ``repository``.
+
+        :rtype: string
+        :return: The server URL, or ``None`` if every server of the
+            repository is in ``exclude``.
+        """
+        candidates = [url for url in self.servers.get(repository, []) if url not in exclude]
+        if not candidates:
+            return None
+        with self.condition:
+            while True:
+                url = min(candidates, key=lambda url: (self.active[url], candidates.index(url)))
+                if self.active[url] < self.connections:
+                    self.active[url] += 1
+                    return url
+                self.condition.wait()
+
+    def release(self, url, size=None):
+        "Frees the slot of ``url``, counting a failure if ``size`` is ``None``."
+        with self.condition:
+            self.active[url] -= 1
+            if size is None:
+                self.stats[url]['failures'] += 1
+            else:
+                self.stats[url]['files'] += 1
+                self.stats[url]['bytes'] += size
+            self.condition.notify_all()
+
+class Prefetcher(object):
+    """
+    Downloads packages into ``cachedir`` with several threads.
+
+    :type servers: dict
+    :param servers: The server URLs by repository, see :func:`parse_config`.
+
+    :type connections: int
+    :param connections: The maximum number of concurrent downloads
+        from one server.
+    """
+
+    def __init__(self, servers, cachedir, connections=2, timeout=60):
+        self.pool = ServerPool(servers, connections)
+        self.cachedir = cachedir
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.cached = []
+        self.downloaded = []
+        self.failed = {}
+        self.elapsed = 0
+
+    def run(self, packages):
+        """
+        Downloads the ``packages`` missing from the cache.
+
+        :rtype: bool
+        :return: True if every package is in the cache.
+        """
+        start = time.time()
+        queue = []
+        for package in packages:
+            path = os.path.join(self.cachedir, package.filename)
+            try:
+                if os.path.exists(path):
+                    package.verify(path)
+                    self.cached.append(package)
+                    continue
+            except ChecksumError:
+                os.remove(path)
+            queue.append(package)
+        slots = sum(len(urls) for urls in self.pool.servers.values()) * self.pool.connections
+        threads = [threading.Thread(target=self.work, args=(queue,)) for i in range(min(slots, len(queue)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+        return not self.failed
+
+    def work(self, queue):
+        while True:
+            with self.lock:
+                if not queue:
+                    return
+                package = queue.pop(0)
+            self.fetch(package)
+
+    def fetch(self, package):
+        "Downloads ``package``, trying each server of its repository in turn."
+        tried = []
+        while True:
+            url = self.pool.acquire(package.repository, tried)
+            if url is None:
+                with self.lock:
+                    self.failed[package.filename] = 'no server left (tried %s)' % ', '.join(tried) if tried else 'no server'
+                return
+            tried.append(url)
+            try:
+                size = self.download(package, '%s/%s' % (url, package.filename))
+            except Exception as e:
+                self.pool.release(url)
+                sys.stderr.write('%s: %s\n' % (url, e))
+                continue
+            self.pool.release(url, size)
+            with self.lock:
+                self.downloaded.append(package)
+            return
+
+    def download(self, package, url):
+        path = os.path.join(self.cachedir, package.filename)
+        part = '%s.part.%d' % (path, threading.current_thread().ident)
+        size = 0
+        try:
+            response = urlopen(url, timeout=self.timeout)
+            try:
+                with open(part, 'wb') as f:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                response.close()
+            package.verify(part)
+            os.rename(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        return size
+
+    def report(self):
+        "Returns the download statistics, one line per server."
+        total = sum(stats['bytes'] for stats in self.pool.stats.values())
+        lines = ['%d packages cached, %d downloaded, %d failed' % (
+            len(self.cached), len(self.downloaded), len(self.failed))]
+        lines.append('%.1fMB in %.1fs (%.2fMB/s)' % (
+            total / 1048576.0, self.elapsed, total / 1048576.0 / max(self.elapsed, 0.001)))
+        for url, stats in sorted(self.pool.stats.items()):
+            if stats['files'] or stats['failures']:
+                lines.append('%s: %d files, %.1fMB, %d failures' % (
+                    url, stats['files'], stats['bytes'] / 1048576.0, stats['failures']))
+        for filename, reason in sorted(self.failed.items()):
+            lines.append('%s: %s' % (filename, reason))
+        return lines
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            server.requests += 1
+        try:
+            time.sleep(server.delay)
+            data = server.files.get(self.path)
+            self.send_response(404 if data is None else 200)
+            self.send_header('Content-Length', str(len(data or b'')))
+            self.end_headers()
+            self.wfile.write(data or b'')
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+class StandIn(ThreadingMixIn, HTTPServer):
+    """
+    Local mirror for the checks, serving ``files`` (their content by
+    URL path), each request taking at least ``delay`` seconds. It 
+    records the peak number of requests served at the same time.
+    """
+    daemon_threads = True
+
+    def __init__(self, files, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.files = files
+        self.delay = delay
+        self.active = self.peak = self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+def read_packages(lines, dbpath):
+    """
+    Returns the packages of the ``repository filename`` lines, with
+    their checksums from the sync databases of ``dbpath``.
+    """
+    checksums = {}
+    packages = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        repository, filename = fields
+        if repository not in checksums:
+            db = os.path.join(dbpath, 'sync', '%s.db' % repository)
+            checksums[repository] = read_checksums(db) if os.path.exists(db) else {}
+        size, algorithm, checksum = checksums[repository].get(filename, (0, None, None))
+        packages.append(Package(repository, filename, size, algorithm, checksum))
+    return packages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Downloads pacman packages into a package cache.')
+    parser.add_argument('--config', default='/etc/pacman.conf', help='pacman configuration listing the servers')
+    parser.add_argument('--server', action='append', default=[],
+        help='server URL used for every repository instead of the configured ones ($repo and $arch are replaced)')
+    parser.add_argument('--arch', default=os.uname()[4], help='value of $arch in the server URLs')
+    parser.add_argument('--dbpath', default='/var/lib/pacman', help='directory containing the sync databases')
+    parser.add_argument('--cachedir', default='/var/cache/pacman/pkg', help='package cache directory')
+    parser.add_argument('--connections', type=int, default=2, help='concurrent downloads per server')
+    parser.add_argument('--timeout', type=int, default=60, help='network timeout in seconds')
+    parser.add_argument('--prefix', default='prefetch: ', help='prefix of the report lines')
+    args = parser.parse_args(argv)
+
+    packages = read_packages(sys.stdin, args.dbpath)
+    servers = parse_config(args.config, args.arch)
+    if args.server:
+        repositories = set(servers) | set(package.repository for package in packages)
+        servers = dict((repository, [url.replace('$repo', repository).replace('$arch', args.arch).rstrip('/')
+            for url in args.server]) for repository in repositories)
+    if not os.path.isdir(args.cachedir):
+        os.makedirs(args.cachedir)
+    prefetcher = Prefetcher(servers, args.cachedir, args.connections, args.timeout)
+    complete = prefetcher.run(packages)
+    for line in prefetcher.report():
+        print('%s%s' % (args.prefix, line))
+    return 0 if complete else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+SSH readiness probe for many hosts at once.
+
+Each host goes through three stages:
+
+- ``tcp``: the SSH port accepts connections. Connections are made
+  without blocking, with a short timeout, and retried.
+- ``banner``: the server sends its identification (``SSH-2.0-...``).
+- ``command``: an authenticated command succeeds. The command check
+  is a function given to the probe, run on a small pool of threads
+  since SSH clients block.
+
+The first two stages of all the hosts share a single ``select`` event
+loop. The probe gives up on the hosts that are not ready when the
+overall deadline is reached.
+"""
+import errno
+import select
+import socket
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+STAGES = ('tcp', 'banner', 'command')
+
+class ProbeResult(object):
+    """
+    The outcome of the probe of a host.
+
+    ``times`` holds the number of seconds from the start of the probe
+    to the completion of each stage reached, and ``error`` the last
+    error met.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.ok = False
+        self.times = {}
+        self.banner = None
+        self.error = None
+        self.attempts = 0
+
+    @property
+    def stage(self):
+        "The last stage completed, or ``None``."
+        done = [stage for stage in STAGES if stage in self.times]
+        return done[-1] if done else None
+
+    def __repr__(self):
+        times = ', '.join('%s %.1fs' % (stage, self.times[stage]) for stage in STAGES if stage in self.times)
+        if self.ok:
+            return '<%s ready: %s>' % (self.host, times)
+        return '<%s not ready (%s): %s>' % (self.host, self.error, times or 'no stage reached')
+
+class Probe(object):
+    """
+    Probes ``hosts`` until they are ready or ``deadline`` seconds
+    have passed.
+
+    :type command: callable
+    :param command: Called with a host and a timeout in seconds for
+        the ``command`` stage. Returns True if the command succeeded.
+        The stage is skipped if ``None``.
+
+    :type connect_timeout: float
+    :param connect_timeout: The timeout of each TCP connection and
+        banner read attempt.
+
+    :type retry_delay: float
+    :param retry_delay: The time to wait after a failed attempt.
+    """
+
+    def __init__(self, hosts, command=None, port=22, deadline=600, connect_timeout=3, retry_delay=2,
+            workers=4):
+        self.hosts = list(hosts)
+        self.command = command
+        self.port = port
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.retry_delay = retry_delay
+        self.workers = workers
+        self.results = dict((host, ProbeResult(host)) for host in self.hosts)
+
+    def run(self):
+        """
+        Runs the probe.
+
+        :rtype: dict
+        :return: The :class:`ProbeResult` of each host.
+        """
+        self.start = time.time()
+        end = self.start + self.deadline
+        # host -> [state, socket, timer, data]
+        states = dict((host, ['wait', None, self.start, b'']) for host in self.hosts)
+        commands = Queue()
+        finished = Queue()
+        workers = []
+        for i in range(min(self.workers, len(self.hosts)) if self.command else 0):
+            worker = threading.Thread(target=self.work, args=(commands, finished))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            while any(state[0] != 'done' for state in states.values()):
+                now = time.time()
+                if now >= end:
+                    for host, state in states.items():
+                        if state[0] != 'done':
+                            result = self.results[host]
+                            result.error = 'deadline reached%s' % (' (%s)' % result.error if result.error else '')
+                            self.close(state)
+                            state[0] = 'done'
+                    break
+                self.collect(finished, states)
+                for host, state in states.items():
+                    if state[0] == 'wait' and now >= state[2]:
+                        self.connect(host, state)
+                    elif state[0] in ('connect', 'banner') and now >= state[2]:
+                        self.fail(host, state, 'timed out in the %s stage' % ('tcp' if state[0] == 'connect' else 'banner'))
+                readers = [state[1] for state in states.values() if state[0] == 'banner']
+                writers = [state[1] for state in states.values() if state[0] == 'connect']
+                timers = [state[2] for state in states.values() if state[0] in ('wait', 'connect', 'banner')]
+                timeout = max(0, min(timers + [end, now + 0.2]) - now)
+                if readers or writers:
+                    readable, writable, _ = select.select(readers, writers, [], timeout)
+                else:
+                    readable, writable = [], []
+                    time.sleep(timeout)
+                for host, state in states.items():
+                    if state[0] == 'connect' and state[1] in writable:
+                        self.connected(host, state)
+                    elif state[0] == 'banner' and state[1] in readable:
+                        self.read_banner(host, state, commands, end)
+                        if state[0] == 'command' and not self.command:
+                            self.succeed(host, state)
+        finally:
+            for worker in workers:
+                commands.put(None)
+            for state in states.values():
+                self.close(state)
+        return self.results
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def close(self, state):
+        if state[1] is not None:
+            state[1].close()
+            state[1] = None
+
+    def fail(self, host, state, error):
+        "Records ``error`` and retries ``host`` after ``retry_delay``."
+        self.close(state)
+        self.results[host].error = error
+        state[0], state[2], state[3] = 'wait', time.time() + self.retry_delay, b''
+
+    def succeed(self, host, state):
+        self.close(state)
+        self.results[host].ok = True
+        self.results[host].error = None
+        state[0] = 'done'
+
+    def connect(self, host, state):
+        self.results[host].attempts += 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        state[1] = sock
+        try:
+            code = sock.connect_ex((host, self.port))
+        except socket.error as e:
+            # Name resolution errors
+            return self.fail(host, state, str(e))
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            return self.fail(host, state, 'tcp: %s' % errno.errorcode.get(code, code))
+        state[0], state[2] = 'connect', time.time() + self.connect_timeout
+
+    def connected(self, host, state):
+        code = state[1].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            return self.fail(host, state, 'tcp: %s' % errno.errorcode.get(code, code))
+        self.results[host].times.setdefault('tcp', self.elapsed())
+        state[0], state[2] = 'banner', time.time() + self.connect_timeout
+
+    def read_banner(self, host, state, commands, end):
+        try:
+            data = state[1].recv(256)
+        except socket.error as e:
+            return self.fail(host, state, 'banner: %s' % e)
+        if not data:
+            return self.fail(host, state, 'banner: connection closed')
+        state[3] += data
+        if b'\n' not in state[3]:
+            if len(state[3]) > 4096:
+                self.fail(host, state, 'banner: no identification line')
+            return
+        for line in state[3].split(b'\n'):
+            if line.startswith(b'SSH-'):
+                self.results[host].banner = line.strip().decode('ascii', 'replace')
+                self.results[host].times.setdefault('banner', self.elapsed())
+                self.close(state)
+                state[0] = 'command'
+                if self.command:
+                    commands.put((host, max(1, end - time.time())))
+                return
+        if len(state[3]) > 4096:
+            self.fail(host, state, 'banner: no identification line')
+
+    def work(self, commands, finished):
+        while True:
+            item = commands.get()
+            if item is None:
+                return
+            host, timeout = item
+            try:
+                ok, error = bool(self.command(host, timeout)), 'command failed'
+            except BaseException as e:
+                # SystemExit included, the host must still be reported
+                ok, error = False, 'command: %s' % (e if not isinstance(e, SystemExit) else 'aborted')
+            finished.put((host, ok, error))
+
+    def collect(self, finished, states):
+        "Handles the command checks that are over."
+        while True:
+            try:
+                host, ok, error = finished.get_nowait()
+            except Empty:
+                return
+            state = states[host]
+            if state[0] != 'command':
+                continue
+            if ok:
+                self.results[host].times['command'] = self.elapsed()
+                self.succeed(host, state)
+            else:
+                # sshd may answer before the keys are installed
+                self.fail(host, state, error)
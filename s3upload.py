@@ -0,0 +1,364 @@
+"""
+Streaming upload of an AMI bundle to S3 while it is being made.
+
+The module only depends on the standard library. It is copied to the
+build instance and run next to ``ec2-bundle-vol``, which writes the
+parts of the bundle (``<prefix>.part.NN``) one after the other, then
+the manifest (``<prefix>.manifest.xml``)::
+
+    (ec2-bundle-vol -d /mnt -p image ...; echo $? > /tmp/bundle.rc) &
+    python2 s3upload.py --dir /mnt --prefix image --bucket amis \\
+        --done-file /tmp/bundle.rc
+
+A part is uploaded as soon as the next one appears (or the bundler
+is done), by a bounded pool of threads. The manifest is uploaded
+last, when every part is in S3. The bundler reads the parts again
+to write the manifest, so the parts are only deleted once it has
+succeeded and the whole bundle is uploaded. The peak space used on
+the file system of the bundle is reported. The credentials are read from the ``AWS_ACCESS_KEY_ID`` and
+``AWS_SECRET_ACCESS_KEY`` environment variables.
+
+:class:`StandIn` is a local S3 server for checking the uploader
+(see the ``check_s3_upload`` task).
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlparse
+    from urllib import quote, unquote
+    from Queue import Queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlparse, quote, unquote
+    from queue import Queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+class UploadError(Exception):
+    pass
+
+class S3Client(object):
+    """
+    Minimal S3 client making signed (version 2) PUT requests.
+
+    :type endpoint: string
+    :param endpoint: The URL of an S3 compatible service, addressed
+        with the bucket in the path. By default, the bucket is
+        addressed as ``https://<bucket>.s3.amazonaws.com``.
+    """
+
+    def __init__(self, bucket, access_key, secret_key, endpoint=None, timeout=60):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        if endpoint:
+            url = urlparse(endpoint)
+            self.secure = url.scheme == 'https'
+            self.host = url.netloc
+            self.prefix = '%s/%s/' % (url.path.rstrip('/'), bucket)
+        else:
+            self.secure = True
+            self.host = '%s.s3.amazonaws.com' % bucket
+            self.prefix = '/'
+
+    def sign(self, verb, key, headers):
+        amz = ''.join('%s:%s\n' % (name.lower(), value) for name, value in sorted(headers.items())
+            if name.lower().startswith('x-amz-'))
+        string = '%s\n%s\n%s\n%s\n%s/%s/%s' % (verb, headers.get('Content-MD5', ''),
+            headers.get('Content-Type', ''), headers['Date'], amz, self.bucket, quote(key))
+        digest = hmac.new(self.secret_key.encode('utf-8'), string.encode('utf-8'), hashlib.sha1).digest()
+        return 'AWS %s:%s' % (self.access_key, base64.b64encode(digest).decode('ascii'))
+
+    def put(self, key, data, acl=None):
+        "Uploads ``data`` as ``key``, raising an :class:`UploadError` on failure."
+        headers = {
+            'Date' : time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime()),
+            'Content-MD5' : base64.b64encode(hashlib.md5(data).digest()).decode('ascii'),
+            'Content-Type' : 'application/octet-stream',
+            'Content-Length' : str(len(data)),
+        }
+        if acl:
+            headers['x-amz-acl'] = acl
+        headers['Authorization'] = self.sign('PUT', key, headers)
+        connection = (HTTPSConnection if self.secure else HTTPConnection)(self.host, timeout=self.timeout)
+        try:
+            connection.request('PUT', self.prefix + quote(key), data, headers)
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise UploadError('PUT %s: %d %s %s' % (key, response.status, response.reason, body[:200]))
+
+class BundleUploader(object):
+    """
+    Uploads the parts of a bundle to S3 while they are produced.
+
+    :type connections: int
+    :param connections: The number of concurrent uploads.
+
+    :type retries: int
+    :param retries: The number of times a failed upload is retried,
+        waiting twice as long each time.
+    """
+
+    def __init__(self, client, directory, prefix, connections=4, retries=5, acl='aws-exec-read',
+            delete=True, poll=0.5):
+        self.client = client
+        self.directory = directory
+        self.prefix = prefix
+        self.connections = connections
+        self.retries = retries
+        self.acl = acl
+        self.delete = delete
+        self.poll = poll
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.errors = []
+        self.uploaded = 0
+        self.bytes = 0
+        self.active = 0
+        self.start_used = self.peak_used = self.used()
+        self.busy = []
+        self.busy_since = None
+
+    def parts(self):
+        "Returns the part files present in the directory, in order."
+        pattern = re.compile(r'^%s\.part\.(\d+)$' % re.escape(self.prefix))
+        parts = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                parts.append((int(match.group(1)), name))
+        return [name for index, name in sorted(parts)]
+
+    def used(self):
+        "Returns the bytes used on the file system of the directory."
+        stats = os.statvfs(self.directory)
+        return (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+
+    def upload(self, name):
+        "Uploads the file ``name``, retrying on failures."
+        path = os.path.join(self.directory, name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        delay = 1
+        for attempt in range(self.retries + 1):
+            try:
+                self.client.put(name, data, self.acl)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise UploadError('%s: %s' % (name, e))
+                sys.stderr.write('%s: %s, retrying in %ds\n' % (name, e, delay))
+                time.sleep(delay)
+                delay *= 2
+        return len(data)
+
+    def remove(self):
+        "Deletes the uploaded parts and manifest."
+        for name in self.parts() + ['%s.manifest.xml' % self.prefix]:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def work(self):
+        while True:
+            name = self.queue.get()
+            if name is None:
+                return
+            with self.lock:
+                if self.active == 0:
+                    self.busy_since = time.time()
+                self.active += 1
+            try:
+                size = self.upload(name)
+                with self.lock:
+                    self.uploaded += 1
+                    self.bytes += size
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(str(e))
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    if self.active == 0:
+                        self.busy.append((self.busy_since, time.time()))
+
+    def run(self, done_file, timeout=None):
+        """
+        Uploads the parts until the bundler writes its exit status in
+        ``done_file``, then the manifest if the bundler succeeded.
+
+        :rtype: bool
+        :return: True if the whole bundle was uploaded.
+        """
+        self.start = time.time()
+        threads = [threading.Thread(target=self.work) for i in range(self.connections)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        queued = set()
+        status = None
+        while True:
+            if os.path.exists(done_file):
+                with open(done_file) as f:
+                    content = f.read().strip()
+                if content:
+                    status = int(content)
+                    self.bundled = os.path.getmtime(done_file)
+            parts = self.parts()
+            # The last part may still be written until the bundler is done
+            ready = parts if status is not None else parts[:-1]
+            with self.lock:
+                self.peak_used = max(self.peak_used, self.used())
+            for name in ready:
+                if name not in queued:
+                    queued.add(name)
+                    self.queue.put(name)
+            if status is not None:
+                break
+            if timeout and time.time() - self.start > timeout:
+                self.errors.append('bundler timed out')
+                break
+            time.sleep(self.poll)
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.end = time.time()
+        if status:
+            self.errors.append('bundler failed with status %d' % status)
+        if self.errors or status is None:
+            return False
+        manifest = '%s.manifest.xml' % self.prefix
+        try:
+            self.bytes += self.upload(manifest)
+            self.uploaded += 1
+        except Exception as e:
+            self.errors.append(str(e))
+            return False
+        self.end = time.time()
+        if self.delete:
+            self.remove()
+        return True
+
+    def overlap(self):
+        "Returns the number of seconds during which parts were uploaded while bundling."
+        bundled = getattr(self, 'bundled', self.end)
+        return sum(max(0, min(end, bundled) - start) for start, end in self.busy)
+
+    def report(self):
+        bundled = getattr(self, 'bundled', self.end)
+        elapsed = self.end - self.start
+        lines = ['%d files, %.1fMB uploaded in %.1fs (%.2fMB/s)' % (self.uploaded, self.bytes / 1048576.0,
+            elapsed, self.bytes / 1048576.0 / max(elapsed, 0.001))]
+        lines.append('bundling %.1fs, uploading %.1fs, overlap %.1fs, upload tail %.1fs' % (
+            bundled - self.start, sum(end - start for start, end in self.busy), self.overlap(),
+            max(0, self.end - bundled)))
+        lines.append('peak space used on %s %.1fMB, %.1fMB more than at the start' % (self.directory,
+            self.peak_used / 1048576.0, (self.peak_used - self.start_used) / 1048576.0))
+        lines.extend(self.errors)
+        return lines
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        bucket, key = self.path.lstrip('/').split('/', 1)
+        key = unquote(key)
+        with server.lock:
+            server.requests += 1
+            if server.failures:
+                server.failures -= 1
+                return self.reply(500, b'<Error><Code>InternalError</Code></Error>')
+        headers = dict((name.lower(), self.headers[name]) for name in self.headers.keys())
+        signed = dict((name, value) for name, value in headers.items() if name.startswith('x-amz-'))
+        signed.update({ 'Content-MD5' : headers.get('content-md5', ''), 
+            'Content-Type' : headers.get('content-type', ''), 'Date' : headers.get('date', '') })
+        signer = S3Client(bucket, server.access_key, server.secret_key)
+        if headers.get('authorization') != signer.sign('PUT', key, signed):
+            return self.reply(403, b'<Error><Code>SignatureDoesNotMatch</Code></Error>')
+        if signed['Content-MD5'] != base64.b64encode(hashlib.md5(data).digest()).decode('ascii'):
+            return self.reply(400, b'<Error><Code>BadDigest</Code></Error>')
+        with server.lock:
+            server.objects[(bucket, key)] = (data, headers.get('x-amz-acl'))
+        self.reply(200)
+
+    def log_message(self, *args):
+        pass
+
+class StandIn(HTTPServer):
+    """
+    Local S3 stand-in for the checks, keeping the objects in memory.
+
+    It accepts the PUT requests of :class:`S3Client` (with the bucket
+    in the path) signed with ``access_key`` and ``secret_key``, and
+    fails the first ``failures`` requests with a 500 error.
+    """
+
+    def __init__(self, access_key, secret_key, failures=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.failures = failures
+        self.requests = 0
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%d' % self.server_address
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Uploads an AMI bundle to S3 while it is made.')
+    parser.add_argument('--dir', required=True, help='directory the bundle is written to')
+    parser.add_argument('--prefix', required=True, help='bundle prefix')
+    parser.add_argument('--bucket', required=True, help='destination bucket')
+    parser.add_argument('--done-file', required=True, help='file the bundler exit status is written to')
+    parser.add_argument('--endpoint', help='S3 compatible service URL (bucket in the path)')
+    parser.add_argument('--connections', type=int, default=4, help='concurrent uploads')
+    parser.add_argument('--retries', type=int, default=5, help='retries per file')
+    parser.add_argument('--keep', action='store_true', help='keep the bundle once uploaded')
+    parser.add_argument('--timeout', type=int, default=None, help='maximum seconds to wait for the bundler')
+    parser.add_argument('--prefix-report', default='upload: ', help='prefix of the report lines')
+    args = parser.parse_args(argv)
+
+    client = S3Client(args.bucket, os.environ['AWS_ACCESS_KEY_ID'], os.environ['AWS_SECRET_ACCESS_KEY'],
+        args.endpoint)
+    uploader = BundleUploader(client, args.dir, args.prefix, args.connections, args.retries,
+        delete=not args.keep)
+    complete = uploader.run(args.done_file, args.timeout)
+    for line in uploader.report():
+        print('%s%s' % (args.prefix_report, line))
+    return 0 if complete else 1
+
+if __name__ == '__main__':
+    sys.exit(main())